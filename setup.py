@@ -103,6 +103,7 @@ setup(
         "elasticsearch==8.7",
         "fastjsonschema>=2.15.3",
         "filetype>=1.0.7",
+        "numpy>=1.21",
         "Pillow>=8.0",
         "pyyaml",
         "sparqlwrapper>=1.4.1",
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+"""Checkpoints to resume long-running tasks."""
+
+import os
+import pickle
+from glob import glob
+from time import monotonic
+
+from tolkein import tolog
+
+LOGGER = tolog.logger(__name__)
+
+CHECKPOINT_VERSION = 2
+
+
+class Checkpoint:
+    """State saved to a file at intervals.
+
+    Saved state is only loaded by a checkpoint with the same version and
+    identity, such as the index name and root taxon of a traversal.
+    """
+
+    def __init__(self, path, *, interval=600, **identity):
+        """Init Checkpoint class."""
+        self.path = path
+        self.interval = interval
+        self.identity = {"version": CHECKPOINT_VERSION, **identity}
+        self.saved = monotonic()
+
+    def load(self):
+        """Load saved state, returning None if there is no matching state."""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, "rb") as fh:
+                saved = pickle.load(fh)
+        except (EOFError, pickle.UnpicklingError):
+            LOGGER.warning("Unable to read checkpoint %s, starting again", self.path)
+            return None
+        if saved.get("identity", None) != self.identity:
+            LOGGER.warning("Checkpoint %s does not match, starting again", self.path)
+            return None
+        return saved["state"]
+
+    def save(self, state, *, force=False):
+        """Save state if the interval has passed since the last save."""
+        if not force and monotonic() - self.saved < self.interval:
+            return False
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as fh:
+            pickle.dump(
+                {"identity": self.identity, "state": state},
+                fh,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(tmp_path, self.path)
+        self.saved = monotonic()
+        return True
+
+
+def remove_checkpoints(pattern):
+    """Remove checkpoint files matching a glob pattern."""
+    for path in glob(pattern):
+        os.remove(path)
@@ -1,20 +1,30 @@
 #!/usr/bin/env python3
 """Elasticsearch functions."""
 
+import contextlib
+import json
 import logging
 import os
 import platform
+import queue
 import signal
 import sys
+import threading
 import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 from pathlib import Path
 from subprocess import PIPE
 from subprocess import Popen
 
 import ujson
-from elasticsearch import ConflictError
+from elasticsearch import ApiError
 from elasticsearch import Elasticsearch
 from elasticsearch import NotFoundError
+from elasticsearch import TransportError
 from elasticsearch import client
 from elasticsearch import helpers
 from tolkein import tofile
@@ -23,16 +33,63 @@ from tqdm import tqdm
 
 LOGGER = tolog.logger(__name__)
 
+RETRY_STATUS = {429, 502, 503, 504}
+
+BULK_LOAD_SESSIONS = []
+
+
+ES_CLIENTS = {}
+
+
+def es_hosts(opts):
+    """List Elasticsearch host URLs from all es-host entries."""
+    hosts = []
+    for host in opts["es-host"]:
+        if "://" not in host:
+            host = f"http://{host}"
+        hosts.append(host)
+    return hosts
+
+
+def es_client_options(opts):
+    """Set Elasticsearch client connection pool options."""
+    options = {
+        "request_timeout": 1800,
+        "max_retries": 10,
+        "retry_on_timeout": True,
+        "connections_per_node": int(opts.get("es-connections", 10)),
+        "http_compress": bool(opts.get("es-compress", False)),
+        "node_selector_class": "round_robin",
+    }
+    if opts.get("es-sniff", False):
+        options.update(
+            {
+                "sniff_on_start": True,
+                "sniff_on_node_failure": True,
+                "min_delay_between_sniffing": 60,
+            }
+        )
+    return options
+
+
+def es_client(opts):
+    """Get a pooled Elasticsearch client shared within the current process."""
+    hosts = es_hosts(opts)
+    options = es_client_options(opts)
+    # clients are not fork-safe so forked workers each create their own
+    key = (os.getpid(), tuple(hosts), tuple(sorted(options.items())))
+    if key not in ES_CLIENTS:
+        ES_CLIENTS[key] = Elasticsearch(hosts=hosts, **options)
+    return ES_CLIENTS[key]
+
 
 def test_connection(opts, *, log=False):
     """Test connection to Elasticsearch."""
     connected = False
-    host = opts["es-host"][0]
-    host = f"http://{host}"
-    hosts = [host]
+    hosts = es_hosts(opts)
     # with tolog.DisableLogger():
     # try:
-    es = Elasticsearch(hosts=hosts, timeout=1800, max_retries=10, retry_on_timeout=True)
+    es = es_client(opts)
     connected = es.info()
     #   pass
     if not connected:
@@ -138,32 +195,197 @@ def launch_es(opts, log=True):
     return es
 
 
+class MetadataCache:
+    """Cache index existence and loaded templates for the current run.
+
+    Only existing indices are cached, so an index created outside of
+    index_create is still found on the next check.
+    """
+
+    def __init__(self):
+        """Init MetadataCache class."""
+        self.indices = set()
+        self.templates = {}
+        self.saved = 0
+        self._lock = threading.Lock()
+
+    def hit(self):
+        """Count a round trip saved by the cache."""
+        with self._lock:
+            self.saved += 1
+
+    def invalidate(self, index_name=None):
+        """Forget cached state for one or all indices and templates."""
+        with self._lock:
+            if index_name is None:
+                self.indices = set()
+                self.templates = {}
+            else:
+                self.indices.discard(index_name)
+
+
+METADATA_CACHE = MetadataCache()
+
+
 def index_exists(es, index_name):
     """Test if Elasticsearch index exists."""
+    if index_name in METADATA_CACHE.indices:
+        METADATA_CACHE.hit()
+        return True
     es_client = client.IndicesClient(es)
     with tolog.DisableLogger():
         res = es_client.exists(index=index_name)
+    if res:
+        METADATA_CACHE.indices.add(index_name)
     return res
 
 
 def index_create(es, index_name):
     """Create an Elasticsearch index if it does not already exist."""
     es_client = client.IndicesClient(es)
+    METADATA_CACHE.invalidate(index_name)
     res = index_exists(es, index_name)
     if not res:
         with tolog.DisableLogger():
             res = es_client.create(index=index_name)
+        METADATA_CACHE.indices.add(index_name)
     return res
 
 
 def load_mapping(es, mapping_name, mapping):
     """Load index mapping template into Elasticsearch."""
+    key = json.dumps(mapping, sort_keys=True, default=str)
+    if METADATA_CACHE.templates.get(mapping_name) == key:
+        METADATA_CACHE.hit()
+        return {"acknowledged": True}
     es_client = client.IndicesClient(es)
     with tolog.DisableLogger():
         res = es_client.put_template(name=mapping_name, body=mapping)
+    METADATA_CACHE.templates[mapping_name] = key
     return res
 
 
+def log_metadata_cache():
+    """Log the number of round trips saved by the metadata cache."""
+    LOGGER.info(
+        "Index metadata cache saved %d Elasticsearch round trips",
+        METADATA_CACHE.saved,
+    )
+
+
+class BulkLoadSession:
+    """Relax index settings for bulk loading, restoring them on exit.
+
+    While a session is active, refresh_interval is disabled and replicas are
+    removed on the session indices, and refreshes requested by index_stream
+    are deferred until refresh_barrier is called or the session ends.
+    """
+
+    def __init__(self, es, indices, *, replicas=0):
+        """Init BulkLoadSession class."""
+        self.es = es
+        self.indices = list(indices)
+        self.replicas = replicas
+        self.original = {}
+        self.deferred = set()
+
+    def __enter__(self):
+        """Apply bulk-load settings to existing indices."""
+        es_client = client.IndicesClient(self.es)
+        try:
+            for index_name in self.indices:
+                if not index_exists(self.es, index_name):
+                    continue
+                with tolog.DisableLogger():
+                    res = es_client.get_settings(index=index_name, flat_settings=True)
+                for name, obj in res.items():
+                    settings = obj["settings"]
+                    self.original[name] = {
+                        "index.refresh_interval": settings.get(
+                            "index.refresh_interval", None
+                        ),
+                        "index.number_of_replicas": settings.get(
+                            "index.number_of_replicas", None
+                        ),
+                    }
+                    LOGGER.info(
+                        "Setting bulk-load mode on %s (original settings %s)",
+                        name,
+                        self.original[name],
+                    )
+                    with tolog.DisableLogger():
+                        es_client.put_settings(
+                            index=name,
+                            settings={
+                                "index.refresh_interval": "-1",
+                                "index.number_of_replicas": self.replicas,
+                            },
+                        )
+        except Exception:
+            self.restore()
+            raise
+        BULK_LOAD_SESSIONS.append(self)
+        return self
+
+    def __exit__(self, *args):
+        """Refresh and restore original index settings."""
+        if self in BULK_LOAD_SESSIONS:
+            BULK_LOAD_SESSIONS.remove(self)
+        try:
+            self.barrier()
+        finally:
+            self.restore()
+
+    def defer_refresh(self, index_name):
+        """Defer a refresh if the index is managed by this session."""
+        if index_name not in self.original:
+            return False
+        self.deferred.add(index_name)
+        return True
+
+    def barrier(self, es=None):
+        """Refresh all indices with deferred refreshes."""
+        if not self.deferred:
+            return
+        es_client = client.IndicesClient(es or self.es)
+        es_client.refresh(index=",".join(sorted(self.deferred)))
+        self.deferred = set()
+
+    def restore(self):
+        """Restore original index settings."""
+        es_client = client.IndicesClient(self.es)
+        for name, settings in self.original.items():
+            try:
+                with tolog.DisableLogger():
+                    es_client.put_settings(index=name, settings=settings)
+            except Exception as err:
+                LOGGER.error("Unable to restore settings %s on %s", settings, name)
+                LOGGER.error(err)
+        self.original = {}
+
+
+def bulk_load(es, indices, *, enabled=True):
+    """Return a bulk-load session context, or a null context if disabled."""
+    if not enabled:
+        return contextlib.nullcontext()
+    return BulkLoadSession(es, indices)
+
+
+def refresh_index(es, index_name):
+    """Refresh an index unless the refresh is deferred by a bulk-load session."""
+    if any(session.defer_refresh(index_name) for session in BULK_LOAD_SESSIONS):
+        return False
+    es_client = client.IndicesClient(es)
+    es_client.refresh(index=index_name)
+    return True
+
+
+def refresh_barrier(es):
+    """Refresh indices with refreshes deferred by bulk-load sessions."""
+    for session in BULK_LOAD_SESSIONS:
+        session.barrier(es)
+
+
 def get_size(obj, seen=None):
     """Recursively find size of objects."""
     size = sys.getsizeof(obj)
@@ -183,6 +405,360 @@ def get_size(obj, seen=None):
     return size
 
 
+class BulkConcurrency:
+    """Adaptive limit on the number of concurrent bulk requests."""
+
+    def __init__(self, threads):
+        """Init BulkConcurrency class."""
+        self.max_limit = max(1, int(threads))
+        self.limit = self.max_limit
+        self.active = 0
+        self.accepted = 0
+        self.rejected = 0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        """Wait for a free request slot."""
+        with self._condition:
+            while self.active >= self.limit:
+                self._condition.wait()
+            self.active += 1
+        return self
+
+    def __exit__(self, *args):
+        """Release a request slot."""
+        with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def accept(self):
+        """Record an accepted request, slowly restoring concurrency."""
+        with self._condition:
+            self.accepted += 1
+            if self.limit < self.max_limit and self.accepted >= 4 * self.limit:
+                self.limit += 1
+                self.accepted = 0
+                self._condition.notify_all()
+
+    def reject(self):
+        """Record a rejected request, halving concurrency."""
+        with self._condition:
+            self.rejected += 1
+            self.accepted = 0
+            if self.limit > 1:
+                self.limit = max(1, self.limit // 2)
+                LOGGER.warning(
+                    "Elasticsearch rejected bulk request, reducing concurrency to %d",
+                    self.limit,
+                )
+
+
+def is_rejection(status, error=None):
+    """Test whether a bulk response indicates the cluster is overloaded."""
+    if status == 429:
+        return True
+    if isinstance(error, dict):
+        return error.get("type") == "es_rejected_execution_exception"
+    return error is not None and "es_rejected_execution_exception" in str(error)
+
+
+def failed_action(action, status, error):
+    """Describe a bulk action that could not be indexed."""
+    return False, {"status": status, "error": error, "action": action}
+
+
+def serialize_actions(es, actions, failures):
+    """Expand and serialize bulk actions to (action, lines) pairs.
+
+    Actions that cannot be serialized are added to ``failures``.
+    """
+    serializer = es.transport.serializers.get_serializer("application/json")
+    for action in actions:
+        try:
+            header, data = helpers.expand_action(action)
+            lines = [serializer.dumps(header)]
+            if data is not None:
+                lines.append(serializer.dumps(data))
+        except (TypeError, ValueError, OverflowError) as err:
+            failures.append(failed_action(action, None, str(err)))
+            continue
+        yield action, lines
+
+
+class ChunkSizer:
+    """Bulk chunk size limits, optionally tuned from measured latency."""
+
+    def __init__(
+        self,
+        chunk_size=500,
+        max_bytes=10485760,
+        *,
+        autotune=False,
+        target_took=1000,
+        min_size=10,
+        max_size=10000,
+    ):
+        """Init ChunkSizer class."""
+        self.chunk_size = max(1, int(chunk_size))
+        self.max_bytes = int(max_bytes) if max_bytes else None
+        self.autotune = autotune
+        self.target_took = int(target_took)
+        self.min_size = min(int(min_size), self.chunk_size)
+        self.max_size = max(int(max_size), self.chunk_size)
+        self._lock = threading.Lock()
+
+    def observe(self, took, count):
+        """Adjust chunk size from the server-side time taken by a bulk request."""
+        if not self.autotune or not count or took is None:
+            return
+        with self._lock:
+            if count < self.chunk_size and took < self.target_took:
+                # chunk was limited by bytes or the end of the stream
+                return
+            if took > self.target_took:
+                size = int(self.chunk_size * 0.67)
+            elif took < self.target_took / 2:
+                size = int(self.chunk_size * 1.5)
+            else:
+                return
+            self.chunk_size = max(self.min_size, min(self.max_size, size))
+
+
+def chunk_actions(serialized, sizer):
+    """Group serialized actions into bulk request chunks by count and bytes."""
+    chunk = []
+    chunk_bytes = 0
+    for entry in serialized:
+        # +1 for the newline after each line of the NDJSON body
+        entry_bytes = sum(len(line) + 1 for line in entry[1])
+        if chunk and (
+            len(chunk) >= sizer.chunk_size
+            or sizer.max_bytes is not None
+            and chunk_bytes + entry_bytes > sizer.max_bytes
+        ):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(entry)
+        chunk_bytes += entry_bytes
+    if chunk:
+        yield chunk
+
+
+def send_bulk_chunk(es, chunk, concurrency, sizer, *, max_retries=8, backoff=1):
+    """Send a bulk request, retrying retryable failures with backoff.
+
+    Items that fail with a retryable status (or whole requests that fail with
+    a retryable status or connection error) are resent up to ``max_retries``
+    times with exponential backoff. Requests that are too large are split in
+    half. All other failures are returned immediately.
+    """
+    results = []
+    attempt = 0
+    while chunk:
+        res = None
+        error = None
+        with concurrency:
+            try:
+                res = es.bulk(operations=[line for _, lines in chunk for line in lines])
+            except (ApiError, TransportError) as err:
+                error = err
+        retry = []
+        rejected = False
+        if error is not None:
+            status = getattr(error, "status_code", None)
+            if status == 413 and len(chunk) > 1:
+                mid = len(chunk) // 2
+                for part in (chunk[:mid], chunk[mid:]):
+                    results += send_bulk_chunk(
+                        es,
+                        part,
+                        concurrency,
+                        sizer,
+                        max_retries=max_retries,
+                        backoff=backoff,
+                    )
+                return results
+            if status is not None and status not in RETRY_STATUS:
+                results += [
+                    failed_action(action, status, str(error)) for action, _ in chunk
+                ]
+                return results
+            retry = [(entry, status, str(error)) for entry in chunk]
+            rejected = is_rejection(status, error)
+        else:
+            sizer.observe(res.get("took"), len(chunk))
+            for entry, item in zip(chunk, res["items"]):
+                op_type, info = item.copy().popitem()
+                status = info.get("status", 500)
+                if 200 <= status < 300:
+                    results.append((True, {op_type: info}))
+                elif status in RETRY_STATUS or is_rejection(status, info.get("error")):
+                    retry.append((entry, status, info.get("error")))
+                    rejected = rejected or is_rejection(status, info.get("error"))
+                else:
+                    results.append(failed_action(entry[0], status, info.get("error")))
+        if rejected:
+            concurrency.reject()
+        elif error is None:
+            concurrency.accept()
+        if not retry:
+            break
+        if attempt >= max_retries:
+            results += [
+                failed_action(entry[0], status, err) for entry, status, err in retry
+            ]
+            break
+        time.sleep(min(backoff * 2**attempt, 60))
+        attempt += 1
+        chunk = [entry for entry, _, _ in retry]
+    return results
+
+
+def parallel_bulk(
+    es, actions, *, sizer=None, threads=1, queue_size=None, max_retries=8
+):
+    """Send bulk requests from multiple threads with a bounded in-flight queue."""
+    if sizer is None:
+        sizer = ChunkSizer()
+    concurrency = BulkConcurrency(threads)
+    if queue_size is None:
+        queue_size = 2 * concurrency.max_limit
+    queue_size = max(int(queue_size), concurrency.max_limit)
+    failures = []
+    chunks = chunk_actions(serialize_actions(es, actions, failures), sizer)
+    with ThreadPoolExecutor(max_workers=concurrency.max_limit) as executor:
+        in_flight = set()
+        for chunk in chunks:
+            while failures:
+                yield failures.pop()
+            if len(in_flight) >= queue_size:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+            in_flight.add(
+                executor.submit(
+                    send_bulk_chunk,
+                    es,
+                    chunk,
+                    concurrency,
+                    sizer,
+                    max_retries=int(max_retries),
+                )
+            )
+        while in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+    while failures:
+        yield failures.pop()
+
+
+def dead_letter_entry(index_name, failure):
+    """Convert a failed bulk action to a dead-letter record."""
+    action = failure["action"]
+    op_type = action.get("_op_type", "index")
+    if "script" in action:
+        op_type = "attributes"
+        entry = action["script"]["params"]
+    elif op_type == "update":
+        entry = action["doc"]
+    else:
+        entry = action["_source"]
+    return {
+        "_index": action.get("_index", index_name),
+        "_id": action["_id"],
+        "_op_type": op_type,
+        "status": failure["status"],
+        "error": failure["error"],
+        "entry": entry,
+    }
+
+
+def stream_ndjson(path):
+    """Stream records from an NDJSON file."""
+    with open(path) as fh:
+        for line in fh:
+            if line.strip():
+                yield ujson.loads(line)
+
+
+def stream_dead_letters(path):
+    """Stream records from an NDJSON dead-letter file."""
+    yield from stream_ndjson(path)
+
+
+def read_change_log(path, index_name):
+    """Read IDs of documents in an index recorded in a change log."""
+    if not os.path.exists(path):
+        return set()
+    return {
+        record["_id"]
+        for record in stream_ndjson(path)
+        if record["_index"] == index_name
+    }
+
+
+def replay_dead_letters(es, path, *, dry_run=False, log=False, **kwargs):
+    """Resubmit actions recorded in a dead-letter file in bulk.
+
+    Actions that fail again are written back to the dead-letter file. Actions
+    left over from an interrupted replay are resubmitted by the next replay.
+    """
+    replay_path = f"{path}.replay" if path else None
+    if not path or not (os.path.exists(path) or os.path.exists(replay_path)):
+        LOGGER.info("No failed documents to replay")
+        return 0, 0
+    if dry_run:
+        paths = [name for name in (replay_path, path) if os.path.exists(name)]
+    else:
+        if os.path.exists(path):
+            # keep actions from any interrupted replay until a replay completes
+            with open(path, "r") as infile, open(replay_path, "a") as outfile:
+                outfile.write(infile.read())
+            os.remove(path)
+        paths = [replay_path]
+    groups = defaultdict(list)
+    for name in paths:
+        for record in stream_dead_letters(name):
+            groups[(record["_index"], record["_op_type"])].append(
+                (record["_id"], record["entry"])
+            )
+    success = 0
+    failed = 0
+    for (index_name, op_type), entries in groups.items():
+        LOGGER.info("Replaying %d failed documents into %s", len(entries), index_name)
+        ok, not_ok = index_stream(
+            es,
+            index_name,
+            iter(entries),
+            _op_type=op_type,
+            dry_run=dry_run,
+            log=log,
+            **{**kwargs, "dead_letter": path},
+        )
+        success += ok
+        failed += not_ok
+    if not dry_run:
+        os.remove(replay_path)
+    return success, failed
+
+
+def bulk_options(opts):
+    """Set index_stream bulk keyword arguments from command options."""
+    dead_letter = opts.get("es-dead-letter", None)
+    if dead_letter is None and "hub-path" in opts:
+        dead_letter = os.path.join(opts["hub-path"], "dead_letter.jsonl")
+    return {
+        "chunk_size": opts.get("es-batch", 500),
+        "max_chunk_bytes": opts.get("es-batch-bytes", 10485760),
+        "autotune": opts.get("es-autotune", False),
+        "threads": opts.get("es-threads", 1),
+        "dead_letter": dead_letter,
+        "change_log": opts.get("change-log", None),
+    }
+
+
 def index_stream(
     es,
     index_name,
@@ -192,8 +768,35 @@ def index_stream(
     log=False,
     dry_run=False,
     chunk_size=500,
+    max_chunk_bytes=10485760,
+    autotune=False,
+    threads=1,
+    queue_size=None,
+    max_retries=8,
+    dead_letter=None,
+    change_log=None,
 ):
-    """Load bulk entries from stream into Elasticsearch index."""
+    """Load bulk entries from stream into Elasticsearch index.
+
+    Bulk requests hold at most ``chunk_size`` actions and ``max_chunk_bytes``
+    bytes of serialized NDJSON. With ``autotune``, the chunk size is adjusted
+    from the ``took`` time reported for each bulk request.
+
+    Bulk requests are sent from up to ``threads`` worker threads with at most
+    ``queue_size`` chunks in flight. Concurrency is reduced automatically when
+    Elasticsearch rejects requests with a 429 status.
+
+    Retryable failures are retried up to ``max_retries`` times with backoff.
+    Documents that still fail are appended to the NDJSON ``dead_letter`` file
+    so they can be resubmitted with ``replay_dead_letters``.
+
+    With ``_op_type="attributes"``, each entry is a partial document. Its
+    ``attributes`` replace stored attributes with the same key and other
+    fields are set directly, using the update_attributes_by_key script.
+
+    IDs of documents that are written successfully are appended to the NDJSON
+    ``change_log`` file so later fill runs can be limited to affected taxa.
+    """
     # LOGGER.info("Indexing bulk entries to %s", index_name)
     if _op_type == "index":
         actions = (
@@ -210,88 +813,459 @@ def index_stream(
             {"_index": index_name, "_id": entry_id, "doc": entry, "_op_type": _op_type}
             for entry_id, entry in stream
         )
+    elif _op_type == "attributes":
+        actions = (
+            {
+                "_index": index_name,
+                "_id": entry_id,
+                "_op_type": "update",
+                "retry_on_conflict": 5,
+                "script": {"id": "update_attributes_by_key", "params": entry},
+            }
+            for entry_id, entry in stream
+        )
 
     def dry_run_iterator(es, actions):
         """Alternate iterator for dry run."""
         for action in actions:
             yield True, {}
 
-    def debug_actions(actions, batch):
-        """Wrap actions for debugging."""
-        for action in actions:
-            if len(batch) == chunk_size:
-                batch = []
-            batch.append(action)
-            yield action
-
-    batch = []
-    actions = debug_actions(actions, batch)
-
+    tracer = logging.getLogger("elasticsearch")
+    tracer.setLevel(logging.ERROR)
+    if dry_run:
+        iterator = dry_run_iterator(es, actions)
+    else:
+        sizer = ChunkSizer(chunk_size, max_chunk_bytes, autotune=bool(autotune))
+        iterator = parallel_bulk(
+            es,
+            actions,
+            sizer=sizer,
+            threads=int(threads),
+            queue_size=queue_size,
+            max_retries=max_retries,
+        )
+    success = 0
+    failed = 0
+    if log:
+        iterator = tqdm(iterator, unit=" records", unit_scale=True)
+    dead_letter_file = None
+    change_log_file = None
+    if change_log is not None and not dry_run:
+        Path(change_log).parent.mkdir(parents=True, exist_ok=True)
+        change_log_file = open(change_log, "a")
     try:
-        tracer = logging.getLogger("elasticsearch")
-        tracer.setLevel(logging.ERROR)
-        if dry_run:
-            iterator = dry_run_iterator(es, actions)
-        else:
-            chunk_size = int(chunk_size)
-            iterator = helpers.streaming_bulk(es, actions, chunk_size)
-        success = 0
-        failed = 0
-        if log:
-            iterator = tqdm(iterator, unit=" records", unit_scale=True)
         for ok, response in iterator:
             if ok:
                 success += 1
-            else:
-                failed += 1
-    except Exception as bulk_err:
-        for action in batch:
-            try:
-                if _op_type == "index":
-                    es.create(
-                        index=index_name, id=action["_id"], document=action["_source"]
-                    )
-                else:
-                    es.update(index=index_name, id=action["_id"], doc=action["doc"])
-            except ConflictError:
-                pass
-            except OverflowError:
-                pass
-            except Exception as err:
-                LOGGER.warn(
-                    "Size of document that failed to index is %d bytes",
-                    get_size(action),
-                )
-                LOGGER.warn(action)
-                raise err
-        # raise bulk_err
-    es_client = client.IndicesClient(es)
-    es_client.refresh(index=index_name)
+                if change_log_file is not None:
+                    for info in response.values():
+                        record = {"_index": index_name, "_id": info["_id"]}
+                        change_log_file.write(json.dumps(record) + "\n")
+                continue
+            failed += 1
+            if dead_letter is None:
+                LOGGER.debug(response)
+                continue
+            if dead_letter_file is None:
+                Path(dead_letter).parent.mkdir(parents=True, exist_ok=True)
+                dead_letter_file = open(dead_letter, "a")
+            record = dead_letter_entry(index_name, response)
+            dead_letter_file.write(json.dumps(record, default=str) + "\n")
+    finally:
+        if dead_letter_file is not None:
+            dead_letter_file.close()
+        if change_log_file is not None:
+            change_log_file.close()
+    if failed:
+        if dead_letter is None:
+            LOGGER.warning("Failed to index %d documents into %s", failed, index_name)
+        else:
+            LOGGER.warning(
+                "Failed to index %d documents into %s, written to '%s'",
+                failed,
+                index_name,
+                dead_letter,
+            )
+    refresh_index(es, index_name)
     return success, failed
 
 
-def stream_template_search_results(es, *, index, body, size=10):
-    """Stream results of a template search."""
-    body["params"].update({"size": size})
+def open_point_in_time(es, *, index, keep_alive="10m"):
+    """Open a point in time, returning None if not supported."""
+    try:
+        with tolog.DisableLogger():
+            res = es.open_point_in_time(index=index, keep_alive=keep_alive)
+    except (ApiError, AttributeError) as err:
+        LOGGER.debug("Unable to open point in time on %s: %s", index, err)
+        return None
+    return res["id"]
+
+
+def render_template_query(es, body, *, size=10, tiebreaker=None):
+    """Render a search template to a query body for paging."""
     with tolog.DisableLogger():
-        res = es.search_template(
-            index=index, body=body, rest_total_hits_as_int=True, scroll="90m"
+        rendered = es.render_search_template(
+            **{key: body[key] for key in ("id", "source", "params") if key in body}
         )
+    query = {
+        key: value
+        for key, value in rendered["template_output"].items()
+        if key not in {"from", "size"}
+    }
+    query["size"] = size
+    if tiebreaker is not None:
+        sort = query.get("sort", [])
+        if not isinstance(sort, list):
+            sort = [sort]
+        query["sort"] = sort + [{tiebreaker: "asc"}]
+        query["track_total_hits"] = False
+    return query
+
+
+def pit_pages(es, *, pit_id, query, keep_alive="10m"):
+    """Page through a point in time search using search_after."""
+    query = {**query}
+    while True:
+        query["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+        with tolog.DisableLogger():
+            res = es.search(body=query)
+        pit_id = res.get("pit_id", pit_id)
+        hits = res["hits"]["hits"]
+        if hits:
+            yield hits
+        if len(hits) < query["size"]:
+            break
+        query["search_after"] = hits[-1]["sort"]
+
+
+def scroll_pages(es, res, *, keep_alive="90m"):
+    """Page through scroll results, clearing the scroll when done."""
     scroll_id = res["_scroll_id"]
-    count = res["hits"]["total"]
-    for hit in res["hits"]["hits"]:
-        yield hit
-    offset = size
-    while offset < count:
+    try:
+        while res["hits"]["hits"]:
+            yield res["hits"]["hits"]
+            with tolog.DisableLogger():
+                res = es.scroll(scroll=keep_alive, scroll_id=scroll_id)
+            scroll_id = res.get("_scroll_id", scroll_id)
+    finally:
         with tolog.DisableLogger():
-            res = es.scroll(
-                rest_total_hits_as_int=True, scroll="90m", scroll_id=scroll_id
-            )
-        for hit in res["hits"]["hits"]:
-            yield hit
-        offset += size
+            es.clear_scroll(scroll_id=scroll_id)
+
+
+def template_pages(
+    es, *, index, body, size=10, engine="pit", keep_alive=None, tiebreaker="_shard_doc"
+):
+    """Page through results of a template search.
+
+    Pages are fetched using a point in time and ``search_after`` where
+    possible, falling back to a scroll.
+    """
+    if engine == "pit":
+        pit_id = open_point_in_time(es, index=index, keep_alive=keep_alive or "10m")
+        if pit_id is not None:
+            query = render_template_query(es, body, size=size, tiebreaker=tiebreaker)
+            try:
+                yield from pit_pages(
+                    es, pit_id=pit_id, query=query, keep_alive=keep_alive or "10m"
+                )
+            finally:
+                with tolog.DisableLogger():
+                    es.close_point_in_time(id=pit_id)
+            return
     with tolog.DisableLogger():
-        es.clear_scroll(scroll_id=scroll_id)
+        res = es.search_template(index=index, body=body, scroll=keep_alive or "90m")
+    yield from scroll_pages(es, res, keep_alive=keep_alive or "90m")
+
+
+def merge_pages(streams, *, queue_size=4):
+    """Merge page streams read concurrently in background threads.
+
+    Each stream is read in its own thread with up to ``queue_size`` pages
+    buffered. Closing the merged generator stops and closes all streams.
+    """
+    pages = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read(stream):
+        try:
+            for page in stream:
+                if not put(("page", page)):
+                    break
+        except Exception as err:
+            put(("error", err))
+        finally:
+            if hasattr(stream, "close"):
+                stream.close()
+            put(("done", None))
+
+    threads = [threading.Thread(target=read, args=(stream,)) for stream in streams]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        running = len(threads)
+        while running:
+            status, page = pages.get()
+            if status == "page":
+                yield page
+            elif status == "error":
+                raise page
+            else:
+                running -= 1
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def prefetch(stream, size=2):
+    """Read ahead up to ``size`` items of a stream in a background thread."""
+    if int(size) < 1:
+        yield from stream
+        return
+    yield from merge_pages([stream], queue_size=int(size))
+
+
+def sliced_pages(
+    es, *, index, body, size=10, slices=2, keep_alive=None, tiebreaker="_shard_doc"
+):
+    """Page through results of a template search in parallel slices."""
+    slices = int(slices)
+    pit_id = open_point_in_time(es, index=index, keep_alive=keep_alive or "10m")
+    if pit_id is not None:
+        query = render_template_query(es, body, size=size, tiebreaker=tiebreaker)
+        streams = [
+            pit_pages(
+                es,
+                pit_id=pit_id,
+                query={**query, "slice": {"id": i, "max": slices}},
+                keep_alive=keep_alive or "10m",
+            )
+            for i in range(slices)
+        ]
+        try:
+            yield from merge_pages(streams, queue_size=2 * slices)
+        finally:
+            with tolog.DisableLogger():
+                es.close_point_in_time(id=pit_id)
+        return
+    query = render_template_query(es, body, size=size)
+
+    def slice_pages(i):
+        with tolog.DisableLogger():
+            res = es.search(
+                index=index,
+                body={**query, "slice": {"id": i, "max": slices}},
+                scroll=keep_alive or "90m",
+            )
+        yield from scroll_pages(es, res, keep_alive=keep_alive or "90m")
+
+    yield from merge_pages(
+        [slice_pages(i) for i in range(slices)], queue_size=2 * slices
+    )
+
+
+def stream_template_search_results(
+    es,
+    *,
+    index,
+    body,
+    size=10,
+    engine="pit",
+    keep_alive=None,
+    tiebreaker="_shard_doc",
+    slices=1,
+    prefetch_pages=0,
+):
+    """Stream results of a template search.
+
+    By default, results are paged with a point in time and ``search_after``,
+    sorted by ``tiebreaker``, falling back to a scroll if a point in time
+    cannot be opened. The point in time or scroll is kept open for
+    ``keep_alive`` between pages and released when the generator is closed.
+
+    With ``slices`` > 1, the index is read in that many parallel slices and
+    results are returned in no particular order.
+
+    With ``prefetch_pages`` > 0, up to that many pages are fetched in a
+    background thread while earlier pages are being processed.
+    """
+    body = {**body, "params": {**body.get("params", {}), "size": size}}
+    if int(slices) > 1:
+        pages = sliced_pages(
+            es,
+            index=index,
+            body=body,
+            size=size,
+            slices=slices,
+            keep_alive=keep_alive,
+            tiebreaker=tiebreaker,
+        )
+    else:
+        pages = template_pages(
+            es,
+            index=index,
+            body=body,
+            size=size,
+            engine=engine,
+            keep_alive=keep_alive,
+            tiebreaker=tiebreaker,
+        )
+        pages = prefetch(pages, prefetch_pages)
+    try:
+        for page in pages:
+            yield from page
+    finally:
+        pages.close()
+
+
+class SearchBatcher:
+    """Coalesce individual lookups into bounded msearch and mget requests.
+
+    Lookups are queued per index and sent once a batch reaches batch_size
+    entries or max_bytes of request body, with up to threads batches in
+    flight. Each lookup returns a future resolving to its own response.
+    """
+
+    def __init__(self, es, *, batch_size=500, max_bytes=1048576, threads=4):
+        """Init SearchBatcher class."""
+        self.es = es
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = defaultdict(list)
+        self.pending_bytes = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        """Return batcher."""
+        return self
+
+    def __exit__(self, *args):
+        """Send remaining lookups and wait for all batches."""
+        self.close()
+
+    def _add(self, key, item, size):
+        """Queue a lookup, sending the batch when it is full."""
+        future = Future()
+        batch = None
+        with self._lock:
+            if self.pending[key] and self.pending_bytes[key] + size > self.max_bytes:
+                batch = self._take(key)
+            self.pending[key].append((item, future))
+            self.pending_bytes[key] += size
+            if batch is None and len(self.pending[key]) >= self.batch_size:
+                batch = self._take(key)
+        if batch is not None:
+            self._submit(key, batch)
+        return future
+
+    def _take(self, key):
+        """Remove and return queued lookups for a key."""
+        batch = self.pending.pop(key)
+        del self.pending_bytes[key]
+        return batch
+
+    def _submit(self, key, batch):
+        """Send a batch in a worker thread."""
+        method, index = key
+        if method == "mget":
+            self.executor.submit(self._send_mget, index, batch)
+        else:
+            self.executor.submit(self._send_msearch, index, batch)
+
+    def _resolve(self, batch, results):
+        """Resolve futures in order, failing any without a result."""
+        results = iter(results)
+        for _, future in batch:
+            result = next(results, None)
+            if result is None:
+                future.set_exception(RuntimeError("No response for batched lookup"))
+            else:
+                future.set_result(result)
+
+    def _send_msearch(self, index, batch):
+        """Send a batch of template searches."""
+        body = "".join("{}\n%s\n" % item for item, _ in batch)
+        try:
+            with tolog.DisableLogger():
+                responses = self.es.msearch_template(body=body, index=index)[
+                    "responses"
+                ]
+        except Exception as err:
+            for _, future in batch:
+                future.set_exception(err)
+            return
+        self._resolve(batch, responses)
+
+    def _send_mget(self, index, batch):
+        """Send a batch of document lookups."""
+        try:
+            with tolog.DisableLogger():
+                docs = self.es.mget(
+                    body={"ids": [item for item, _ in batch]}, index=index
+                )["docs"]
+        except Exception as err:
+            for _, future in batch:
+                future.set_exception(err)
+            return
+        self._resolve(batch, docs)
+
+    def search_template(self, index, template_name, params):
+        """Queue a template search, returning a future for its response."""
+        item = ujson.dumps({"id": template_name, "params": params})
+        return self._add(("msearch", index), item, len(item) + 4)
+
+    def get(self, index, doc_id):
+        """Queue a document lookup, returning a future for the mget doc."""
+        return self._add(("mget", index), doc_id, len(doc_id) + 3)
+
+    def flush(self):
+        """Send all queued lookups."""
+        with self._lock:
+            batches = [(key, self._take(key)) for key in list(self.pending)]
+        for key, batch in batches:
+            self._submit(key, batch)
+
+    def close(self):
+        """Send queued lookups and wait for all batches to complete."""
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+
+SEARCH_BATCHERS = {}
+SEARCH_BATCHERS_LOCK = threading.Lock()
+
+
+def search_batcher(es):
+    """Return the search batcher shared by lookups with a client.
+
+    Lookups queued by concurrent callers are sent in the same batches.
+    Batchers are not shared with forked processes.
+    """
+    key = (os.getpid(), id(es))
+    with SEARCH_BATCHERS_LOCK:
+        entry = SEARCH_BATCHERS.get(key, None)
+        if entry is None or entry[0] is not es:
+            entry = SEARCH_BATCHERS[key] = (es, SearchBatcher(es))
+    return entry[1]
+
+
+def msearch_template_values(es, template_name, params, index):
+    """Run a template search for each set of params in coalesced batches."""
+    batcher = search_batcher(es)
+    futures = [batcher.search_template(index, template_name, p) for p in params]
+    batcher.flush()
+    return {"responses": [future.result() for future in futures]}
 
 
 def query_flexible_template(es, template_name, index, opts=None):
@@ -314,29 +1288,23 @@ def query_keyword_value_template(es, template_name, keyword, values, index, opts
         return None
     if opts is None:
         opts = {"keyword": "keyword", "value": "value"}
-    multisearch = False
-    body = ""
     if isinstance(values, list):
-        multisearch = True
-    else:
-        values = [values]
-    for value in values:
-        if multisearch:
-            body += "{}\n"
-        body += ujson.dumps(
-            {
-                "id": template_name,
-                "params": {opts["keyword"]: keyword, opts["value"]: value},
-            }
+        return msearch_template_values(
+            es,
+            template_name,
+            [{opts["keyword"]: keyword, opts["value"]: value} for value in values],
+            index,
         )
-        body += "\n"
+    body = ujson.dumps(
+        {
+            "id": template_name,
+            "params": {opts["keyword"]: keyword, opts["value"]: values},
+        }
+    )
+    body += "\n"
     res = None
-    if multisearch:
-        with tolog.DisableLogger():
-            res = es.msearch_template(body=body, index=index)
-    else:
-        with tolog.DisableLogger():
-            res = es.search_template(body=body, index=index)
+    with tolog.DisableLogger():
+        res = es.search_template(body=body, index=index)
     return res
 
 
@@ -344,26 +1312,17 @@ def query_value_template(es, template_name, values, index):
     """Run query using a by_value template."""
     if not index_exists(es, index):
         return None
-    multisearch = False
-    body = ""
-    if isinstance(values, list):
-        multisearch = True
-    else:
-        values = [values]
     if not values:
         return None
-    for value in values:
-        if multisearch:
-            body += "{}\n"
-        body += ujson.dumps({"id": template_name, "params": {"value": value}})
-        body += "\n"
+    if isinstance(values, list):
+        return msearch_template_values(
+            es, template_name, [{"value": value} for value in values], index
+        )
+    body = ujson.dumps({"id": template_name, "params": {"value": values}})
+    body += "\n"
     res = None
-    if multisearch:
-        with tolog.DisableLogger():
-            res = es.msearch_template(body=body, index=index)
-    else:
-        with tolog.DisableLogger():
-            res = es.search_template(body=body, index=index)
+    with tolog.DisableLogger():
+        res = es.search_template(body=body, index=index)
     return res
 
 
@@ -379,13 +1338,14 @@ def document_by_id(es, ids, index):
     res = None
     try:
         if multisearch:
-            with tolog.DisableLogger():
-                res = es.mget(body={"ids": ids}, index=index)
-                ret = {}
-                for result in res["docs"]:
-                    if "found" in result and result["found"]:
-                        ret.update({result["_id"]: result["_source"]})
-                res = ret
+            batcher = search_batcher(es)
+            futures = [batcher.get(index, doc_id) for doc_id in ids]
+            batcher.flush()
+            res = {}
+            for future in futures:
+                result = future.result()
+                if "found" in result and result["found"]:
+                    res.update({result["_id"]: result["_source"]})
         else:
             with tolog.DisableLogger():
                 res = es.get(id=ids, index=index)
@@ -20,6 +20,7 @@ from tolkein import tofile
 from tolkein import tolog
 
 from .analysis import index_template as analysis_index_template
+from .es_functions import bulk_options
 from .es_functions import document_by_id
 from .es_functions import index_stream
 from .hub import index_templator
@@ -304,7 +305,7 @@ def index_docs(es, opts, doc_collection, template, *, dry_run=False):
                 _op_type=op_type,
                 dry_run=dry_run,
                 log=opts.get("log-es", True),
-                chunk_size=opts.get("es-batch", 500),
+                **bulk_options(opts),
             )
 
 
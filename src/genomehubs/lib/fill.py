@@ -6,13 +6,20 @@ Fill attribute values.
 Usage:
     genomehubs fill [--hub-name STRING] [--hub-path PATH] [--hub-version PATH]
                     [--config-file PATH...] [--config-save PATH]
-                    [--es-batch INT] [--es-host URL...]  [--taxonomy-source STRING]
+                    [--es-batch INT] [--es-batch-bytes INT] [--es-autotune]
+                    [--es-host URL...] [--es-threads INT] [--es-dead-letter PATH]
+                    [--es-connections INT] [--es-compress] [--es-sniff]
+                    [--es-slices INT] [--es-prefetch INT] [--es-partial-update]
+                    [--taxonomy-source STRING]
                     [--traverse-limit STRING]
                     [--traverse-infer-ancestors] [--traverse-infer-descendants]
                     [--traverse-infer-both] [--traverse-threads INT]
                     [--traverse-depth INT] [--traverse-root STRING]
-                    [--traverse-weight STRING] [--log-interval INT]
-                    [--log-es BOOL]
+                    [--traverse-weight STRING] [--traverse-incremental PATH]
+                    [--traverse-attribute-groups INT]
+                    [--checkpoint PATH] [--checkpoint-interval INT] [--resume]
+                    [--profile-fill PATH] [--bulk-load]
+                    [--log-interval INT] [--log-es BOOL]
                     [-h|--help] [-v|--version]
 
 Options:
@@ -22,9 +29,23 @@ Options:
     --config-file PATH            Path to YAML file containing configuration options.
     --config-save PATH            Path to write configuration options to YAML file.
     --es-batch INT                Batch size for ElasticSearch bulk indexing.
+    --es-batch-bytes INT          Maximum size (bytes) of an ElasticSearch bulk request.
+    --es-autotune                 Flag to tune bulk batch size from request latency.
     --es-host URL                 ElasticSearch hostname/URL and port.
+    --es-connections INT          Number of pooled connections per ElasticSearch node.
+    --es-compress                 Flag to gzip compress ElasticSearch request bodies.
+    --es-sniff                    Flag to discover ElasticSearch nodes from the cluster.
+    --es-threads INT              Number of threads for ElasticSearch bulk indexing.
+    --es-dead-letter PATH         Path to NDJSON file to record documents that failed to
+                                  index.
+    --es-slices INT               Number of parallel slices for whole-index reads.
+    --es-prefetch INT             Number of result pages to read ahead of processing.
+    --es-partial-update           Flag to only send modified attributes when updating
+                                  taxa.
     --taxonomy-source STRING      Name of taxonomy to use (ncbi or ott).
     --traverse-depth INT          Maximum depth for tree traversal relative to root taxon.
+                                  Multi-threaded traversal splits subtrees at this depth
+                                  instead of by subtree size if set.
     --traverse-infer-ancestors    Flag to enable tree traversal from tips to root.
     --traverse-infer-descendants  Flag to enable tree traversal from root to tips.
     --traverse-infer-both         Flag to enable tree traversal from tips to root and
@@ -34,6 +55,19 @@ Options:
     --traverse-threads INT        Number of threads to use for tree traversal. [Default: 1]
     --traverse-weight STRING      Weighting scheme for setting values during tree
                                   traversal.
+    --traverse-incremental PATH   Path to change log written by index to only fill taxa
+                                  affected by changes.
+    --traverse-attribute-groups INT
+                                  Number of groups of attributes to fill in parallel
+                                  processes.
+    --checkpoint PATH             Directory to save traversal progress to resume an
+                                  interrupted fill.
+    --checkpoint-interval INT     Minimum time (seconds) between saving traversal
+                                  progress. [Default: 600]
+    --resume                      Flag to resume traversal from saved progress.
+    --profile-fill PATH           Path to write a JSON (or .tsv) report of time spent
+                                  per attribute, depth and summary function.
+    --bulk-load                   Flag to disable refresh and replicas while filling.
     --log-interval INT            Minimum time (seconds) between prgress bar updates.
     --log-es BOOL                 Show Info-level logs from elasticsearch.
     -h, --help                    Show this
@@ -46,11 +80,16 @@ Examples:
 
 
 import contextlib
+import hashlib
+import os
 import re
 import sys
 from collections import defaultdict
+from datetime import date
 from datetime import datetime
+from functools import partial
 from itertools import groupby
+from itertools import repeat
 from multiprocessing import Pool
 from statistics import mean
 from statistics import median
@@ -59,6 +98,7 @@ from statistics import median_low
 from statistics import mode
 from traceback import format_exc
 
+import ujson
 from docopt import docopt
 from tolkein import tolog
 from tqdm import tqdm
@@ -66,10 +106,28 @@ from tqdm import tqdm
 from ..lib import hub
 from ..lib import taxon
 from .attributes import fetch_types
+from .checkpoint import Checkpoint
+from .checkpoint import remove_checkpoints
 from .config import config
+from .es_functions import bulk_load
+from .es_functions import bulk_options
+from .es_functions import document_by_id
 from .es_functions import index_stream
 from .es_functions import launch_es
+from .es_functions import log_metadata_cache
+from .es_functions import read_change_log
+from .es_functions import refresh_barrier
 from .es_functions import stream_template_search_results
+from .profiling import PROFILE
+from .summary import NUMERIC_TYPES
+from .summary import SKETCH_SUMMARIES
+from .summary import Accumulators
+from .summary import KeywordCodes
+from .summary import ValueSketch
+from .summary import count_bits
+from .summary import numeric_summary
+from .summary import union_bits
+from .tree import load_tree
 from .version import __version__
 
 LOGGER = tolog.logger(__name__)
@@ -100,14 +158,23 @@ def get_max_depth_by_lineage(es, *, index, root):
     return res["aggregations"]["depths"]["root"]["max_depth"]["value"]
 
 
-def stream_nodes_by_root_depth(es, *, index, root, depth, size=10):
+def stream_nodes_by_root_depth(
+    es, *, index, root, depth, size=10, slices=1, prefetch_pages=0
+):
     """Get entries by depth of root taxon."""
     if depth > 0:
         body = {
             "id": "taxon_attributes_by_root_depth",
             "params": {"taxon_id": root, "depth": depth},
         }
-        return stream_template_search_results(es, index=index, body=body, size=size)
+        return stream_template_search_results(
+            es,
+            index=index,
+            body=body,
+            size=size,
+            slices=slices,
+            prefetch_pages=prefetch_pages,
+        )
     body = {
         "id": "taxon_attributes_by_taxon_id",
         "params": {"taxon_id": root},
@@ -115,19 +182,32 @@ def stream_nodes_by_root_depth(es, *, index, root, depth, size=10):
     return stream_template_search_results(es, index=index, body=body)
 
 
-def stream_descendant_nodes_missing_attributes(es, *, index, attributes, root, size=10):
-    """Get entries descended from root that lack one or more attributes."""
-    id_list = set()
-    for attribute in attributes:
+def stream_subtree_nodes(
+    es,
+    *,
+    index,
+    root,
+    max_depth,
+    size=1000,
+    slices=1,
+    prefetch_pages=0,
+    template_id="taxon_attributes_by_root",
+):
+    """Get root and descendant entries down to max_depth below root."""
+    yield from stream_nodes_by_root_depth(es, index=index, root=root, depth=0)
+    if max_depth > 0:
         body = {
-            "id": "taxon_missing_attribute_by_ancestor_id",
-            "params": {"taxon_id": root, "attribute": attribute["key"]},
+            "id": template_id,
+            "params": {"taxon_id": root, "depth": max_depth},
         }
-        for result in stream_template_search_results(
-            es, index=index, body=body, size=size
-        ):
-            if result["_id"] not in id_list:
-                yield result
+        yield from stream_template_search_results(
+            es,
+            index=index,
+            body=body,
+            size=size,
+            slices=slices,
+            prefetch_pages=prefetch_pages,
+        )
 
 
 def enum(tup):
@@ -161,6 +241,22 @@ def ordered_list(tup):
     return values
 
 
+def encoded_ordered_list(codes, tup):
+    """Remove values that are in a higher priority list from a bitset."""
+    (key, order, arr, linked) = tup
+    bits = union_bits(arr)
+    seen = 0
+    for i, k in enumerate(order):
+        if i == 0 and k == key:
+            break
+        if k == key:
+            return bits & ~seen
+        if k in linked:
+            with contextlib.suppress(KeyError):
+                seen |= codes.encode(linked[k]["keyword_value"], add=False)
+    return bits
+
+
 def earliest(arr, *args):
     """Select earliest date from a list."""
     if not isinstance(arr, list):
@@ -181,6 +277,16 @@ def latest(arr, *args):
     return max(arr + list(args))
 
 
+def date_ordinal(value):
+    """Convert a YYYY-MM-DD date string to a day ordinal."""
+    return date(int(value[:4]), int(value[5:7]), int(value[8:10])).toordinal()
+
+
+def date_string(value):
+    """Convert a day ordinal to a YYYY-MM-DD date string."""
+    return date.fromordinal(int(value)).isoformat()
+
+
 def range(arr):
     """Calculate difference between max and min values."""
     return latest(arr) - earliest(arr)
@@ -238,7 +344,7 @@ def flatten_list(arr):
 
 def deduped_list(arr):
     """Remove duplicate values from a list."""
-    return list(set(flatten_list(arr)))
+    return sorted(set(flatten_list(arr)))
 
 
 def deduped_list_length(arr):
@@ -246,6 +352,185 @@ def deduped_list_length(arr):
     return len(deduped_list(arr))
 
 
+def encoded_list_length(arr):
+    """Find number of unique values in a list of bitsets."""
+    return count_bits(union_bits(arr))
+
+
+SUMMARIES = {
+    "count": len,
+    "earliest": earliest,
+    "enum": enum,
+    "latest": latest,
+    "max": latest,
+    "min": earliest,
+    "mean": mean,
+    "median": median,
+    "median_high": median_high,
+    "median_low": median_low,
+    "median_list": median_list,
+    "mode": mode,
+    "most_common": mode,
+    "mode_high": mode_high,
+    "mode_low": mode_low,
+    "mode_mean": mode_mean,
+    "mode_list": mode_list,
+    "range": range,
+    "sum": sum,
+    "sp_count": len,
+    "list": deduped_list,
+    "length": deduped_list_length,
+    "ordered_list": ordered_list,
+}
+
+# summaries of date values that are not themselves dates
+UNDATED_SUMMARIES = {"count", "length", "range", "sp_count"}
+
+# keyword summaries calculated from dictionary-encoded sets of values
+SET_SUMMARIES = {"list", "length", "ordered_list"}
+
+INTEGER_TYPES = {"byte", "short", "integer", "long"}
+
+
+class SummaryPlan:
+    """Summary settings for an attribute, resolved once per run.
+
+    Plans are treated as immutable and shared by every node in a traversal.
+    """
+
+    __slots__ = (
+        "key",
+        "type",
+        "value_type",
+        "date",
+        "numeric",
+        "integer",
+        "summary",
+        "summaries",
+        "summary_types",
+        "functions",
+        "traverse",
+        "traverse_direction",
+        "traverse_limit",
+        "has_traverse_limit",
+        "order",
+        "attr_order",
+        "linked",
+        "codes",
+    )
+
+    def __init__(self, key, meta, codes=None):
+        """Init SummaryPlan class."""
+        self.key = key
+        self.type = meta["type"]
+        self.value_type = f'{meta["type"]}_value'
+        self.date = meta["type"] == "date"
+        # dates are summarised as day ordinals
+        self.numeric = meta["type"] in NUMERIC_TYPES or self.date
+        self.integer = meta["type"] in INTEGER_TYPES
+        self.traverse = meta.get("traverse", False)
+        self.traverse_direction = meta.get("traverse_direction", None)
+        self.has_traverse_limit = "traverse_limit" in meta
+        self.traverse_limit = meta.get("traverse_limit", None)
+        self.order = tuple(meta.get("constraint", {}).get("enum", []))
+        self.attr_order = tuple(meta.get("order", []))
+        self.linked = frozenset(self.attr_order)
+        default_summary = "median"
+        if meta["type"] == "keyword":
+            default_summary = "mode"
+        elif meta["type"] == "date":
+            default_summary = "latest"
+        summary = meta.get("summary", None)
+        if summary is not None and not isinstance(summary, list):
+            summary = [summary]
+        self.summary = None if summary is None else tuple(summary)
+        self.summaries = self.summary
+        self.summary_types = ()
+        self.functions = {}
+        self.codes = None
+        if summary is None:
+            return
+        summaries = list(summary)
+        if self.traverse and summaries[0] != self.traverse:
+            if summaries[0] != "primary":
+                summaries = [self.traverse] + summaries
+            elif len(summaries) > 1 and summaries[1] != "primary":
+                summaries.insert(1, self.traverse)
+        self.summaries = tuple(summaries)
+        # fallback summaries for each position in the summary list
+        self.summary_types = tuple(
+            list(summary[index + 1 :]) + [default_summary]
+            for index, _ in enumerate(summaries)
+        )
+        self.functions = {
+            name: SUMMARIES[name]
+            for name in summaries + summary + [default_summary]
+            if name in SUMMARIES
+        }
+        if meta["type"] == "keyword" and set(summaries) <= SET_SUMMARIES:
+            if codes is None:
+                codes = {}
+            self.codes = codes.setdefault(key, KeywordCodes())
+            self.functions.update(
+                {
+                    "list": union_bits,
+                    "length": encoded_list_length,
+                    "ordered_list": partial(encoded_ordered_list, self.codes),
+                }
+            )
+
+    def local_limit(self, traverse_limit):
+        """Return the rank limit for traversal of this attribute."""
+        if self.has_traverse_limit:
+            return self.traverse_limit
+        return traverse_limit
+
+    def ascends(self):
+        """Test whether values are passed up the tree to ancestors."""
+        return bool(self.traverse) and self.traverse_direction != "down"
+
+    def read_values(self, values):
+        """Convert a list of values read from a node for summarising."""
+        if self.codes is not None:
+            return [self.codes.encode(values)] if values else values
+        if self.date:
+            return [date_ordinal(value) for value in values]
+        return values
+
+    def parse_value(self, value):
+        """Convert a stored value or list of values for summarising."""
+        if self.codes is not None and isinstance(value, list):
+            return self.codes.encode(value)
+        if not self.date or value is None:
+            return value
+        if isinstance(value, list):
+            return [date_ordinal(entry) for entry in value]
+        if isinstance(value, str):
+            return date_ordinal(value)
+        return value
+
+    def format_value(self, summary, value):
+        """Convert a summary value or list of values for storing."""
+        if self.codes is not None and summary in {"list", "ordered_list"}:
+            return self.codes.decode(value)
+        if not self.date or value is None or summary in UNDATED_SUMMARIES:
+            return value
+        if isinstance(value, list):
+            return [date_string(entry) for entry in value]
+        return date_string(value)
+
+
+def compile_plans(meta, codes=None):
+    """Compile summary plans for each attribute.
+
+    Plans for keyword set summaries add a dictionary for each attribute
+    to codes.
+    """
+    if codes is None:
+        codes = {}
+    return {key: SummaryPlan(key, value, codes) for key, value in meta.items()}
+
+
 def apply_summary(
     summary,
     values,
@@ -254,50 +539,29 @@ def apply_summary(
     summary_types=None,
     max_value=None,
     min_value=None,
-    order=None,
-    attr_order=None,
-    meta=None,
+    plan=None,
     linked_attributes=None,
 ):
     """Apply summary statistic functions."""
-    summaries = {
-        "count": len,
-        "earliest": earliest,
-        "enum": enum,
-        "latest": latest,
-        "max": latest,
-        "min": earliest,
-        "mean": mean,
-        "median": median,
-        "median_high": median_high,
-        "median_low": median_low,
-        "median_list": median_list,
-        "mode": mode,
-        "most_common": mode,
-        "mode_high": mode_high,
-        "mode_low": mode_low,
-        "mode_mean": mode_mean,
-        "mode_list": mode_list,
-        "range": range,
-        "sum": sum,
-        "sp_count": len,
-        "list": deduped_list,
-        "length": deduped_list_length,
-        "ordered_list": ordered_list,
-    }
     if summary == "primary":
         if primary_values:
             values = primary_values
         summary = summary_types[0]
+    started = PROFILE.start()
     flattened = flatten_list(values)
-    if summary == "enum":
-        value = summaries[summary]((order, flattened))
-    elif summary == "ordered_list":
-        value = summaries[summary](
-            (meta["key"], attr_order, flattened, linked_attributes)
-        )
-    else:
-        value = summaries[summary](flattened)
+    value = None
+    if plan is not None and plan.numeric:
+        value = numeric_summary(summary, flattened)
+    if value is None:
+        function = plan.functions.get(summary) if plan is not None else None
+        if function is None:
+            function = SUMMARIES[summary]
+        if summary == "enum":
+            value = function((plan.order, flattened))
+        elif summary == "ordered_list":
+            value = function((plan.key, plan.attr_order, flattened, linked_attributes))
+        else:
+            value = function(flattened)
     if summary == "max":
         if max_value is not None:
             value = latest(value, max_value)
@@ -306,6 +570,7 @@ def apply_summary(
         if min_value is not None:
             value = earliest(value, min_value)
         min_value = value
+    PROFILE.record("summary", summary, started, size=len(flattened))
     return value, max_value, min_value
 
 
@@ -317,24 +582,17 @@ def set_traverse_values(
     sp_count,
     max_value,
     min_value,
-    meta,
+    plan,
     attribute,
-    value_type,
-    traverse,
     source,
     linked_attributes,
 ):
     """Set values  use for tree traversal."""
     idx = 0
-    order = meta.get("constraint", {}).get("enum", [])
-    attr_order = meta.get("order", [])
-    default_summary = "median"
-    if meta["type"] == "keyword":
-        default_summary = "mode"
-    elif meta["type"] == "date":
-        default_summary = "latest"
+    value_type = plan.value_type
+    traverse = plan.traverse
     for index, summary in enumerate(summaries):
-        summary_types = meta["summary"][index + 1 :] + [default_summary]
+        summary_types = plan.summary_types[index]
         value, max_value, min_value = apply_summary(
             summary,
             values,
@@ -342,9 +600,7 @@ def set_traverse_values(
             summary_types=summary_types,
             max_value=max_value,
             min_value=min_value,
-            order=order,
-            attr_order=attr_order,
-            meta=meta,
+            plan=plan,
             linked_attributes=linked_attributes,
         )
         if idx == 0:
@@ -355,11 +611,14 @@ def set_traverse_values(
                 ):
                     if summary == "primary" and "values" not in attribute:
                         summary = summary_types[0]
-                    attribute[value_type] = value
+                    attribute[value_type] = plan.format_value(summary, value)
                     attribute["count"] = count or len(values)
                     attribute["sp_count"] = sp_count
                     if summary in ["list", "ordered_list"]:
-                        attribute["length"] = deduped_list_length(values)
+                        if plan.codes is not None:
+                            attribute["length"] = encoded_list_length(values)
+                        else:
+                            attribute["length"] = deduped_list_length(values)
                     attribute["aggregation_method"] = summary
                     attribute["aggregation_source"] = source
                 traverse_value = value or []
@@ -369,13 +628,13 @@ def set_traverse_values(
         elif summary != "list":
             if summary.startswith("median"):
                 summary = "median"
-        else:
+        elif plan.codes is None:
             traverse_value = list(set(traverse_value))
         if summary == "range":
             attribute[summary] = value
             traverse_value = [min_value, max_value]
         elif summary not in attribute and summary in {"mean", "median", "mode", "sum"}:
-            attribute[summary] = value
+            attribute[summary] = plan.format_value(summary, value)
     return traverse_value, max_value, min_value
 
 
@@ -396,7 +655,7 @@ def set_traverse_values(
 
 def summarise_attribute_values(
     attribute,
-    meta,
+    plan,
     *,
     linked_attributes=None,
     values=None,
@@ -409,8 +668,8 @@ def summarise_attribute_values(
     """Calculate a single summary value for an attribute."""
     if values is None and "values" not in attribute:
         return None, None, None
-    if "summary" in meta:
-        value_type = f'{meta["type"]}_value'
+    if plan.summary is not None:
+        value_type = plan.value_type
         primary_values = []
         if "values" in attribute:
             # iterate_values(attribute, meta)
@@ -420,26 +679,26 @@ def summarise_attribute_values(
                     try:
                         values.append(value[value_type])
                     except KeyError:
-                        print(meta)
+                        print(plan.key)
                         print(value)
                     if "is_primary_value" in value and value["is_primary_value"]:
                         primary_values.append(value[value_type])
+                if plan.date or plan.codes is not None:
+                    count = count or len(values)
+                    values = plan.read_values(values)
+                    primary_values = plan.read_values(primary_values)
             else:
                 # TODO: handle existing value here
-                values += [value[value_type] for value in attribute["values"]]
+                values.extend(
+                    plan.read_values(
+                        [value[value_type] for value in attribute["values"]]
+                    )
+                )
         if not values:
             return None, None, None
-        traverse = meta.get("traverse", False)
         traverse_value = None
-        if not isinstance(meta["summary"], list):
-            meta["summary"] = [meta["summary"]]
         try:
-            summaries = meta["summary"][:]
-            if traverse and source != "ancestor" and summaries[0] != traverse:
-                if summaries[0] != "primary":
-                    summaries = [traverse] + summaries
-                elif summaries[1] != "primary":
-                    summaries.insert(1, traverse)
+            summaries = plan.summary if source == "ancestor" else plan.summaries
             traverse_value, max_value, min_value = set_traverse_values(
                 summaries,
                 values,
@@ -448,35 +707,75 @@ def summarise_attribute_values(
                 sp_count,
                 max_value,
                 min_value,
-                meta,
+                plan,
                 attribute,
-                value_type,
-                traverse,
                 source,
                 linked_attributes,
             )
         except Exception:
             print(format_exc())
-            LOGGER.error(
-                f"Unable to generate summary values for attribute {meta['key']}"
-            )
+            LOGGER.error(f"Unable to generate summary values for attribute {plan.key}")
             sys.exit(1)
-        if isinstance(max_value, (float, int)):
+        if plan.date:
+            if max_value and min_value:
+                attribute["from"] = date_string(min_value)
+                attribute["to"] = date_string(max_value)
+        elif isinstance(max_value, (float, int)):
             attribute["max"] = max_value
             attribute["min"] = min_value
-        elif meta["type"] == "date" and max_value and min_value:
-            attribute["from"] = min_value
-            attribute["to"] = max_value
         return traverse_value, max_value, min_value
     return None, None, None
 
 
-def summarise_attributes(*, attributes, rank, attrs, meta, parent, parents):
+def summarise_sketch_values(attribute, plan, sketch, *, count, sp_count, source):
+    """Set approximate summary values for an attribute from a value sketch."""
+    value_type = plan.value_type
+    integer = plan.integer
+    summaries = plan.summary
+    if plan.traverse and summaries[0] != plan.traverse:
+        summaries = (plan.traverse,) + summaries
+    attribute[value_type] = sketch.summarise(summaries[0], integer=integer)
+    attribute["count"] = count
+    attribute["sp_count"] = sp_count
+    attribute["aggregation_method"] = summaries[0]
+    attribute["aggregation_source"] = source
+    attribute["summary_error"] = sketch.error(summaries[0])
+    for summary in summaries[1:]:
+        if summary.startswith("median"):
+            summary = "median"
+        if summary in {"mean", "median", "mode", "range", "sum"}:
+            attribute[summary] = sketch.summarise(summary, integer=integer)
+    attribute["max"] = sketch.max
+    attribute["min"] = sketch.min
+
+
+def add_to_sketch(accumulator, *, values=None, sketch=None):
+    """Add values or a descendant sketch to an accumulator sketch."""
+    if accumulator.get("sketch") is None:
+        accumulator["sketch"] = ValueSketch()
+    if values is not None:
+        accumulator["sketch"].add_values(values)
+    if sketch is not None:
+        accumulator["sketch"].merge(sketch)
+
+
+def linked_attribute_values(plan, by_key):
+    """Find attributes linked to an attribute by order."""
+    if not plan.linked:
+        return {}
+    return {key: by_key[key] for key in plan.linked if key in by_key}
+
+
+def summarise_attributes(*, attributes, rank, plans, parent, parents, approximate=None):
     """Set attribute summary values."""
+    if approximate is None:
+        approximate = set()
     changed = False
     attr_dict = {}
+    by_key = {attribute["key"]: attribute for attribute in attributes}
     for node_attribute in attributes:
-        if node_attribute["key"] in attrs:
+        if node_attribute["key"] in plans:
+            plan = plans[node_attribute["key"]]
             attr_dict[node_attribute["key"]] = node_attribute
             sp_count = 0
             if rank == "species":
@@ -488,29 +787,33 @@ def summarise_attributes(*, attributes, rank, attrs, meta, parent, parents):
                 parents[parent][node_attribute["key"]]["sp_count"] = 1
                 attr_dict[node_attribute["key"]]["sp_count"] = 0
 
-            linked_attributes = {}
-            if "order" in meta[node_attribute["key"]]:
-                for attribute in attributes:
-                    if attribute["key"] in meta[node_attribute["key"]]["order"]:
-                        linked_attributes[attribute["key"]] = attribute
+            started = PROFILE.start()
             summary_value, max_value, min_value = summarise_attribute_values(
                 node_attribute,
-                {"key": node_attribute["key"], **meta[node_attribute["key"]]},
-                linked_attributes=linked_attributes,
+                plan,
+                linked_attributes=linked_attribute_values(plan, by_key),
                 # sp_count=sp_count,
             )
+            PROFILE.record(
+                "attribute",
+                plan.key,
+                started,
+                size=len(node_attribute.get("values", [])),
+            )
             if summary_value is not None:
                 changed = True
                 if parent is not None:
                     parents[parent][node_attribute["key"]]["count"] += 1
-                    if isinstance(summary_value, list):
-                        parents[parent][node_attribute["key"]][
-                            "values"
-                        ] += summary_value
-                    else:
-                        parents[parent][node_attribute["key"]]["values"].append(
-                            summary_value
+                    if node_attribute["key"] in approximate:
+                        add_to_sketch(
+                            parents[parent][node_attribute["key"]],
+                            values=[
+                                value[plan.value_type]
+                                for value in node_attribute["values"]
+                            ],
                         )
+                        continue
+                    parents[parent][node_attribute["key"]].add(summary_value)
                     if max_value is not None:
                         if parents[parent][node_attribute["key"]]["max"] is not None:
                             parents[parent][node_attribute["key"]]["max"] = latest(
@@ -546,7 +849,7 @@ def set_values_from_descendants(
     *,
     attributes,
     descendant_values,
-    meta,
+    plans,
     taxon_id,
     parent,
     taxon_rank,
@@ -555,22 +858,21 @@ def set_values_from_descendants(
     descendant_ranks=None,
     attr_dict=None,
     limits=None,
+    approximate=None,
 ):
     """Set attribute summary values from descendant values."""
     changed = False
     if attr_dict is None:
         attr_dict = {}
+    if approximate is None:
+        approximate = set()
+    # first entry for each key, matching a linear search of the list
+    by_key = {attribute["key"]: attribute for attribute in reversed(attributes)}
     for key, obj in descendant_values.items():
-        traverseable = meta[key].get("traverse", False)
-        if (
-            traverseable
-            and "traverse_direction" in meta[key]
-            and meta[key]["traverse_direction"] == "down"
-        ):
-            traverseable = False
-        if not traverseable or taxon_id in limits[key]:
+        plan = plans[key]
+        if not plan.ascends() or taxon_id in limits[key]:
             continue
-        if local_limit := meta[key].get("traverse_limit", traverse_limit):
+        if local_limit := plan.local_limit(traverse_limit):
             if (
                 descendant_ranks is not None
                 and local_limit in descendant_ranks[taxon_id]
@@ -578,27 +880,45 @@ def set_values_from_descendants(
                 continue
             if taxon_rank == local_limit:
                 limits[key].add(parent)
-        try:
-            attribute = next(entry for entry in attributes if entry["key"] == key)
-        except StopIteration:
-            attribute = {"key": key}
+        attribute = by_key.get(key, None)
+        if attribute is None:
+            attribute = by_key[key] = {"key": key}
             attributes.append(attribute)
-        linked_attributes = {}
-        if "order" in meta[key]:
-            for attribute in attributes:
-                if attribute["key"] in meta[key]["order"]:
-                    linked_attributes[attribute["key"]] = attribute
+        if key in approximate and obj.get("sketch") is not None:
+            sketch = obj["sketch"].copy()
+            if "values" in attribute:
+                sketch.add_values(
+                    [value[plan.value_type] for value in attribute["values"]]
+                )
+            summarise_sketch_values(
+                attribute,
+                plan,
+                sketch,
+                count=obj["count"],
+                sp_count=obj["sp_count"],
+                source=set_aggregation_source(attribute),
+            )
+            set_aggregation_source(attribute, "descendant")
+            changed = True
+            attr_dict.update({key: attribute})
+            if parent is not None:
+                parents[parent][key]["count"] += 1
+                parents[parent][key]["sp_count"] += attribute["sp_count"]
+                add_to_sketch(parents[parent][key], sketch=obj["sketch"])
+            continue
+        started = PROFILE.start()
         summary_value, max_value, min_value = summarise_attribute_values(
             attribute,
-            {"key": key, **meta[key]},
+            plan,
             values=obj["values"],
             count=obj["count"],
             sp_count=obj["sp_count"],
             max_value=obj["max"],
             min_value=obj["min"],
             source=set_aggregation_source(attribute),
-            linked_attributes=linked_attributes,
+            linked_attributes=linked_attribute_values(plan, by_key),
         )
+        PROFILE.record("attribute", key, started, size=len(obj["values"]))
         set_aggregation_source(attribute, "descendant")
 
         if summary_value is not None:
@@ -606,16 +926,12 @@ def set_values_from_descendants(
             attr_dict.update({key: attribute})
             if parent is not None:
                 parents[parent][key]["count"] += 1
-                if "sp_count" not in parents[parent][key]:
-                    parents[parent][key]["sp_count"] = 0
                 if "sp_count" in attribute:
                     parents[parent][key]["sp_count"] += attribute["sp_count"]
                 if isinstance(summary_value, list):
-                    parents[parent][key]["values"] = list(
-                        set(parents[parent][key]["values"] + summary_value)
-                    )
+                    parents[parent][key].add_unique(summary_value)
                 else:
-                    parents[parent][key]["values"].append(summary_value)
+                    parents[parent][key].add(summary_value)
                 if max_value is not None:
                     if parents[parent][key]["max"] is not None:
                         parents[parent][key]["max"] = latest(
@@ -633,6 +949,29 @@ def set_values_from_descendants(
     return changed, attr_dict
 
 
+def set_approximate_attributes(meta):
+    """Set which attributes should be summarised with mergeable sketches."""
+    approximate = set()
+    for key, value in meta.items():
+        if value.get("summary_precision", "exact") != "approximate":
+            continue
+        summaries = value.get("summary", [])
+        if not isinstance(summaries, list):
+            summaries = [summaries]
+        if value.get("traverse", False):
+            summaries = summaries + [value["traverse"]]
+        if value["type"] in NUMERIC_TYPES and all(
+            summary in SKETCH_SUMMARIES for summary in summaries
+        ):
+            approximate.add(key)
+        else:
+            LOGGER.warning(
+                "Approximate summaries are not supported for %s, using exact values",
+                key,
+            )
+    return approximate
+
+
 def set_attributes_to_descend(meta, traverse_limit):
     """Set which attributes should have values inferred from ancestral taxa."""
     desc_attrs = set()
@@ -659,9 +998,12 @@ def set_attributes_to_descend(meta, traverse_limit):
 
 
 def track_missing_attribute_values(
-    node, missing_attributes, attr_dict, desc_attrs, desc_attr_limits
+    node, missing_attributes, attr_dict, desc_attrs, desc_attr_limits, fingerprints=None
 ):
-    """Keep track of missing attribute values for in memory traversal."""
+    """Keep track of missing attribute values for in memory traversal.
+
+    Yields tracked entries for nodes once all missing values are filled.
+    """
     missing_from_descendants = {}
     if (
         node["_source"]["taxon_id"] in missing_attributes
@@ -685,7 +1027,7 @@ def track_missing_attribute_values(
                 missing_from_descendants[child_id] = obj
             else:
                 # yield when all values filled or removed
-                yield obj["node"]["_id"], obj["node"]["_source"]
+                yield obj
         del missing_attributes[node["_source"]["taxon_id"]]
     if "parent" in node["_source"]:
         missing_attributes[node["_source"]["parent"]].update(missing_from_descendants)
@@ -695,6 +1037,7 @@ def track_missing_attribute_values(
                     "keys": set({key for key in desc_attrs if key not in attr_dict}),
                     "attributes": node["_source"]["attributes"],
                     "node": node,
+                    "fingerprints": fingerprints,
                 }
             }
         )
@@ -706,60 +1049,168 @@ def track_descendant_ranks(node, descendant_ranks):
         descendant_ranks[node["_source"]["parent"]].add(node["_source"]["taxon_rank"])
 
 
-def traverse_from_tips(es, opts, *, template, root=None, max_depth=None):
-    """Traverse a tree, filling in values."""
-    if root is None:
-        root = opts["traverse-root"]
-    if max_depth is None:
-        max_depth = get_max_depth_by_lineage(
-            es,
-            index=template["index_name"],
-            root=root,
+def push_stored_summaries(node, *, plans, parents, limits, approximate, traverse_limit):
+    """Add stored summaries of an unchanged node to its parent accumulators.
+
+    Used for nodes outside the changed lineages in an incremental fill, so
+    the parent receives the same values as if the node had been traversed.
+    """
+    parent = node["_source"].get("parent", None)
+    attributes = node["_source"].get("attributes", [])
+    stored = {attribute["key"]: {**attribute} for attribute in attributes}
+    if attributes:
+        summarise_attributes(
+            attributes=attributes,
+            rank=node["_source"]["taxon_rank"],
+            plans=plans,
+            parent=parent,
+            parents=parents,
+            approximate=approximate,
         )
-    root_depth = max_depth
-    meta = template["types"]["attributes"]
-    attrs = set(meta.keys())
-    parents = defaultdict(
-        lambda: defaultdict(
-            lambda: {
-                "max": None,
-                "min": None,
-                "values": [],
-                "prefixed_values": [],
-                "count": 0,
-                "sp_count": 0,
-            }
+    if parent is None:
+        return
+    for key, attribute in stored.items():
+        if key not in plans or not plans[key].ascends():
+            continue
+        source = attribute.get("aggregation_source", [])
+        if "descendant" not in (source if isinstance(source, list) else [source]):
+            continue
+        value_type = plans[key].value_type
+        if value_type not in attribute:
+            continue
+        local_limit = plans[key].local_limit(traverse_limit)
+        if local_limit and node["_source"]["taxon_rank"] == local_limit:
+            limits[key].add(parent)
+        accumulator = parents[parent][key]
+        accumulator["count"] += 1
+        accumulator["sp_count"] += attribute.get("sp_count", 0)
+        value = plans[key].parse_value(attribute[value_type])
+        if key in approximate:
+            add_to_sketch(accumulator, values=[value])
+        elif isinstance(value, list):
+            accumulator.add_unique(value)
+        else:
+            accumulator.add(value)
+        max_value = plans[key].parse_value(
+            attribute.get("max", attribute.get("to", None))
         )
-    )
-    limits = defaultdict(set)
+        min_value = plans[key].parse_value(
+            attribute.get("min", attribute.get("from", None))
+        )
+        if max_value is not None:
+            if accumulator["max"] is not None:
+                max_value = latest(accumulator["max"], max_value)
+            accumulator["max"] = max_value
+        if min_value is not None:
+            if accumulator["min"] is not None:
+                min_value = earliest(accumulator["min"], min_value)
+            accumulator["min"] = min_value
+
+
+class FillState:
+    """Values carried between depths of a traversal from tips to root."""
+
+    def __init__(self, meta):
+        """Init FillState class."""
+        value_types = {key: value["type"] for key, value in meta.items()}
+        self.parents = defaultdict(partial(Accumulators, value_types))
+        self.limits = defaultdict(set)
+        self.descendant_ranks = defaultdict(set)
+        self.missing_attributes = defaultdict(dict)
+        self.codes = {}
+        self.depth = None
+        self.written = 0
+        self.skipped = 0
+        # taxa written with changes to any of the tracked attributes
+        self.tracked = set()
+        self.modified = set()
+
+    def release(self, taxon_id):
+        """Release values held for a taxon once it has been summarised."""
+        self.parents.pop(taxon_id, None)
+        self.descendant_ranks.pop(taxon_id, None)
+        for limited in self.limits.values():
+            limited.discard(taxon_id)
+
+    def log_counts(self, root):
+        """Log numbers of updated and unchanged taxa."""
+        LOGGER.info(
+            "Updated %d taxa below root taxon %s, skipped %d unchanged",
+            self.written,
+            root,
+            self.skipped,
+        )
+
+
+def attribute_fingerprints(attributes):
+    """Hash each attribute in a list to detect changes."""
+    return {
+        attribute["key"]: hashlib.blake2b(
+            ujson.dumps(attribute, sort_keys=True).encode("utf-8"), digest_size=16
+        ).digest()
+        for attribute in attributes
+    }
+
+
+def summarise_levels(tree, opts, *, meta, frozen=None, state=None):
+    """Summarise values from tips to root of a loaded tree, one depth at a time.
+
+    Yields each depth with a list of updates. Depths at or below state.depth
+    have already been summarised and are skipped.
+
+    Nodes in frozen are not recalculated, their stored summaries are passed
+    on to their parents instead.
+    """
+    if frozen is None:
+        frozen = set()
+    if state is None:
+        state = FillState(meta)
+    plans = compile_plans(meta, state.codes)
+    partial = opts.get("es-partial-update", False)
+    parents = state.parents
+    limits = state.limits
+    descendant_ranks = state.descendant_ranks
+    missing_attributes = state.missing_attributes
+    approximate = set_approximate_attributes(meta)
     if "traverse-infer-both" in opts and opts["traverse-infer-both"]:
         desc_attrs, desc_attr_limits = set_attributes_to_descend(
             meta, opts["traverse-limit"]
         )
-        missing_attributes = defaultdict(dict)
-        descendant_ranks = defaultdict(set)
     else:
         desc_attrs = {}
-    while root_depth >= 0:
-        nodes = stream_nodes_by_root_depth(
-            es,
-            index=template["index_name"],
-            root=root,
-            depth=root_depth,
-            size=50,
-        )
-        for ctr, node in enumerate(nodes):
+    for depth, level in groupby(tree.bottom_up(), key=lambda idx: tree.depths[idx]):
+        if state.depth is not None and depth >= state.depth:
+            for idx in level:
+                tree.release(idx)
+            continue
+        started = PROFILE.start()
+        updates = []
+        nodes = 0
+        for idx in level:
+            node = tree.release(idx)
+            nodes += 1
             track_descendant_ranks(node, descendant_ranks)
+            if node["_source"]["taxon_id"] in frozen:
+                push_stored_summaries(
+                    node,
+                    plans=plans,
+                    parents=parents,
+                    limits=limits,
+                    approximate=approximate,
+                    traverse_limit=opts["traverse-limit"],
+                )
+                continue
             changed = False
             attr_dict = {}
+            fingerprints = attribute_fingerprints(node["_source"].get("attributes", []))
             if "attributes" in node["_source"] and node["_source"]["attributes"]:
                 changed, attr_dict = summarise_attributes(
                     attributes=node["_source"]["attributes"],
                     rank=node["_source"]["taxon_rank"],
-                    attrs=attrs,
-                    meta=meta,
+                    plans=plans,
                     parent=node["_source"].get("parent", None),
                     parents=parents,
+                    approximate=approximate,
                 )
             else:
                 node["_source"]["attributes"] = []
@@ -767,7 +1218,7 @@ def traverse_from_tips(es, opts, *, template, root=None, max_depth=None):
                 modified, attr_dict = set_values_from_descendants(
                     attributes=node["_source"]["attributes"],
                     descendant_values=parents[node["_source"]["taxon_id"]],
-                    meta=meta,
+                    plans=plans,
                     taxon_id=node["_source"]["taxon_id"],
                     parent=node["_source"].get("parent", None),
                     parents=parents,
@@ -776,20 +1227,215 @@ def traverse_from_tips(es, opts, *, template, root=None, max_depth=None):
                     traverse_limit=opts["traverse-limit"],
                     attr_dict=attr_dict,
                     limits=limits,
+                    approximate=approximate,
                 )
                 if not changed:
                     changed = modified
             if desc_attrs:
-                yield from track_missing_attribute_values(
-                    node, missing_attributes, attr_dict, desc_attrs, desc_attr_limits
-                )
+                for obj in track_missing_attribute_values(
+                    node,
+                    missing_attributes,
+                    attr_dict,
+                    desc_attrs,
+                    desc_attr_limits,
+                    fingerprints=fingerprints,
+                ):
+                    add_changed_update(
+                        updates, obj["node"], obj["fingerprints"], state, partial
+                    )
+            state.release(node["_source"]["taxon_id"])
             if changed:
-                yield node["_id"], node["_source"]
-        root_depth -= 1
-    if desc_attrs:
-        for incomplete in missing_attributes.values():
-            for obj in incomplete.values():
-                yield obj["node"]["_id"], obj["node"]["_source"]
+                add_changed_update(updates, node, fingerprints, state, partial)
+        state.depth = depth
+        PROFILE.record("depth", depth, started, size=nodes)
+        yield depth, updates
+    if desc_attrs and state.depth != -1:
+        state.depth = -1
+        yield -1, missing_attribute_updates(state, partial)
+
+
+def missing_attribute_updates(state, partial=False):
+    """Make updates for taxa with values still missing after the traversal."""
+    updates = []
+    for incomplete in state.missing_attributes.values():
+        for obj in incomplete.values():
+            add_changed_update(
+                updates, obj["node"], obj["fingerprints"], state, partial
+            )
+    return updates
+
+
+def add_changed_update(updates, node, fingerprints, state, partial=False):
+    """Add a node to a list of updates unless its attributes are unchanged.
+
+    With partial, the update only holds the attributes that have changed.
+    """
+    attributes = node["_source"]["attributes"]
+    changed = attribute_fingerprints(attributes)
+    if changed == fingerprints:
+        state.skipped += 1
+        return
+    state.written += 1
+    if state.tracked and any(
+        changed[key] != fingerprints.get(key, None)
+        for key in state.tracked
+        if key in changed
+    ):
+        state.modified.add(node["_source"]["taxon_id"])
+    if partial:
+        attributes = [
+            attribute
+            for attribute in attributes
+            if changed[attribute["key"]] != fingerprints.get(attribute["key"], None)
+        ]
+        updates.append((node["_id"], {"attributes": attributes}))
+        return
+    updates.append((node["_id"], node["_source"]))
+
+
+def summarise_tree(tree, opts, *, meta, frozen=None, state=None):
+    """Summarise values from tips to root of a loaded tree."""
+    for _depth, updates in summarise_levels(
+        tree, opts, meta=meta, frozen=frozen, state=state
+    ):
+        yield from updates
+
+
+def select_attributes(nodes, keys):
+    """Drop attributes outside a group of keys as nodes are read."""
+    for node in nodes:
+        if "attributes" in node["_source"]:
+            node["_source"]["attributes"] = [
+                attribute
+                for attribute in node["_source"]["attributes"]
+                if attribute["key"] in keys
+            ]
+        yield node
+
+
+def load_subtree(es, opts, *, template, root, max_depth):
+    """Load a root taxon and its descendants down to max_depth into a tree."""
+    nodes = stream_subtree_nodes(
+        es,
+        index=template["index_name"],
+        root=root,
+        max_depth=max_depth,
+        slices=opts.get("es-slices", 1),
+        prefetch_pages=opts.get("es-prefetch", 0),
+    )
+    if "attribute_group" in template:
+        nodes = select_attributes(nodes, template["attribute_group"])
+    started = PROFILE.start()
+    tree = load_tree(nodes)
+    PROFILE.record("es_read", root, started, size=len(tree))
+    return tree
+
+
+def index_updates(es, opts, template, stream):
+    """Write fill updates to the index and wait for them to be searchable.
+
+    Partial updates only send attributes, which are merged into the stored
+    attributes by key. For an attribute group, only attributes in the group
+    are sent.
+    """
+    op_type = "update"
+    if opts.get("es-partial-update", False) or "attribute_group" in template:
+        op_type = "attributes"
+        keys = template.get("attribute_group", None)
+        stream = (
+            (
+                doc_id,
+                {
+                    "attributes": [
+                        attribute
+                        for attribute in source["attributes"]
+                        if keys is None or attribute["key"] in keys
+                    ]
+                },
+            )
+            for doc_id, source in stream
+        )
+    success, failed = index_stream(
+        es,
+        template["index_name"],
+        stream,
+        _op_type=op_type,
+        log=opts.get("log-es", True),
+        **bulk_options(opts),
+    )
+    refresh_barrier(es)
+    return success, failed
+
+
+def traverse_from_tips(es, opts, *, template, root=None, max_depth=None):
+    """Traverse a tree, filling in values."""
+    if root is None:
+        root = opts["traverse-root"]
+    if max_depth is None:
+        max_depth = get_max_depth_by_lineage(
+            es,
+            index=template["index_name"],
+            root=root,
+        )
+        if max_depth is None:
+            max_depth = 0
+    # load the subtree once and visit nodes deepest first
+    tree = load_subtree(es, opts, template=template, root=root, max_depth=max_depth)
+    state = FillState(template["types"]["attributes"])
+    yield from summarise_tree(
+        tree, opts, meta=template["types"]["attributes"], state=state
+    )
+    state.log_counts(root)
+
+
+def checkpoint_path(opts, template, root="*"):
+    """Set path to the checkpoint file for a traversal root."""
+    name = f'fill-{template["index_name"]}-{root}'
+    if "attribute_group" in template:
+        name += f'-{min(template["attribute_group"])}'
+    return os.path.join(opts["checkpoint"], f"{name}.pickle")
+
+
+def fill_from_tips(es, opts, *, template, root, max_depth):
+    """Fill values from tips to root, writing updates after each depth.
+
+    Progress is saved after each depth if a checkpoint directory is set.
+    """
+    meta = template["types"]["attributes"]
+    if max_depth is None:
+        max_depth = get_max_depth_by_lineage(
+            es, index=template["index_name"], root=root
+        )
+        if max_depth is None:
+            max_depth = 0
+    tree = load_subtree(es, opts, template=template, root=root, max_depth=max_depth)
+    checkpoint = None
+    state = None
+    if opts.get("checkpoint", None):
+        checkpoint = Checkpoint(
+            checkpoint_path(opts, template, root),
+            interval=int(opts.get("checkpoint-interval", 600)),
+            index=template["index_name"],
+            root=root,
+            nodes=len(tree),
+            attributes=sorted(meta),
+        )
+        if opts.get("resume", False):
+            state = checkpoint.load()
+    if state is None:
+        state = FillState(meta)
+    else:
+        LOGGER.info("Resuming root taxon %s above depth %d", root, state.depth)
+    for depth, updates in summarise_levels(tree, opts, meta=meta, state=state):
+        started = PROFILE.start()
+        index_updates(es, opts, template, iter(updates))
+        PROFILE.record("es_write", depth, started, size=len(updates))
+        if checkpoint is not None:
+            checkpoint.save(state)
+    if checkpoint is not None:
+        # keep a completed checkpoint so a resumed run can skip this root
+        checkpoint.save(state, force=True)
+    state.log_counts(root)
 
 
 def copy_attribute_summary(source, meta):
@@ -810,82 +1456,93 @@ def copy_attribute_summary(source, meta):
     return dest
 
 
-def stream_missing_attributes_at_level(es, *, nodes, attrs, template, level=1):
-    """Stream all descendant nodes with missing attributes."""
-    for node in nodes:
-        taxon_id = node["_source"]["taxon_id"]
-        fill_attrs = []
-        if "attributes" in node["_source"]:
-            fill_attrs.extend(
-                attribute
-                for attribute in node["_source"]["attributes"]
-                if attribute["key"] in attrs
-            )
-        if not fill_attrs:
-            continue
-        meta = template["types"]["attributes"]
-        desc_nodes = stream_descendant_nodes_missing_attributes(
-            es,
-            index=template["index_name"],
-            attributes=fill_attrs,
-            root=taxon_id,
-            size=50,
-        )
-        anc_attributes = {attr["key"]: attr for attr in fill_attrs}
-        for desc_node in desc_nodes:
-            skip_attrs = set()
-            if "attributes" in desc_node["_source"]:
-                for desc_attribute in desc_node["_source"]["attributes"]:
-                    if desc_attribute["key"] in anc_attributes:
-                        skip_attrs.add(desc_attribute["key"])
+def stream_ancestor_values_to_descendants(
+    tree, *, attrs, meta, max_depth, root_values=None, partial=False
+):
+    """Carry nearest ancestor values down a tree, filling missing attributes.
+
+    Values in root_values are inherited by the root node from outside the tree.
+    With partial, updates only hold the filled attributes.
+    """
+    above = {-1: root_values} if root_values else {}
+    current = {}
+    current_depth = 0
+    for idx in tree.top_down():
+        depth = tree.depths[idx]
+        if depth != current_depth:
+            # only values carried by the level above are needed
+            above, current, current_depth = current, {}, depth
+        node = tree.release(idx)
+        inherited = above.get(tree.parents[idx], {})
+        if "attributes" not in node["_source"]:
+            node["_source"]["attributes"] = []
+        own = {
+            attribute["key"]: attribute
+            for attribute in node["_source"]["attributes"]
+            if attribute["key"] in attrs
+        }
+        filled = []
+        for key, anc_attribute in inherited.items():
+            if key not in own:
+                desc_attribute = copy_attribute_summary(anc_attribute, meta[key])
+                desc_attribute["aggregation_method"] = meta[key]["traverse"]
+                desc_attribute["aggregation_source"] = "ancestor"
+                node["_source"]["attributes"].append(desc_attribute)
+                filled.append(desc_attribute)
+        if filled and partial:
+            yield node["_id"], {"attributes": filled}
+        elif filled:
+            yield node["_id"], node["_source"]
+        if tree.child_nodes(idx):
+            # only ancestors above max_depth pass on their own values, but
+            # inherited values are carried down to all descendants
+            if own and depth < max_depth:
+                current[idx] = {**inherited, **own}
             else:
-                desc_node["_source"]["attributes"] = []
-            for key, anc_attribute in anc_attributes.items():
-                if key not in skip_attrs:
-                    desc_attribute = copy_attribute_summary(anc_attribute, meta[key])
-                    desc_attribute["aggregation_method"] = meta[key]["traverse"]
-                    desc_attribute["aggregation_source"] = "ancestor"
-                    desc_node["_source"]["attributes"].append(desc_attribute)
-            yield desc_node["_id"], desc_node["_source"]
+                current[idx] = inherited
 
 
-def traverse_from_root(es, opts, *, template, root=None, max_depth=None, log=True):
+def set_attributes_to_inherit(meta):
+    """Set which attributes can be inherited from ancestors."""
+    return {
+        key
+        for key, value in meta.items()
+        if value.get("traverse", False)
+        and value.get("traverse_direction", None) != "up"
+    }
+
+
+def traverse_from_root(
+    es, opts, *, template, root=None, max_depth=None, log=True, root_values=None
+):
     """Traverse a tree, filling in values."""
     if root is None:
         root = opts["traverse-root"]
+    tree_depth = get_max_depth_by_lineage(es, index=template["index_name"], root=root)
+    if tree_depth is None:
+        tree_depth = 0
     if max_depth is None:
-        max_depth = get_max_depth_by_lineage(
-            es, index=template["index_name"], root=root
-        )
-    root_depth = max_depth - 1
+        max_depth = tree_depth
     meta = template["types"]["attributes"]
-    attrs = set({})
-    for key, value in meta.items():
-        if (
-            "traverse" in value
-            and value["traverse"]
-            and (
-                "traverse_direction" not in value or value["traverse_direction"] != "up"
-            )
-        ):
-            attrs.add(key)
-    while root_depth >= 0:
-        LOGGER.info("Filling values at root depth %d" % root_depth)
-        nodes = stream_nodes_by_root_depth(
-            es, index=template["index_name"], root=root, depth=root_depth, size=50
-        )
-        desc_nodes = stream_missing_attributes_at_level(
-            es, nodes=nodes, attrs=attrs, template=template
-        )
-        index_stream(
-            es,
-            template["index_name"],
-            desc_nodes,
-            _op_type="update",
-            log=opts.get("log-es", True),
-            chunk_size=opts.get("es-batch", 500),
-        )
-        root_depth -= 1
+    attrs = set_attributes_to_inherit(meta)
+    if log:
+        LOGGER.info("Filling values from ancestors of root taxon %s", root)
+    tree = load_subtree(es, opts, template=template, root=root, max_depth=tree_depth)
+    started = PROFILE.start()
+    index_updates(
+        es,
+        opts,
+        template,
+        stream_ancestor_values_to_descendants(
+            tree,
+            attrs=attrs,
+            meta=meta,
+            max_depth=max_depth,
+            root_values=root_values,
+            partial=opts.get("es-partial-update", False),
+        ),
+    )
+    PROFILE.record("es_write", "descendants", started, size=len(tree))
 
 
 def traverse_tree(es, opts, template, root, max_depth):
@@ -894,11 +1551,18 @@ def traverse_tree(es, opts, template, root, max_depth):
     if es is None:
         log = False
         es = launch_es(opts, log=log)
-    if "traverse-infer-ancestors" in opts:
+    # write each depth separately to record progress or write times per depth
+    if "traverse-infer-ancestors" in opts and (
+        opts.get("checkpoint", None) or opts.get("profile-fill", None)
+    ):
         LOGGER.info("Inferring ancestral values for root taxon %s", root)
-        _success, _failed = index_stream(
+        fill_from_tips(es, opts, template=template, root=root, max_depth=max_depth)
+    elif "traverse-infer-ancestors" in opts:
+        LOGGER.info("Inferring ancestral values for root taxon %s", root)
+        index_updates(
             es,
-            template["index_name"],
+            opts,
+            template,
             traverse_from_tips(
                 es,
                 opts,
@@ -906,9 +1570,6 @@ def traverse_tree(es, opts, template, root, max_depth):
                 root=root,
                 max_depth=max_depth,
             ),
-            _op_type="update",
-            log=opts.get("log-es", True),
-            chunk_size=opts.get("es-batch", 500),
         )
     if "traverse-infer-descendants" in opts:
         if log:
@@ -918,49 +1579,371 @@ def traverse_tree(es, opts, template, root, max_depth):
         )
 
 
+def changed_lineages(es, *, index, root, doc_ids):
+    """Find changed taxa below a root and their ancestors up to the root."""
+    changed = {}
+    affected = set()
+    docs = document_by_id(es, sorted(doc_ids), index) if doc_ids else None
+    for source in (docs or {}).values():
+        taxon_id = source["taxon_id"]
+        lineage = sorted(source.get("lineage", []), key=lambda anc: anc["node_depth"])
+        if taxon_id != root:
+            depth = next(
+                (anc["node_depth"] for anc in lineage if anc["taxon_id"] == root),
+                None,
+            )
+            if depth is None:
+                continue
+            lineage = [anc for anc in lineage if anc["node_depth"] <= depth]
+        else:
+            lineage = []
+        changed[taxon_id] = [anc["taxon_id"] for anc in lineage]
+        affected.add(taxon_id)
+        affected.update(changed[taxon_id])
+    return changed, affected
+
+
+def stream_nodes_and_children(es, *, index, taxon_ids, size=1000, chunk_size=1000):
+    """Get entries for a set of taxa followed by entries for their children."""
+    taxon_ids = sorted(taxon_ids)
+    docs = document_by_id(es, [f"taxon-{taxon_id}" for taxon_id in taxon_ids], index)
+    fields = ("taxon_id", "taxon_rank", "scientific_name", "parent", "attributes")
+    for doc_id, source in (docs or {}).items():
+        yield {
+            "_id": doc_id,
+            "_source": {key: source[key] for key in fields if key in source},
+        }
+    while taxon_ids:
+        chunk, taxon_ids = taxon_ids[:chunk_size], taxon_ids[chunk_size:]
+        yield from stream_template_search_results(
+            es,
+            index=index,
+            body={"id": "taxon_attributes_by_parent", "params": {"taxon_ids": chunk}},
+            size=size,
+        )
+
+
+def inherited_values(es, *, index, lineage, attrs):
+    """Get nearest ancestor values for a taxon from its lineage."""
+    values = {}
+    docs = document_by_id(es, [f"taxon-{taxon_id}" for taxon_id in lineage], index)
+    if not docs:
+        return values
+    for taxon_id in lineage:
+        source = docs.get(f"taxon-{taxon_id}", {})
+        for attribute in source.get("attributes", []):
+            if attribute["key"] in attrs and attribute["key"] not in values:
+                values[attribute["key"]] = attribute
+    return values
+
+
+def summarise_lineages(es, opts, *, template, taxon_ids, tracked=None):
+    """Summarise values for a set of taxa that includes all of their ancestors.
+
+    Children outside the set contribute their stored summaries. Returns the
+    set of taxa with changed values for any attribute in tracked.
+    """
+    if not taxon_ids:
+        return set()
+    index = template["index_name"]
+    tree = load_tree(stream_nodes_and_children(es, index=index, taxon_ids=taxon_ids))
+    state = FillState(template["types"]["attributes"])
+    if tracked:
+        state.tracked = set(tracked)
+    index_updates(
+        es,
+        opts,
+        template,
+        summarise_tree(
+            tree,
+            opts,
+            meta=template["types"]["attributes"],
+            frozen=set(tree.taxon_ids) - set(taxon_ids),
+            state=state,
+        ),
+    )
+    state.log_counts(opts["traverse-root"])
+    return state.modified
+
+
+def incremental_fill(es, opts, template):
+    """Fill values for taxa affected by changes recorded in a change log.
+
+    Only changed taxa and their ancestors up to the root are recalculated,
+    unchanged children contribute their stored summaries. Values are then
+    inherited below changed taxa and any ancestors with changed values.
+    """
+    root = opts["traverse-root"]
+    index = template["index_name"]
+    meta = template["types"]["attributes"]
+    path = opts["traverse-incremental"]
+    working = f"{path}.fill"
+    if os.path.exists(path):
+        # keep entries from any failed run until a fill completes
+        with open(path, "r") as infile, open(working, "a") as outfile:
+            outfile.write(infile.read())
+        os.remove(path)
+    changed, affected = changed_lineages(
+        es, index=index, root=root, doc_ids=read_change_log(working, index)
+    )
+    LOGGER.info(
+        "Filling values for %d changed taxa and %d ancestors",
+        len(changed),
+        len(affected) - len(changed),
+    )
+    attrs = set_attributes_to_inherit(meta)
+    modified = set()
+    if "traverse-infer-ancestors" in opts:
+        modified = summarise_lineages(
+            es, opts, template=template, taxon_ids=affected, tracked=attrs
+        )
+    if "traverse-infer-descendants" in opts:
+        # ancestors with new values pass them on to their unchanged descendants
+        lineages = {}
+        for taxon_id, lineage in changed.items():
+            lineages[taxon_id] = lineage
+            for idx, ancestor in enumerate(lineage):
+                lineages.setdefault(ancestor, lineage[idx + 1 :])
+        roots = set(changed) | (modified & set(lineages))
+        for taxon_id in sorted(roots):
+            lineage = lineages[taxon_id]
+            if any(ancestor in roots for ancestor in lineage):
+                continue
+            traverse_from_root(
+                es,
+                opts,
+                template=template,
+                root=taxon_id,
+                log=False,
+                root_values=inherited_values(
+                    es, index=index, lineage=lineage, attrs=attrs
+                ),
+            )
+    if os.path.exists(working):
+        os.remove(working)
+
+
+def partition_subtrees(es, opts, *, index, root, parts):
+    """Split a tree into groups of subtrees with similar numbers of nodes.
+
+    Returns groups of subtree root taxon ids, largest first, and the set of
+    taxon ids above the subtrees.
+    """
+    max_depth = get_max_depth_by_lineage(es, index=index, root=root)
+    tree = load_tree(
+        stream_subtree_nodes(
+            es,
+            index=index,
+            root=root,
+            max_depth=max_depth or 0,
+            slices=opts.get("es-slices", 1),
+            prefetch_pages=opts.get("es-prefetch", 0),
+            template_id="taxon_parents_by_root",
+        )
+    )
+    sizes = tree.subtree_sizes()
+    target = max(1, sizes[tree.index[root]] // parts)
+    roots, above = tree.partition(target, sizes=sizes)
+    groups = []
+    group = []
+    group_size = 0
+    for idx in roots:
+        # pack small sibling subtrees together to reduce per-task overhead
+        group.append(tree.taxon_ids[idx])
+        group_size += sizes[idx]
+        if group_size >= target:
+            groups.append(group)
+            group = []
+            group_size = 0
+    if group:
+        groups.append(group)
+    return groups, {tree.taxon_ids[idx] for idx in above}
+
+
+def connect_subtrees(es, opts, template, taxon_ids):
+    """Propagate values between filled subtrees through the taxa above them.
+
+    Inherited values are only filled down to the subtree roots, the subtrees
+    are filled from their roots afterwards.
+    """
+    if not taxon_ids:
+        return
+    index = template["index_name"]
+    if "traverse-infer-ancestors" in opts:
+        summarise_lineages(es, opts, template=template, taxon_ids=taxon_ids)
+    if "traverse-infer-descendants" in opts:
+        tree = load_tree(
+            stream_nodes_and_children(es, index=index, taxon_ids=taxon_ids)
+        )
+        index_updates(
+            es,
+            opts,
+            template,
+            stream_ancestor_values_to_descendants(
+                tree,
+                attrs=set_attributes_to_inherit(template["types"]["attributes"]),
+                meta=template["types"]["attributes"],
+                max_depth=len(tree),
+                partial=opts.get("es-partial-update", False),
+            ),
+        )
+
+
 def traverse_helper(params):
-    """Wrap traverse_tree for multithreaded traversal."""
+    """Wrap traverse_tree for multithreaded traversal of a group of subtrees."""
+    es, opts, template, roots, max_depth = params
+    PROFILE.reset(enabled=bool(opts.get("profile-fill", None)))
     with tolog.DisableLogger():
-        traverse_tree(*params)
-    return params[3]
+        for root in roots:
+            traverse_tree(es, opts, template, root, max_depth)
+    return roots, PROFILE.export()
+
+
+def partition_attributes(meta, groups):
+    """Split attribute keys into groups of similar size.
+
+    Attributes linked by an order are kept in the same group.
+    """
+    components = {key: {key} for key in meta}
+    for key, value in meta.items():
+        for linked in value.get("order", []):
+            if linked in components and components[linked] is not components[key]:
+                merged = components[key] | components[linked]
+                for member in merged:
+                    components[member] = merged
+    unique = {id(component): component for component in components.values()}
+    partitions = [set() for _ in repeat(None, groups)]
+    for component in sorted(unique.values(), key=len, reverse=True):
+        min(partitions, key=len).update(component)
+    return [keys for keys in partitions if keys]
+
+
+def attribute_group_helper(params):
+    """Wrap traverse_tree for multiprocess traversal of an attribute group."""
+    opts, template, root, max_depth = params
+    PROFILE.reset(enabled=bool(opts.get("profile-fill", None)))
+    with tolog.DisableLogger():
+        traverse_tree(None, opts, template, root, max_depth)
+    return template["attribute_group"], PROFILE.export()
+
+
+def traverse_attribute_groups(es, opts, template, root, max_depth, groups):
+    """Fill values for groups of attributes in parallel processes."""
+    meta = template["types"]["attributes"]
+    tasks = []
+    for keys in partition_attributes(meta, groups):
+        group_template = {
+            **template,
+            "types": {
+                **template["types"],
+                "attributes": {key: meta[key] for key in keys},
+            },
+            "attribute_group": keys,
+        }
+        tasks.append(
+            ({**opts, "es-partial-update": True}, group_template, root, max_depth)
+        )
+    LOGGER.info("Filling values in %d attribute groups", len(tasks))
+    with Pool(processes=len(tasks)) as p:
+        with tqdm(
+            total=len(tasks),
+            unit=" groups",
+            mininterval=int(opts.get("log-interval", 1)),
+        ) as pbar:
+            for _keys, profile in p.imap_unordered(attribute_group_helper, tasks):
+                PROFILE.merge(profile)
+                pbar.update()
+
+
+def fill_subtrees(opts, tasks, threads):
+    """Fill values in groups of subtrees in parallel processes."""
+    with Pool(processes=threads) as p:
+        with tqdm(
+            total=sum(len(task[3]) for task in tasks),
+            unit=" subtrees",
+            mininterval=int(opts.get("log-interval", 1)),
+        ) as pbar:
+            for roots, profile in p.imap_unordered(traverse_helper, tasks):
+                PROFILE.merge(profile)
+                pbar.update(len(roots))
 
 
 def traverse_handler(es, opts, template):
     """Handle single or multi-threaded tree traversal."""
+    if "traverse-incremental" in opts:
+        incremental_fill(es, opts, template)
+        return
     root = opts["traverse-root"]
     threads = int(opts["traverse-threads"])
     max_depth = get_max_depth_by_lineage(es, index=template["index_name"], root=root)
     subtree_depth = int(opts.get("traverse-depth", 0))
-    if threads > 1 and subtree_depth == 0:
-        subtree_depth = int(max_depth / 2)
+    groups = int(opts.get("traverse-attribute-groups", 1))
+    if groups > 1:
+        if threads > 1:
+            LOGGER.warning("Using attribute groups, ignoring --traverse-threads")
+        traverse_attribute_groups(es, opts, template, root, max_depth, groups)
+        return
     if threads == 1:
         traverse_tree(es, opts, template, root, max_depth)
         return
 
-    max_depth -= subtree_depth
-
-    nodes = stream_nodes_by_root_depth(
-        es, index=template["index_name"], root=root, depth=subtree_depth
+    if subtree_depth > 0:
+        nodes = stream_nodes_by_root_depth(
+            es, index=template["index_name"], root=root, depth=subtree_depth
+        )
+        tasks = [
+            (
+                None,
+                opts,
+                template,
+                [node["_source"]["taxon_id"]],
+                max_depth - subtree_depth,
+            )
+            for node in nodes
+        ]
+        LOGGER.info("Filling values in subtrees")
+        fill_subtrees(opts, tasks, threads)
+        LOGGER.info("Connecting subtrees")
+        traverse_tree(es, opts, template, root, subtree_depth)
+        return
+    # cut the tree into subtrees of similar size so no worker runs long
+    groups, above = partition_subtrees(
+        es, opts, index=template["index_name"], root=root, parts=threads * 4
     )
-    roots = [
-        (None, opts, template, node["_source"]["taxon_id"], max_depth) for node in nodes
-    ]
-    LOGGER.info("Filling values in subtrees")
-    with Pool(processes=threads) as p:
-        with tqdm(
-            total=len(roots),
-            unit=" subtrees",
-            mininterval=int(opts.get("log-interval", 1)),
-        ) as pbar:
-            for _ in p.imap_unordered(traverse_helper, roots):
-                pbar.update()
+    if "traverse-infer-ancestors" in opts:
+        # subtrees only inherit values from above once they are connected
+        up_opts = {
+            key: value
+            for key, value in opts.items()
+            if key != "traverse-infer-descendants"
+        }
+        LOGGER.info("Filling values in subtrees")
+        fill_subtrees(
+            up_opts,
+            [(None, up_opts, template, group, None) for group in groups],
+            threads,
+        )
     LOGGER.info("Connecting subtrees")
-    traverse_tree(es, opts, template, opts["traverse-root"], subtree_depth)
+    connect_subtrees(es, opts, template, above)
+    if "traverse-infer-descendants" in opts:
+        down_opts = {
+            key: value
+            for key, value in opts.items()
+            if key != "traverse-infer-ancestors"
+        }
+        LOGGER.info("Filling inherited values in subtrees")
+        fill_subtrees(
+            down_opts,
+            [(None, down_opts, template, group, None) for group in groups],
+            threads,
+        )
 
 
 def main(args):
     """Initialise genomehubs."""
     options = config("fill", **args)
+    # changes made by fill are not recorded for later incremental fills
+    options["fill"].pop("change-log", None)
     if "traverse-infer-both" in options["fill"]:
         options["fill"]["traverse-infer-ancestors"] = True
 
@@ -971,6 +1954,7 @@ def main(args):
     hub.post_search_scripts(es)
 
     LOGGER.info("Filling values")
+    PROFILE.reset(enabled="profile-fill" in options["fill"])
 
     types = fetch_types(es, "taxon", options["fill"])
 
@@ -980,7 +1964,18 @@ def main(args):
         if types:
             template["types"]["attributes"] = types
         if "traverse-root" in options["fill"]:
-            traverse_handler(es, options["fill"], template)
+            with bulk_load(
+                es,
+                [template["index_name"]],
+                enabled=options["fill"].get("bulk-load", False),
+            ):
+                traverse_handler(es, options["fill"], template)
+            if options["fill"].get("checkpoint", None):
+                remove_checkpoints(checkpoint_path(options["fill"], template))
+            if "profile-fill" in options["fill"]:
+                PROFILE.write(options["fill"]["profile-fill"])
+                PROFILE.log_top()
+    log_metadata_cache()
 
 
 def cli():
@@ -6,7 +6,11 @@ Index a file, directory or repository.
 Usage:
     genomehubs index [--hub-name STRING] [--hub-path PATH] [--hub-version PATH]
                      [--config-file PATH...] [--config-save PATH]
-                     [--es-batch INT] [--es-host URL...] [--assembly-dir PATH]
+                     [--es-batch INT] [--es-batch-bytes INT] [--es-autotune]
+                     [--es-host URL...] [--es-threads INT] [--es-dead-letter PATH]
+                     [--es-connections INT] [--es-compress] [--es-sniff]
+                     [--es-slices INT] [--es-prefetch INT] [--es-partial-update]
+                     [--assembly-dir PATH]
                      [--feature-dir PATH] [--sample-dir PATH]
                      [--taxon-dir PATH] [--taxon-repo URL] [--taxon-exception PATH]
                      [--taxon-lookup STRING] [--taxon-lookup-root STRING]
@@ -18,7 +22,8 @@ Usage:
                      [--taxon-id STRING] [--assembly-id STRING]
                      [--sample-id STRING] [--analysis-id STRING]
                      [--file-title STRING] [--file-description STRING] [--file-metadata PATH]
-                     [--dry-run] [--log-interval INT] [--log-es BOOL]
+                     [--dry-run] [--replay-failed] [--bulk-load] [--change-log PATH]
+                     [--log-interval INT] [--log-es BOOL]
                      [-h|--help] [-v|--version]
 
 Options:
@@ -28,7 +33,18 @@ Options:
     --config-file PATH         Path to YAML file containing configuration options.
     --config-save PATH         Path to write configuration options to YAML file.
     --es-batch INT             Batch size for ElasticSearch bulk indexing.
+    --es-batch-bytes INT       Maximum size (bytes) of an ElasticSearch bulk request.
+    --es-autotune              Flag to tune bulk batch size from request latency.
     --es-host URL              ElasticSearch hostname/URL and port.
+    --es-connections INT       Number of pooled connections per ElasticSearch node.
+    --es-compress              Flag to gzip compress ElasticSearch request bodies.
+    --es-sniff                 Flag to discover ElasticSearch nodes from the cluster.
+    --es-threads INT           Number of threads for ElasticSearch bulk indexing.
+    --es-dead-letter PATH      Path to NDJSON file to record documents that failed to index.
+    --es-slices INT            Number of parallel slices for whole-index reads.
+    --es-prefetch INT          Number of result pages to read ahead of processing.
+    --es-partial-update        Flag to only send modified names and attributes when
+                               updating taxa.
     --assembly-dir PATH        Path to directory containing assembly-level data.
     --sample-dir PATH          Path to directory containing sample-level data.
     --feature-dir PATH         Path to directory containing feature-level data.
@@ -56,6 +72,11 @@ Options:
     --file-description STRING  Default description for all indexed files.
     --file-metadata PATH       CSV, TSV, YAML or JSON file metadata with one entry per file to be indexed.
     --dry-run                  Flag to run without loading data into the elasticsearch index.
+    --replay-failed            Flag to only resubmit documents recorded in the dead-letter
+                               file, without indexing any other data.
+    --bulk-load                Flag to disable refresh and replicas while indexing.
+    --change-log PATH          Path to NDJSON file to record IDs of modified documents for
+                               incremental fill.
     --log-interval INT         Minimum time (seconds) between prgress bar updates
     --log-es BOOL              Show Info-level logs from elasticsearch
     -h, --help                 Show this
@@ -86,7 +107,9 @@ from ..lib import taxon
 from . import sample
 from .attributes import index_types
 from .config import config
+from .es_functions import bulk_options
 from .es_functions import index_stream
+from .es_functions import prefetch
 from .files import index_files
 from .files import index_metadata
 from .hub import list_files
@@ -113,6 +136,13 @@ def not_blank(key, obj, blanks):
     return key in obj and obj[key] and obj[key] not in blanks
 
 
+def taxon_update_op_type(opts):
+    """Set bulk operation type for taxon updates."""
+    if opts.get("es-partial-update", False):
+        return "attributes"
+    return "update"
+
+
 def summarise_imported_taxa(docs, imported_taxa):
     """Summarise taxon imformation from a stram of taxon docs."""
     for entry_id, entry in docs:
@@ -172,17 +202,24 @@ def index_taxon_records(es, taxonomy_name, opts, with_ids, blanks, types):
     """Index a taxon records."""
     taxon_template = taxon.index_template(taxonomy_name, opts)
     docs = add_names_and_attributes_to_taxa(
-        es, dict(with_ids), opts, template=taxon_template, blanks=blanks
+        es,
+        dict(with_ids),
+        opts,
+        template=taxon_template,
+        blanks=blanks,
+        partial=opts.get("es-partial-update", False),
     )
+    # taxa are looked up in chunks of 500 so read ahead by whole chunks
+    docs = prefetch(docs, int(opts.get("es-prefetch", 0)) * 500)
     imported_taxa = defaultdict(list)
     index_stream(
         es,
         taxon_template["index_name"],
         summarise_imported_taxa(docs, imported_taxa),
-        _op_type="update",
+        _op_type=taxon_update_op_type(opts),
         dry_run=opts.get("dry-run", False),
         log=opts.get("log-es", True),
-        chunk_size=opts.get("es-batch", 500),
+        **bulk_options(opts),
     )
     write_imported_taxa(imported_taxa, opts, types=types)
 
@@ -215,7 +252,7 @@ def index_sample_records(
         docs,
         dry_run=opts.get("dry-run", False),
         log=opts.get("log-es", True),
-        chunk_size=opts.get("es-batch", 500),
+        **bulk_options(opts),
     )
     # index taxon-level attributes
     index_types(
@@ -235,15 +272,18 @@ def index_sample_records(
         opts,
         template=taxon_template,
         blanks=blanks,
+        partial=opts.get("es-partial-update", False),
     )
+    # taxa are looked up in chunks of 500 so read ahead by whole chunks
+    taxon_docs = prefetch(taxon_docs, int(opts.get("es-prefetch", 0)) * 500)
     index_stream(
         es,
         taxon_template["index_name"],
         taxon_docs,
-        _op_type="update",
+        _op_type=taxon_update_op_type(opts),
         dry_run=opts.get("dry-run", False),
         log=opts.get("log-es", True),
-        chunk_size=opts.get("es-batch", 500),
+        **bulk_options(opts),
     )
 
 
@@ -367,7 +407,7 @@ def index_feature_records(es, opts, taxonomy_name, with_ids, blanks):
         docs,
         dry_run=opts.get("dry-run", False),
         log=opts.get("log-es", True),
-        chunk_size=opts.get("es-batch", 500),
+        **bulk_options(opts),
     )
 
 
@@ -486,6 +526,7 @@ def index_taxon_sample(es, opts, index="taxon", *, dry_run=False, taxonomy_name)
                     },
                     taxon_table=taxon_table,
                 )
+                es_functions.refresh_barrier(es)
                 if "tests" in types["file"]:
                     result = test_json_dir(
                         f'{dir_path}/{types["file"]["tests"]}',
@@ -517,6 +558,7 @@ def index_taxon_sample(es, opts, index="taxon", *, dry_run=False, taxonomy_name)
                     taxon_table=taxon_table,
                     exclusions=exclusions,
                 )
+                es_functions.refresh_barrier(es)
                 if "tests" in types["file"]:
                     result = test_json_dir(
                         f'{dir_path}/{types["file"]["tests"]}',
@@ -580,10 +622,21 @@ def index_features(es, opts, *, dry_run=False):
                 {**opts, "index": index, "index_types": index_types},
                 shared_values=shared_values,
             )
+            es_functions.refresh_barrier(es)
         elif "attributes" in types:
             stored_attributes = {**stored_attributes, **types["attributes"]}
 
 
+def bulk_load_indices(taxonomy_name, opts):
+    """List indices to manage in bulk-load mode."""
+    return [
+        taxon.index_template(taxonomy_name, opts)["index_name"],
+        sample.index_template(taxonomy_name, opts, index_type="assembly")["index_name"],
+        sample.index_template(taxonomy_name, opts, index_type="sample")["index_name"],
+        feature.index_template(taxonomy_name, opts)["index_name"],
+    ]
+
+
 def main(args):
     """Index files."""
     options = config("index", **args)
@@ -597,28 +650,44 @@ def main(args):
 
     taxonomy_name = options["index"]["taxonomy-source"].lower()
     dry_run = options["index"].get("dry-run", False)
-    for index in ["taxon", "sample", "assembly"]:
-        index_taxon_sample(
+    if options["index"].get("replay-failed", False):
+        bulk_kwargs = bulk_options(options["index"])
+        es_functions.replay_dead_letters(
             es,
-            options["index"],
-            index=index,
+            bulk_kwargs.pop("dead_letter"),
             dry_run=dry_run,
-            taxonomy_name=taxonomy_name,
+            log=options["index"].get("log-es", True),
+            **bulk_kwargs,
         )
+        return
+    with es_functions.bulk_load(
+        es,
+        bulk_load_indices(taxonomy_name, options["index"]),
+        enabled=options["index"].get("bulk-load", False) and not dry_run,
+    ):
+        for index in ["taxon", "sample", "assembly"]:
+            index_taxon_sample(
+                es,
+                options["index"],
+                index=index,
+                dry_run=dry_run,
+                taxonomy_name=taxonomy_name,
+            )
 
-    if "feature-dir" in options["index"]:
-        index_features(es, options["index"], dry_run=dry_run)
+        if "feature-dir" in options["index"]:
+            index_features(es, options["index"], dry_run=dry_run)
 
-    if "file" in options["index"]:
-        index_files(es, options["index"]["file"], taxonomy_name, options["index"])
-    elif "file-metadata" in options["index"]:
-        index_metadata(
-            es,
-            options["index"]["file-metadata"],
-            taxonomy_name,
-            options["index"],
-            dry_run=dry_run,
-        )
+        if "file" in options["index"]:
+            index_files(es, options["index"]["file"], taxonomy_name, options["index"])
+        elif "file-metadata" in options["index"]:
+            index_metadata(
+                es,
+                options["index"]["file-metadata"],
+                taxonomy_name,
+                options["index"],
+                dry_run=dry_run,
+            )
+    es_functions.log_metadata_cache()
 
 
 def cli():
@@ -6,7 +6,11 @@ Initialise a GenomeHubs instance.
 Usage:
     genomehubs init [--hub-name STRING] [--hub-path PATH] [--hub-version PATH]
                     [--config-file PATH...] [--config-save PATH]
-                    [--es-batch INT] [--es-host URL...] [--es-url URL]
+                    [--es-batch INT] [--es-batch-bytes INT] [--es-autotune]
+                    [--es-host URL...] [--es-threads INT] [--es-dead-letter PATH]
+                    [--es-connections INT] [--es-compress] [--es-sniff]
+                    [--es-slices INT]
+                    [--es-url URL]
                     [--insdc-metadata] [--insdc-root INT...] [--restore-indices]
                     [--taxonomy-path PATH] [--taxonomy-source STRING]
                     [--taxonomy-ncbi-root INT] [--taxonomy-ncbi-url URL]
@@ -27,7 +31,16 @@ Options:
     --config-file PATH            Path to YAML file containing configuration options.
     --config-save PATH            Path to write configuration options to YAML file.
     --es-batch INT                Batch size for ElasticSearch bulk indexing.
+    --es-batch-bytes INT          Maximum size (bytes) of an ElasticSearch bulk request.
+    --es-autotune                 Flag to tune bulk batch size from request latency.
     --es-host URL                 ElasticSearch hostname/URL and port.
+    --es-connections INT          Number of pooled connections per ElasticSearch node.
+    --es-compress                 Flag to gzip compress ElasticSearch request bodies.
+    --es-sniff                    Flag to discover ElasticSearch nodes from the cluster.
+    --es-threads INT              Number of threads for ElasticSearch bulk indexing.
+    --es-dead-letter PATH         Path to NDJSON file to record documents that failed to
+                                  index.
+    --es-slices INT               Number of parallel slices for whole-index reads.
     --es-url URL                  Remote URL to fetch ElasticSearch code.
     --insdc-metadata              Flag to index metadata for public INSDC assemblies.
     --insdc-root INT              Root taxid when indexing public INSDC assemblies.
@@ -215,7 +228,7 @@ def main(args):
                     template["index_name"],
                     stream,
                     log=options["init"].get("log-es", True),
-                    chunk_size=options["init"].get("es-batch", 500),
+                    **es_functions.bulk_options(options["init"]),
                 )
 
         # Prepare taxon index
@@ -228,7 +241,7 @@ def main(args):
                 "source": {"index": template["index_name"]},
                 "dest": {"index": taxon_template["index_name"]},
             }
-            es.reindex(body=body)
+            es.reindex(body=body, slices=options["init"].get("es-slices", 1))
 
         # Prepare assembly index
         assembly_template = sample.index_template(
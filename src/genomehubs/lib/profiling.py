@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""Timing profiles for long-running tasks."""
+
+import json
+from collections import defaultdict
+from time import perf_counter
+
+from tolkein import tolog
+
+LOGGER = tolog.logger(__name__)
+
+
+class Profile:
+    """Call counts, wall time and value counts grouped by section and name.
+
+    Timers are only started when the profile is enabled so instrumented
+    code has negligible overhead otherwise.
+    """
+
+    def __init__(self):
+        """Init Profile class."""
+        self.enabled = False
+        self.stats = defaultdict(dict)
+
+    def reset(self, enabled=False):
+        """Clear recorded stats."""
+        self.enabled = enabled
+        self.stats = defaultdict(dict)
+
+    def start(self):
+        """Start a timer, returning None if the profile is disabled."""
+        if not self.enabled:
+            return None
+        return perf_counter()
+
+    def record(self, section, name, started, size=0):
+        """Record a call started at a time returned by start."""
+        if started is None:
+            return
+        self.add(section, name, 1, perf_counter() - started, size, size)
+
+    def add(self, section, name, calls, seconds, size, max_size):
+        """Add totals for a section and name."""
+        entry = self.stats[section].get(name, None)
+        if entry is None:
+            self.stats[section][name] = [calls, seconds, size, max_size]
+            return
+        entry[0] += calls
+        entry[1] += seconds
+        entry[2] += size
+        entry[3] = max(entry[3], max_size)
+
+    def export(self):
+        """Export stats as a list of rows."""
+        return [
+            [section, str(name), *entry]
+            for section, entries in self.stats.items()
+            for name, entry in entries.items()
+        ]
+
+    def merge(self, rows):
+        """Merge rows exported from another profile."""
+        for section, name, calls, seconds, size, max_size in rows:
+            self.add(section, name, calls, seconds, size, max_size)
+
+    def top(self, n=10):
+        """Return the n rows with the most wall time."""
+        return sorted(self.export(), key=lambda row: row[3], reverse=True)[:n]
+
+    def write(self, path):
+        """Write stats to a TSV file or, for other extensions, a JSON file."""
+        header = ["section", "name", "calls", "seconds", "values", "max_values"]
+        rows = sorted(self.export(), key=lambda row: (row[0], -row[3]))
+        with open(path, "w") as fh:
+            if path.endswith(".tsv"):
+                fh.write("\t".join(header) + "\n")
+                for row in rows:
+                    fh.write("\t".join(str(value) for value in row) + "\n")
+            else:
+                json.dump([dict(zip(header, row)) for row in rows], fh, indent=2)
+
+    def log_top(self, n=10):
+        """Log the n rows with the most wall time."""
+        LOGGER.info("Top %d profile entries by wall time:", n)
+        for section, name, calls, seconds, size, max_size in self.top(n):
+            LOGGER.info(
+                "%10.3fs %10d calls %12d values (max %d) %s %s",
+                seconds,
+                calls,
+                size,
+                max_size,
+                section,
+                name,
+            )
+
+
+PROFILE = Profile()
@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+
+"""Vectorised summary functions for numeric attribute values."""
+
+from array import array
+from statistics import mean
+from statistics import median_high
+from statistics import median_low
+
+import numpy as np
+
+NUMERIC_TYPES = {"byte", "short", "integer", "long", "half_float", "float", "double"}
+
+
+def numeric_array(values):
+    """Convert a flat list of values to a numeric array if possible."""
+    try:
+        arr = np.asarray(values)
+    except ValueError:
+        return None
+    if arr.ndim != 1 or arr.size == 0 or arr.dtype.kind not in "iuf":
+        return None
+    return arr
+
+
+def nth_value(arr, idx):
+    """Return the value at idx in the sorted array."""
+    return np.partition(arr, idx)[idx].item()
+
+
+def np_count(arr):
+    """Count values."""
+    return int(arr.size)
+
+
+def np_max(arr):
+    """Find maximum value."""
+    return arr.max().item()
+
+
+def np_min(arr):
+    """Find minimum value."""
+    return arr.min().item()
+
+
+def np_range(arr):
+    """Calculate difference between max and min values."""
+    return (arr.max() - arr.min()).item()
+
+
+def np_sum(arr):
+    """Sum values."""
+    if arr.dtype.kind in "iu":
+        return int(arr.sum(dtype=np.int64))
+    return arr.sum().item()
+
+
+def np_mean(arr):
+    """Calculate mean, matching statistics.mean for integer values."""
+    if arr.dtype.kind in "iu":
+        total = int(arr.sum(dtype=np.int64))
+        if total % arr.size == 0:
+            return total // arr.size
+        return total / arr.size
+    return arr.mean().item()
+
+
+def np_median(arr):
+    """Calculate median, averaging the middle values of an even length array."""
+    length = arr.size
+    half = length // 2
+    if length % 2 == 1:
+        return nth_value(arr, half)
+    parted = np.partition(arr, [half - 1, half])
+    return (parted[half - 1].item() + parted[half].item()) / 2
+
+
+def np_median_high(arr):
+    """Calculate median, taking the higher value to resolve ties."""
+    return nth_value(arr, arr.size // 2)
+
+
+def np_median_low(arr):
+    """Calculate median, taking the lower value to resolve ties."""
+    return nth_value(arr, (arr.size - 1) // 2)
+
+
+def np_median_list(arr):
+    """Return both values in event of tied median."""
+    length = arr.size
+    half = length // 2
+    if length % 2 == 1:
+        return [nth_value(arr, half)]
+    parted = np.partition(arr, [half - 1, half])
+    return list({parted[half].item(), parted[half - 1].item()})
+
+
+def np_mode(arr):
+    """Find most common value, taking the first seen to resolve ties."""
+    _values, first, counts = np.unique(arr, return_index=True, return_counts=True)
+    modal = counts == counts.max()
+    return arr[first[modal].min()].item()
+
+
+def np_mode_list(arr):
+    """Return values with the longest run of consecutive repeats."""
+    starts = np.flatnonzero(np.concatenate(([True], arr[1:] != arr[:-1])))
+    lengths = np.diff(np.append(starts, arr.size))
+    return arr[starts[lengths == lengths.max()]].tolist()
+
+
+def np_mode_high(arr):
+    """Calculate mode using median_high to resolve ties."""
+    return median_high(np_mode_list(arr))
+
+
+def np_mode_low(arr):
+    """Calculate mode using median_low to resolve ties."""
+    return median_low(np_mode_list(arr))
+
+
+def np_mode_mean(arr):
+    """Calculate mode using mean to resolve ties."""
+    return mean(np_mode_list(arr))
+
+
+NUMERIC_SUMMARIES = {
+    "count": np_count,
+    "earliest": np_min,
+    "latest": np_max,
+    "max": np_max,
+    "min": np_min,
+    "mean": np_mean,
+    "median": np_median,
+    "median_high": np_median_high,
+    "median_low": np_median_low,
+    "median_list": np_median_list,
+    "mode": np_mode,
+    "most_common": np_mode,
+    "mode_high": np_mode_high,
+    "mode_low": np_mode_low,
+    "mode_mean": np_mode_mean,
+    "mode_list": np_mode_list,
+    "range": np_range,
+    "sum": np_sum,
+    "sp_count": np_count,
+}
+
+
+def numeric_summary(summary, values):
+    """Apply a vectorised summary, returning None if values are not numeric."""
+    if summary not in NUMERIC_SUMMARIES:
+        return None
+    arr = numeric_array(values)
+    if arr is None:
+        return None
+    return NUMERIC_SUMMARIES[summary](arr)
+
+
+SKETCH_SUMMARIES = {
+    "count",
+    "max",
+    "min",
+    "mean",
+    "median",
+    "median_high",
+    "median_low",
+    "mode",
+    "most_common",
+    "mode_high",
+    "mode_low",
+    "mode_mean",
+    "range",
+    "sum",
+}
+
+QUANTILE_SUMMARIES = {"median", "median_high", "median_low"}
+
+MODE_SUMMARIES = {"mode", "most_common", "mode_high", "mode_low", "mode_mean"}
+
+
+class ValueSketch:
+    """Mergeable summary of numeric values with bounded size.
+
+    Quantiles are estimated from logarithmic buckets (DDSketch) with a
+    relative error of at most relative_accuracy. Modal values are tracked
+    in a Misra-Gries count map of at most capacity entries, so counts are
+    low by at most count_error. Count, sum, min and max are exact.
+    """
+
+    def __init__(self, relative_accuracy=0.01, capacity=1024):
+        """Init ValueSketch class."""
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.capacity = capacity
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.counts = {}
+        self.count_error = 0
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def copy(self):
+        """Return an independent copy of the sketch."""
+        sketch = ValueSketch(self.relative_accuracy, self.capacity)
+        sketch.merge(self)
+        return sketch
+
+    def _bucket(self, store, keys):
+        """Add bucket counts for an array of bucket keys."""
+        keys, counts = np.unique(keys, return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            store[key] = store.get(key, 0) + count
+
+    def add_values(self, values):
+        """Add a list of numeric values."""
+        arr = numeric_array(flatten(values))
+        if arr is None:
+            return
+        self.count += int(arr.size)
+        self.sum += np_sum(arr)
+        low, high = np_min(arr), np_max(arr)
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+        self.zeros += int(np.count_nonzero(arr == 0))
+        for store, part in (
+            (self.positive, arr[arr > 0]),
+            (self.negative, -arr[arr < 0]),
+        ):
+            if part.size:
+                self._bucket(store, np.ceil(np.log(part) / self.log_gamma).astype(int))
+        for value in arr.tolist():
+            self.counts[value] = self.counts.get(value, 0) + 1
+        self._compact()
+
+    def merge(self, other):
+        """Merge another sketch into this one."""
+        if other.count == 0:
+            return
+        self.count += other.count
+        self.sum += other.sum
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.zeros += other.zeros
+        for store, other_store in (
+            (self.positive, other.positive),
+            (self.negative, other.negative),
+        ):
+            for key, count in other_store.items():
+                store[key] = store.get(key, 0) + count
+        for value, count in other.counts.items():
+            self.counts[value] = self.counts.get(value, 0) + count
+        self.count_error += other.count_error
+        self._compact()
+
+    def _compact(self):
+        """Reduce the count map to capacity entries."""
+        if len(self.counts) <= self.capacity:
+            return
+        cutoff = sorted(self.counts.values(), reverse=True)[self.capacity]
+        self.counts = {
+            value: count - cutoff
+            for value, count in self.counts.items()
+            if count > cutoff
+        }
+        self.count_error += cutoff
+
+    def _value(self, key):
+        """Return the representative value of a bucket."""
+        return 2 * self.gamma**key / (self.gamma + 1)
+
+    def quantile(self, q):
+        """Estimate the value at quantile q."""
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self._value(key)
+        seen += self.zeros
+        if seen > rank:
+            return 0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self._value(key)
+        return self.max
+
+    def modes(self):
+        """Return values with the highest count."""
+        top = max(self.counts.values())
+        return [value for value, count in self.counts.items() if count == top]
+
+    def summarise(self, summary, integer=False):
+        """Calculate a summary value from the sketch."""
+        if summary in QUANTILE_SUMMARIES:
+            value = min(max(self.quantile(0.5), self.min), self.max)
+            return int(round(value)) if integer else value
+        if summary in MODE_SUMMARIES:
+            modes = self.modes()
+            if summary == "mode_high":
+                return median_high(modes)
+            if summary == "mode_low":
+                return median_low(modes)
+            if summary == "mode_mean":
+                return mean(modes)
+            return modes[0]
+        if summary == "mean":
+            return self.sum / self.count
+        if summary == "range":
+            return self.max - self.min
+        return {
+            "count": self.count,
+            "max": self.max,
+            "min": self.min,
+            "sum": self.sum,
+        }[summary]
+
+    def error(self, summary):
+        """Return the error bound for a summary.
+
+        Quantile summaries report the relative error of the value, modal
+        summaries report the maximum undercount as a fraction of values.
+        """
+        if summary in QUANTILE_SUMMARIES:
+            return self.relative_accuracy
+        if summary in MODE_SUMMARIES and self.count:
+            return self.count_error / self.count
+        return 0
+
+
+def flatten(values):
+    """Flatten a list by expanding any nested lists."""
+    flattened = []
+    for value in values:
+        if isinstance(value, list):
+            flattened += value
+        else:
+            flattened.append(value)
+    return flattened
+
+
+FLOAT_TYPES = {"half_float", "float", "double"}
+
+
+class Accumulator:
+    """Descendant values collected for one attribute of one taxon.
+
+    Values for float attributes are held in a typed array, other types use
+    a list. Supports item access so it can stand in for the dict it
+    replaces.
+    """
+
+    __slots__ = ("max", "min", "values", "count", "sp_count", "sketch")
+
+    def __init__(self, value_type=None):
+        """Init Accumulator class."""
+        self.max = None
+        self.min = None
+        self.values = array("d") if value_type in FLOAT_TYPES else []
+        self.count = 0
+        self.sp_count = 0
+        self.sketch = None
+
+    def __getitem__(self, key):
+        """Get a field value."""
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        """Set a field value."""
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        """Test if a field exists."""
+        return key in self.__slots__
+
+    def get(self, key, default=None):
+        """Get a field value with a default."""
+        return getattr(self, key, default)
+
+    def add(self, value):
+        """Add a summary value or list of values."""
+        if isinstance(value, list):
+            self.values.extend(value)
+        else:
+            self.values.append(value)
+
+    def add_unique(self, values):
+        """Add a list of values, removing duplicates."""
+        merged = set(self.values)
+        merged.update(values)
+        if isinstance(self.values, array):
+            self.values = array(self.values.typecode, merged)
+        else:
+            self.values = list(merged)
+
+
+class Accumulators(dict):
+    """Accumulators for the attributes of one taxon, created on first use."""
+
+    __slots__ = ("types",)
+
+    def __init__(self, types):
+        """Init Accumulators class."""
+        super().__init__()
+        self.types = types
+
+    def __missing__(self, key):
+        """Create an accumulator for a new attribute key."""
+        accumulator = self[key] = Accumulator(self.types.get(key))
+        return accumulator
+
+
+class KeywordCodes:
+    """Dictionary of keyword values for one attribute.
+
+    Sets of values are encoded as integer bitsets, with a bit for the code
+    of each value, so sets from descendants are merged with a bitwise or.
+    """
+
+    def __init__(self):
+        """Init KeywordCodes class."""
+        self.codes = {}
+        self.keywords = []
+
+    def __len__(self):
+        """Count values in the dictionary."""
+        return len(self.keywords)
+
+    def code(self, value):
+        """Return the code for a value, adding it if new."""
+        code = self.codes.get(value, None)
+        if code is None:
+            code = self.codes[value] = len(self.keywords)
+            self.keywords.append(value)
+        return code
+
+    def encode(self, values, *, add=True):
+        """Encode a list of values as a bitset.
+
+        Unless add is set, values missing from the dictionary are skipped.
+        """
+        if isinstance(values, str):
+            values = [values]
+        if add:
+            idx = [self.code(value) for value in values]
+        else:
+            idx = [self.codes[value] for value in values if value in self.codes]
+        if not idx:
+            return 0
+        bits = np.zeros(max(idx) + 1, dtype=np.uint8)
+        bits[idx] = 1
+        return int.from_bytes(np.packbits(bits, bitorder="little").tobytes(), "little")
+
+    def decode(self, bits):
+        """Decode a bitset to a sorted list of values."""
+        if not bits:
+            return []
+        data = np.frombuffer(
+            bits.to_bytes((bits.bit_length() + 7) // 8, "little"), dtype=np.uint8
+        )
+        idx = np.flatnonzero(np.unpackbits(data, bitorder="little"))
+        return sorted(self.keywords[code] for code in idx.tolist())
+
+
+def union_bits(values):
+    """Merge a list of bitsets."""
+    bits = 0
+    for value in values:
+        bits |= value
+    return bits
+
+
+def count_bits(bits):
+    """Count the values in a bitset."""
+    return bin(bits).count("1")
@@ -9,6 +9,7 @@ from tolkein import tolog
 from tqdm import tqdm
 
 from .es_functions import EsQueryBuilder
+from .es_functions import bulk_options
 from .es_functions import document_by_id
 from .es_functions import index_stream
 from .es_functions import query_keyword_value_template
@@ -200,43 +201,46 @@ def lookup_missing_taxon_ids(
     return with_ids, without_ids, found_ids
 
 
-def stream_taxon_names(es, *, index, root=None, size=1000):
+def stream_taxon_names(es, *, index, root=None, size=1000, slices=1, prefetch_pages=0):
     """Get entries by depth of root taxon."""
     if root is not None:
         body = {
             "id": "taxon_names_by_root",
             "params": {"root": root},
         }
-        return stream_template_search_results(es, index=index, body=body, size=size)
-    body = {
-        "id": "taxon_names",
-        "params": {},
-    }
-    return stream_template_search_results(es, index=index, body=body)
-
-
-def chunker(seq, size):
-    """Loop through array in chunks."""
-    return (seq[pos : pos + size] for pos in range(0, len(seq), size))
+    else:
+        body = {
+            "id": "taxon_names",
+            "params": {},
+        }
+    return stream_template_search_results(
+        es,
+        index=index,
+        body=body,
+        size=size,
+        slices=slices,
+        prefetch_pages=prefetch_pages,
+    )
 
 
 def translate_xrefs(es, *, index, xrefs, source):
     """Translate a list of xrefs into taxon_ids."""
     id_map = {}
-    for refs in chunker(xrefs, 20):
-        responses = query_keyword_value_template(
-            es,
-            "taxon_by_specific_name",
-            source,
-            refs,
-            index,
-            opts={"keyword": "source", "value": "name"},
-        )
-        for idx, res in enumerate(responses["responses"]):
-            if "hits" in res and "hits" in res["hits"]:
-                hits = res["hits"]["hits"]
-                if len(hits) == 1:
-                    id_map[refs[idx]] = hits[0]["_source"]["taxon_id"]
+    responses = query_keyword_value_template(
+        es,
+        "taxon_by_specific_name",
+        source,
+        xrefs,
+        index,
+        opts={"keyword": "source", "value": "name"},
+    )
+    if responses is None:
+        return id_map
+    for idx, res in enumerate(responses["responses"]):
+        if "hits" in res and "hits" in res["hits"]:
+            hits = res["hits"]["hits"]
+            if len(hits) == 1:
+                id_map[xrefs[idx]] = hits[0]["_source"]["taxon_id"]
     return id_map
 
 
@@ -248,7 +252,13 @@ def load_taxon_table(es, opts, taxonomy_name, taxon_table):
     if "taxon-lookup-root" in opts:
         root = opts["taxon-lookup-root"]
     for node in tqdm(
-        stream_taxon_names(es, index=taxon_template["index_name"], root=root),
+        stream_taxon_names(
+            es,
+            index=taxon_template["index_name"],
+            root=root,
+            slices=opts.get("es-slices", 1),
+            prefetch_pages=opts.get("es-prefetch", 0),
+        ),
         mininterval=int(opts.get("log-interval", 1)),
     ):
         lineage = {}
@@ -429,7 +439,7 @@ def find_or_create_taxa(es, opts, *, taxon_ids, taxon_template, asm_by_taxon_id=
         stream_taxa(to_create),
         dry_run=opts.get("dry-run", False),
         log=opts.get("log-es", True),
-        chunk_size=opts.get("es-batch", 500),
+        **bulk_options(opts),
     )
     taxa.update(
         {
@@ -465,10 +475,38 @@ def add_names_to_list(existing, new, *, blanks=set({"NA", "None"})):
             names[entry["class"]][entry["name"]] = True
 
 
+def attribute_keys(attributes):
+    """List keys of new attribute values, which may be grouped in lists."""
+    keys = set()
+    for group in attributes:
+        if not isinstance(group, list):
+            group = [group]
+        keys.update(entry["key"] for entry in group)
+    return keys
+
+
+def partial_taxon_update(source, keys, taxon_names):
+    """Select fields of a taxon doc modified by new names and attributes."""
+    doc = {
+        key: source[key]
+        for key in ("taxon_id", "taxon_rank", "scientific_name", "additional_taxon")
+        if key in source
+    }
+    doc["attributes"] = [
+        attribute for attribute in source["attributes"] if attribute["key"] in keys
+    ]
+    if taxon_names:
+        doc["taxon_names"] = source["taxon_names"]
+    return doc
+
+
 def add_names_and_attributes_to_taxa(
-    es, data, opts, *, template, blanks=set(["NA", "None"])
+    es, data, opts, *, template, blanks=set(["NA", "None"]), partial=False
 ):
-    """Add names and attributes to taxa."""
+    """Add names and attributes to taxa.
+
+    With partial, only modified fields are returned for each taxon.
+    """
     for values in chunks(list(data.keys()), 500):
         # taxa = lookup_taxa_by_taxon_id(es, values, template, return_type="list")
         all_taxa = find_or_create_taxa(
@@ -501,8 +539,14 @@ def add_names_and_attributes_to_taxa(
                     or not doc["_source"]["attributes"]
                 ):
                     doc["_source"]["attributes"] = []
+                keys = attribute_keys(attributes)
                 add_attribute_values(doc["_source"]["attributes"], attributes)
-                yield doc["_id"], doc["_source"]
+                if partial:
+                    yield doc["_id"], partial_taxon_update(
+                        doc["_source"], keys, taxon_names
+                    )
+                else:
+                    yield doc["_id"], doc["_source"]
 
 
 def lookup_taxon_within_lineage(
@@ -1089,7 +1133,7 @@ def create_taxa(
         stream_taxa(new_taxa),
         dry_run=opts.get("dry-run", False),
         log=opts.get("log-es", True),
-        chunk_size=opts.get("es-batch", 500),
+        **bulk_options(opts),
     )
     # return a list of alt_taxon_ids for the created taxa
     return new_taxa.keys()
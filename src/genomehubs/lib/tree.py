@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+"""Array-backed taxon tree for in-memory traversal."""
+
+from array import array
+
+
+class Tree:
+    """Taxon tree held in integer arrays indexed by node number.
+
+    Nodes are numbered in the order they are added. Parent, depth and
+    child arrays refer to nodes by number so traversal schedules can be
+    computed without repeated lookups by taxon_id.
+    """
+
+    def __init__(self):
+        """Init Tree class."""
+        self.index = {}
+        self.taxon_ids = []
+        self.nodes = []
+        self.parent_ids = []
+        self.parents = array("l")
+        self.depths = array("l")
+        self.child_offsets = array("l")
+        self.children = array("l")
+
+    def __len__(self):
+        """Return number of nodes."""
+        return len(self.taxon_ids)
+
+    def add(self, node):
+        """Add a taxon search hit to the tree."""
+        taxon_id = node["_source"]["taxon_id"]
+        if taxon_id in self.index:
+            return self.index[taxon_id]
+        idx = len(self.taxon_ids)
+        self.index[taxon_id] = idx
+        self.taxon_ids.append(taxon_id)
+        self.nodes.append(node)
+        self.parent_ids.append(node["_source"].get("parent", None))
+        return idx
+
+    def link(self):
+        """Set parent, depth and child arrays once all nodes are added."""
+        count = len(self.taxon_ids)
+        self.parents = array("l", (self.index.get(p, -1) for p in self.parent_ids))
+        self.parent_ids = []
+        self.depths = array("l", [-1]) * count
+        for idx in range(count):
+            path = []
+            while idx >= 0 and self.depths[idx] < 0:
+                path.append(idx)
+                idx = self.parents[idx]
+            depth = self.depths[idx] if idx >= 0 else -1
+            for node_idx in reversed(path):
+                depth += 1
+                self.depths[node_idx] = depth
+        counts = array("l", [0]) * (count + 1)
+        for parent in self.parents:
+            if parent >= 0:
+                counts[parent + 1] += 1
+        for idx in range(count):
+            counts[idx + 1] += counts[idx]
+        self.child_offsets = counts
+        self.children = array("l", [0]) * counts[count]
+        filled = array("l", counts[:count])
+        for idx, parent in enumerate(self.parents):
+            if parent >= 0:
+                self.children[filled[parent]] = idx
+                filled[parent] += 1
+        return self
+
+    def child_nodes(self, idx):
+        """Return node numbers of the children of a node."""
+        return self.children[self.child_offsets[idx] : self.child_offsets[idx + 1]]
+
+    def bottom_up(self):
+        """Return node numbers ordered so children precede their parents.
+
+        Nodes are ordered by decreasing depth, keeping the order in which
+        they were added within each depth.
+        """
+        depths = self.depths
+        return sorted(range(len(depths)), key=lambda idx: -depths[idx])
+
+    def top_down(self):
+        """Return node numbers ordered so parents precede their children."""
+        depths = self.depths
+        return sorted(range(len(depths)), key=lambda idx: depths[idx])
+
+    def subtree_sizes(self):
+        """Return the number of nodes in the subtree below each node."""
+        sizes = array("l", [1]) * len(self)
+        for idx in self.bottom_up():
+            parent = self.parents[idx]
+            if parent >= 0:
+                sizes[parent] += sizes[idx]
+        return sizes
+
+    def partition(self, target, sizes=None):
+        """Cut the tree into subtrees of at most target nodes.
+
+        Returns subtree root node numbers, largest first, and the node
+        numbers above the cut.
+        """
+        if sizes is None:
+            sizes = self.subtree_sizes()
+        roots = []
+        above = []
+        stack = [idx for idx, parent in enumerate(self.parents) if parent < 0]
+        while stack:
+            idx = stack.pop()
+            if sizes[idx] <= target:
+                roots.append(idx)
+            else:
+                above.append(idx)
+                stack.extend(self.child_nodes(idx))
+        roots.sort(key=lambda idx: -sizes[idx])
+        return roots, above
+
+    def release(self, idx):
+        """Return a node and drop the tree's reference to it."""
+        node = self.nodes[idx]
+        self.nodes[idx] = None
+        return node
+
+
+def load_tree(nodes):
+    """Build a linked tree from a stream of taxon search hits."""
+    tree = Tree()
+    for node in nodes:
+        tree.add(node)
+    return tree.link()
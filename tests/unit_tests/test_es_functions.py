@@ -0,0 +1,531 @@
+#!/usr/bin/env python3
+"""Elasticsearch function tests."""
+
+import threading
+
+import pytest
+import ujson
+
+from genomehubs.lib import es_functions
+
+
+class FakeSerializer:
+    """Minimal JSON serializer."""
+
+    def dumps(self, data):
+        """Serialize data to bytes."""
+        return ujson.dumps(data).encode("utf-8")
+
+
+class FakeSerializers:
+    """Minimal serializer collection."""
+
+    def get_serializer(self, mimetype):
+        """Return a JSON serializer."""
+        return FakeSerializer()
+
+
+class FakeTransport:
+    """Minimal transport."""
+
+    serializers = FakeSerializers()
+
+
+class FakeEs:
+    """Fake Elasticsearch client recording bulk requests."""
+
+    def __init__(self, reject=0, fail_ids=None):
+        """Init FakeEs class."""
+        self.transport = FakeTransport()
+        self.requests = []
+        self.reject = reject
+        self.fail_ids = set() if fail_ids is None else fail_ids
+        self._lock = threading.Lock()
+
+    def bulk(self, operations):
+        """Record a bulk request and respond to each action."""
+        items = []
+        with self._lock:
+            self.requests.append(operations)
+            for line in operations:
+                obj = ujson.loads(line)
+                if "index" not in obj:
+                    continue
+                status = 201
+                if obj["index"]["_id"] in self.fail_ids:
+                    status = 400
+                elif self.reject > 0:
+                    self.reject -= 1
+                    status = 429
+                items.append({"index": {"_id": obj["index"]["_id"], "status": status}})
+        return {"items": items}
+
+
+class FakeIndicesClient:
+    """Fake indices client."""
+
+    def __init__(self, es):
+        """Init FakeIndicesClient class."""
+        self.es = es
+
+    def refresh(self, index):
+        """Ignore refresh requests."""
+        return None
+
+
+@pytest.fixture
+def no_refresh(monkeypatch):
+    """Skip index refresh after bulk indexing."""
+    monkeypatch.setattr(es_functions.client, "IndicesClient", FakeIndicesClient)
+
+
+def test_bulk_concurrency_reduces_and_restores_limit():
+    """Test concurrency is halved on rejection and slowly restored."""
+    concurrency = es_functions.BulkConcurrency(4)
+    concurrency.reject()
+    assert concurrency.limit == 2
+    concurrency.reject()
+    concurrency.reject()
+    assert concurrency.limit == 1
+    for _ in range(4):
+        concurrency.accept()
+    assert concurrency.limit == 2
+
+
+def test_parallel_bulk_indexes_all_actions():
+    """Test all actions are sent in chunks across threads."""
+    es = FakeEs()
+    actions = (
+        {"_index": "test", "_id": str(i), "_source": {"value": i}} for i in range(25)
+    )
+    sizer = es_functions.ChunkSizer(10)
+    results = list(es_functions.parallel_bulk(es, actions, sizer=sizer, threads=3))
+    assert len(results) == 25
+    assert all(ok for ok, _ in results)
+    assert sorted(len(request) for request in es.requests) == [10, 20, 20]
+
+
+def test_parallel_bulk_retries_rejected_actions(monkeypatch):
+    """Test actions rejected with a 429 status are retried."""
+    monkeypatch.setattr(es_functions.time, "sleep", lambda seconds: None)
+    es = FakeEs(reject=3)
+    actions = (
+        {"_index": "test", "_id": str(i), "_source": {"value": i}} for i in range(5)
+    )
+    sizer = es_functions.ChunkSizer(5)
+    results = list(es_functions.parallel_bulk(es, actions, sizer=sizer, threads=2))
+    assert len(results) == 5
+    assert all(ok for ok, _ in results)
+    assert len(es.requests) == 2
+
+
+def test_chunk_actions_limits_bytes():
+    """Test chunks are split when serialized size exceeds max bytes."""
+    serialized = [({"_id": str(i)}, [b"x" * 9, b"y" * 19]) for i in range(10)]
+    sizer = es_functions.ChunkSizer(500, 100)
+    chunks = list(es_functions.chunk_actions(iter(serialized), sizer))
+    assert [len(chunk) for chunk in chunks] == [3, 3, 3, 1]
+
+
+def test_chunk_actions_keeps_oversized_action():
+    """Test an action larger than max bytes is sent on its own."""
+    serialized = [({"_id": "a"}, [b"x" * 500]), ({"_id": "b"}, [b"x"])]
+    sizer = es_functions.ChunkSizer(500, 100)
+    chunks = list(es_functions.chunk_actions(iter(serialized), sizer))
+    assert [len(chunk) for chunk in chunks] == [1, 1]
+
+
+def test_chunk_sizer_autotune():
+    """Test chunk size follows bulk request latency."""
+    sizer = es_functions.ChunkSizer(100, autotune=True, target_took=1000)
+    sizer.observe(100, 100)
+    assert sizer.chunk_size == 150
+    sizer.observe(5000, 150)
+    assert sizer.chunk_size == 100
+    sizer.observe(100, 20)
+    assert sizer.chunk_size == 100
+    fixed = es_functions.ChunkSizer(100)
+    fixed.observe(100, 100)
+    assert fixed.chunk_size == 100
+
+
+def test_index_stream_writes_dead_letters(tmp_path, no_refresh):
+    """Test permanent failures are written to the dead-letter file and replayed."""
+    dead_letter = tmp_path / "dead_letter.jsonl"
+    es = FakeEs(fail_ids={"doc-3", "doc-7"})
+    stream = ((f"doc-{i}", {"value": i}) for i in range(10))
+    success, failed = es_functions.index_stream(
+        es, "test", stream, chunk_size=4, dead_letter=str(dead_letter)
+    )
+    assert (success, failed) == (8, 2)
+    records = list(es_functions.stream_dead_letters(dead_letter))
+    assert sorted(record["_id"] for record in records) == ["doc-3", "doc-7"]
+    assert records[0]["status"] == 400
+    assert records[0]["entry"]["value"] in {3, 7}
+    es.fail_ids = {"doc-7"}
+    success, failed = es_functions.replay_dead_letters(es, str(dead_letter))
+    assert (success, failed) == (1, 1)
+    records = list(es_functions.stream_dead_letters(dead_letter))
+    assert [record["_id"] for record in records] == ["doc-7"]
+
+
+def test_replay_resumes_interrupted_replay(monkeypatch, tmp_path, no_refresh):
+    """Test actions left from an interrupted replay are resubmitted."""
+    dead_letter = tmp_path / "dead_letter.jsonl"
+    es = FakeEs(fail_ids={"doc-1", "doc-2"})
+    stream = ((f"doc-{i}", {"value": i}) for i in range(3))
+    es_functions.index_stream(es, "test", stream, dead_letter=str(dead_letter))
+    es.fail_ids = set()
+    index_stream = es_functions.index_stream
+
+    def interrupted(*args, **kwargs):
+        raise ConnectionError
+
+    monkeypatch.setattr(es_functions, "index_stream", interrupted)
+    with pytest.raises(ConnectionError):
+        es_functions.replay_dead_letters(es, str(dead_letter))
+    assert not dead_letter.exists()
+    monkeypatch.setattr(es_functions, "index_stream", index_stream)
+    success, failed = es_functions.replay_dead_letters(es, str(dead_letter))
+    assert (success, failed) == (2, 0)
+    assert not (tmp_path / "dead_letter.jsonl.replay").exists()
+
+
+def test_dead_letter_entry_keeps_partial_updates():
+    """Test scripted attribute updates are recorded for replay as partial docs."""
+    entry = {"attributes": [{"key": "genome_size", "long_value": 10}]}
+    failure = {
+        "action": {
+            "_index": "taxon",
+            "_id": "taxon-1",
+            "_op_type": "update",
+            "script": {"id": "update_attributes_by_key", "params": entry},
+        },
+        "status": 400,
+        "error": "mapper_parsing_exception",
+    }
+    record = es_functions.dead_letter_entry("taxon", failure)
+    assert (record["_op_type"], record["entry"]) == ("attributes", entry)
+
+
+def test_index_stream_writes_change_log(tmp_path, no_refresh):
+    """Test successful writes are recorded in the change log."""
+    change_log = tmp_path / "changes.jsonl"
+    es = FakeEs(fail_ids={"doc-2"})
+    stream = ((f"doc-{i}", {"value": i}) for i in range(4))
+    es_functions.index_stream(
+        es, "test", stream, chunk_size=2, change_log=str(change_log)
+    )
+    assert es_functions.read_change_log(str(change_log), "test") == {
+        "doc-0",
+        "doc-1",
+        "doc-3",
+    }
+    assert es_functions.read_change_log(str(change_log), "other") == set()
+    assert es_functions.read_change_log(str(tmp_path / "missing"), "test") == set()
+
+
+class FakeSearchEs:
+    """Fake Elasticsearch client supporting point in time searches."""
+
+    def __init__(self, count):
+        """Init FakeSearchEs class."""
+        self.docs = [{"_id": str(i), "sort": [i]} for i in range(count)]
+        self.open_pits = set()
+        self.searches = []
+
+    def open_point_in_time(self, index, keep_alive):
+        """Open a point in time."""
+        self.open_pits.add("pit")
+        return {"id": "pit"}
+
+    def close_point_in_time(self, id):
+        """Close a point in time."""
+        self.open_pits.discard(id)
+
+    def render_search_template(self, id, params):
+        """Render a template to a search body."""
+        return {"template_output": {"from": "0", "size": params["size"]}}
+
+    def search(self, body):
+        """Return the next page of results."""
+        self.searches.append(dict(body))
+        docs = self.docs
+        if "slice" in body:
+            slice_id = body["slice"]["id"]
+            docs = [
+                doc for doc in docs if doc["sort"][0] % body["slice"]["max"] == slice_id
+            ]
+        after = body.get("search_after", [-1])[0]
+        docs = [doc for doc in docs if doc["sort"][0] > after]
+        return {"hits": {"hits": docs[: body["size"]]}}
+
+
+def test_stream_template_search_results_with_pit():
+    """Test all results are streamed with search_after."""
+    es = FakeSearchEs(25)
+    body = {"id": "template", "params": {"key": "value"}}
+    hits = list(
+        es_functions.stream_template_search_results(
+            es, index="test", body=body, size=10
+        )
+    )
+    assert [hit["_id"] for hit in hits] == [str(i) for i in range(25)]
+    assert body == {"id": "template", "params": {"key": "value"}}
+    assert "from" not in es.searches[0]
+    assert es.searches[0]["sort"] == [{"_shard_doc": "asc"}]
+    assert es.searches[0]["pit"] == {"id": "pit", "keep_alive": "10m"}
+    assert not es.open_pits
+
+
+def test_stream_template_search_results_closes_pit_early():
+    """Test the point in time is closed when the generator is closed."""
+    es = FakeSearchEs(25)
+    stream = es_functions.stream_template_search_results(
+        es, index="test", body={"id": "template", "params": {}}, size=10
+    )
+    next(stream)
+    assert es.open_pits
+    stream.close()
+    assert not es.open_pits
+
+
+def test_stream_template_search_results_in_slices():
+    """Test sliced reads return every result exactly once."""
+    es = FakeSearchEs(53)
+    hits = list(
+        es_functions.stream_template_search_results(
+            es, index="test", body={"id": "template", "params": {}}, size=5, slices=4
+        )
+    )
+    assert sorted(int(hit["_id"]) for hit in hits) == list(range(53))
+    assert {search["slice"]["max"] for search in es.searches} == {4}
+    assert not es.open_pits
+
+
+def test_stream_template_search_results_with_prefetch():
+    """Test prefetched results are complete and released on early close."""
+    es = FakeSearchEs(25)
+    body = {"id": "template", "params": {}}
+    hits = list(
+        es_functions.stream_template_search_results(
+            es, index="test", body=body, size=10, prefetch_pages=2
+        )
+    )
+    assert [hit["_id"] for hit in hits] == [str(i) for i in range(25)]
+    stream = es_functions.stream_template_search_results(
+        es, index="test", body=body, size=10, prefetch_pages=2
+    )
+    next(stream)
+    stream.close()
+    assert not es.open_pits
+
+
+def test_prefetch_propagates_errors():
+    """Test errors raised while reading ahead reach the consumer."""
+
+    def failing_stream():
+        yield 1
+        raise ValueError("failed")
+
+    stream = es_functions.prefetch(failing_stream(), 2)
+    assert next(stream) == 1
+    with pytest.raises(ValueError):
+        next(stream)
+
+
+class FakeSettingsIndicesClient:
+    """Fake indices client recording settings and refresh requests."""
+
+    settings = {}
+    refreshed = []
+
+    def __init__(self, es):
+        """Init FakeSettingsIndicesClient class."""
+        self.es = es
+
+    def get_settings(self, index, flat_settings):
+        """Return current index settings."""
+        return {index: {"settings": dict(self.settings[index])}}
+
+    def put_settings(self, index, settings):
+        """Update index settings."""
+        self.settings[index].update(settings)
+
+    def refresh(self, index):
+        """Record refresh requests."""
+        self.refreshed.append(index)
+
+
+def test_bulk_load_session_defers_refresh_and_restores_settings(monkeypatch):
+    """Test bulk-load settings are applied, refreshes deferred and restored."""
+    monkeypatch.setattr(es_functions.client, "IndicesClient", FakeSettingsIndicesClient)
+    monkeypatch.setattr(es_functions, "index_exists", lambda es, name: True)
+    original = {"index.refresh_interval": "1s", "index.number_of_replicas": "1"}
+    FakeSettingsIndicesClient.settings = {"test": dict(original)}
+    FakeSettingsIndicesClient.refreshed = []
+    with pytest.raises(ValueError):
+        with es_functions.bulk_load(None, ["test"]):
+            settings = FakeSettingsIndicesClient.settings["test"]
+            assert settings["index.refresh_interval"] == "-1"
+            assert settings["index.number_of_replicas"] == 0
+            assert not es_functions.refresh_index(None, "test")
+            assert es_functions.refresh_index(None, "other")
+            assert FakeSettingsIndicesClient.refreshed == ["other"]
+            es_functions.refresh_barrier(None)
+            assert FakeSettingsIndicesClient.refreshed == ["other", "test"]
+            es_functions.refresh_index(None, "test")
+            raise ValueError("failed")
+    assert FakeSettingsIndicesClient.refreshed == ["other", "test", "test"]
+    assert FakeSettingsIndicesClient.settings["test"] == original
+    assert not es_functions.BULK_LOAD_SESSIONS
+
+
+def test_es_client_is_shared_and_uses_all_hosts():
+    """Test clients are pooled per process across all configured hosts."""
+    opts = {"es-host": ["localhost:9200", "https://remote:9243"], "es-connections": 4}
+    es = es_functions.es_client(opts)
+    assert es_functions.es_client(dict(opts)) is es
+    assert es_functions.es_hosts(opts) == [
+        "http://localhost:9200",
+        "https://remote:9243",
+    ]
+    assert len(es.transport.node_pool.all()) == 2
+    assert es_functions.es_client({**opts, "es-compress": True}) is not es
+
+
+class FakeLookupEs:
+    """Fake Elasticsearch client recording msearch and mget requests."""
+
+    def __init__(self):
+        """Init FakeLookupEs class."""
+        self.msearches = []
+        self.mgets = []
+        self._lock = threading.Lock()
+
+    def msearch_template(self, body, index):
+        """Respond with the template params of each search."""
+        searches = [ujson.loads(line) for line in body.splitlines()[1::2]]
+        with self._lock:
+            self.msearches.append(len(searches))
+        return {"responses": [{"params": search["params"]} for search in searches]}
+
+    def mget(self, body, index):
+        """Respond with a document for each even ID."""
+        with self._lock:
+            self.mgets.append(len(body["ids"]))
+        return {
+            "docs": [
+                {"_id": doc_id, "found": int(doc_id) % 2 == 0, "_source": {}}
+                for doc_id in body["ids"]
+            ]
+        }
+
+
+def test_search_batcher_coalesces_lookups():
+    """Test lookups are batched by count and bytes and answered in order."""
+    es = FakeLookupEs()
+    with es_functions.SearchBatcher(es, batch_size=10, max_bytes=10000) as batcher:
+        searches = [
+            batcher.search_template("test", "t", {"value": i}) for i in range(25)
+        ]
+        gets = [batcher.get("test", str(i)) for i in range(25)]
+    assert [future.result()["params"]["value"] for future in searches] == list(
+        range(25)
+    )
+    assert sorted(es.msearches) == [5, 10, 10]
+    assert sorted(es.mgets) == [5, 10, 10]
+    assert [future.result()["found"] for future in gets[:3]] == [True, False, True]
+    es = FakeLookupEs()
+    with es_functions.SearchBatcher(es, max_bytes=200) as batcher:
+        for i in range(10):
+            batcher.search_template("test", "template", {"value": i})
+    assert sorted(es.msearches) == [2, 4, 4]
+
+
+def test_document_by_id_uses_batched_mget(monkeypatch):
+    """Test document_by_id returns found documents from batched lookups."""
+    monkeypatch.setattr(es_functions, "index_exists", lambda es, name: True)
+    es = FakeLookupEs()
+    res = es_functions.document_by_id(es, [str(i) for i in range(6)], "test")
+    assert sorted(res) == ["0", "2", "4"]
+
+
+def test_search_batcher_is_shared_and_coalesces_calls(monkeypatch):
+    """Test lookups from separate calls share one batcher and batch."""
+    monkeypatch.setattr(es_functions, "index_exists", lambda es, name: True)
+    es = FakeLookupEs()
+    batcher = es_functions.search_batcher(es)
+    assert es_functions.search_batcher(es) is batcher
+    assert es_functions.search_batcher(FakeLookupEs()) is not batcher
+    queued = [batcher.get("test", str(i)) for i in range(3)]
+    res = es_functions.document_by_id(es, [str(i) for i in range(3, 6)], "test")
+    assert sorted(res) == ["4"]
+    assert es.mgets == [6]
+    assert [future.result()["_id"] for future in queued] == ["0", "1", "2"]
+
+
+def test_search_batcher_fails_lookups_without_response():
+    """Test a short batch response fails the remaining lookups."""
+    es = FakeLookupEs()
+    es.mget = lambda body, index: {"docs": [{"_id": body["ids"][0]}]}
+    with es_functions.SearchBatcher(es) as batcher:
+        futures = [batcher.get("test", str(i)) for i in range(3)]
+    assert futures[0].result()["_id"] == "0"
+    for future in futures[1:]:
+        with pytest.raises(RuntimeError):
+            future.result(timeout=1)
+
+
+class FakeExistsIndicesClient:
+    """Fake indices client counting existence checks."""
+
+    indices = set()
+    calls = []
+
+    def __init__(self, es):
+        """Init FakeExistsIndicesClient class."""
+        self.es = es
+
+    def exists(self, index):
+        """Record an existence check."""
+        self.calls.append(("exists", index))
+        return index in self.indices
+
+    def create(self, index):
+        """Create an index."""
+        self.calls.append(("create", index))
+        self.indices.add(index)
+        return {"acknowledged": True}
+
+    def put_template(self, name, body):
+        """Record a template update."""
+        self.calls.append(("put_template", name))
+        return {"acknowledged": True}
+
+
+def test_metadata_cache_saves_round_trips(monkeypatch):
+    """Test existing indices and loaded templates are only checked once."""
+    monkeypatch.setattr(es_functions.client, "IndicesClient", FakeExistsIndicesClient)
+    monkeypatch.setattr(es_functions, "METADATA_CACHE", es_functions.MetadataCache())
+    FakeExistsIndicesClient.indices = {"existing"}
+    FakeExistsIndicesClient.calls = []
+    assert es_functions.index_exists(None, "existing")
+    assert es_functions.index_exists(None, "existing")
+    assert not es_functions.index_exists(None, "new")
+    assert not es_functions.index_exists(None, "new")
+    es_functions.index_create(None, "new")
+    assert es_functions.index_exists(None, "new")
+    es_functions.load_mapping(None, "template", {"mappings": {}})
+    es_functions.load_mapping(None, "template", {"mappings": {}})
+    es_functions.load_mapping(None, "template", {"mappings": {"a": 1}})
+    assert FakeExistsIndicesClient.calls == [
+        ("exists", "existing"),
+        ("exists", "new"),
+        ("exists", "new"),
+        ("exists", "new"),
+        ("create", "new"),
+        ("put_template", "template"),
+        ("put_template", "template"),
+    ]
+    assert es_functions.METADATA_CACHE.saved == 3
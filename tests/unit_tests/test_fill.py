@@ -0,0 +1,779 @@
+#!/usr/bin/env python3
+"""Fill tests."""
+
+import pytest
+import ujson
+
+from genomehubs.lib import fill
+from genomehubs.lib.tree import load_tree
+
+
+def make_node(taxon_id, parent=None, rank="genus", attributes=None):
+    """Create a taxon search hit."""
+    source = {"taxon_id": taxon_id, "taxon_rank": rank, "scientific_name": taxon_id}
+    if parent is not None:
+        source["parent"] = parent
+    if attributes is not None:
+        source["attributes"] = attributes
+    return {"_id": f"taxon-{taxon_id}", "_source": source}
+
+
+def genome_size(value):
+    """Create a genome_size attribute with a single value."""
+    return [{"key": "genome_size", "values": [{"long_value": value}]}]
+
+
+def make_nodes():
+    """Create a small tree with values at the tips."""
+    return [
+        make_node("sp1", "g1", "species", genome_size(10)),
+        make_node("root", rank="family"),
+        make_node("g1", "root"),
+        make_node("sp2", "g1", "species", genome_size(20)),
+        make_node("g2", "root"),
+        make_node("sp3", "g2", "species", genome_size(40)),
+        make_node("sp4", "g2", "species"),
+    ]
+
+
+@pytest.fixture
+def template():
+    """Taxon template with a single traversable attribute."""
+    return {
+        "index_name": "taxon",
+        "types": {
+            "attributes": {
+                "genome_size": {
+                    "type": "long",
+                    "summary": ["median"],
+                    "traverse": "median",
+                }
+            }
+        },
+    }
+
+
+def test_tree_orders_children_before_parents():
+    """Test array-backed tree depths and bottom-up schedule."""
+    tree = load_tree(make_nodes())
+    assert [tree.depths[tree.index[key]] for key in ("root", "g1", "sp1")] == [0, 1, 2]
+    children = tree.child_nodes(tree.index["g2"])
+    assert sorted(tree.taxon_ids[idx] for idx in children) == ["sp3", "sp4"]
+    order = [tree.taxon_ids[idx] for idx in tree.bottom_up()]
+    assert order == ["sp1", "sp2", "sp3", "sp4", "g1", "g2", "root"]
+
+
+def test_traverse_from_tips_summarises_subtree(monkeypatch, template):
+    """Test values are summarised from tips to root in a single pass."""
+    monkeypatch.setattr(
+        fill, "stream_subtree_nodes", lambda es, **kwargs: iter(make_nodes())
+    )
+    opts = {"traverse-root": "root", "traverse-limit": "null"}
+    updates = dict(
+        fill.traverse_from_tips(None, opts, template=template, root="root", max_depth=2)
+    )
+    assert updates["taxon-g1"]["attributes"][0]["long_value"] == 15
+    assert updates["taxon-g2"]["attributes"][0]["long_value"] == 40
+    root = updates["taxon-root"]["attributes"][0]
+    assert root["long_value"] == 27.5
+    assert root["count"] == 2
+    assert root["aggregation_source"] == "descendant"
+    assert "taxon-sp4" not in updates
+
+
+def test_date_summaries_use_day_ordinals(monkeypatch):
+    """Test date values are summarised as ordinals and stored as dates."""
+
+    def release_date(*values):
+        return [
+            {
+                "key": "release_date",
+                "values": [{"date_value": value} for value in values],
+            }
+        ]
+
+    nodes = [
+        make_node("sp1", "g1", "species", release_date("2019-02-28", "2021-06-01")),
+        make_node("sp2", "g1", "species", release_date("2020-12-31")),
+        make_node("sp3", "g2", "species", release_date("2018-01-01")),
+        make_node("g1", "root"),
+        make_node("g2", "root"),
+        make_node("root", rank="family"),
+    ]
+    monkeypatch.setattr(fill, "stream_subtree_nodes", lambda es, **kwargs: iter(nodes))
+    template = {
+        "index_name": "taxon",
+        "types": {
+            "attributes": {
+                "release_date": {
+                    "type": "date",
+                    "summary": ["max", "min"],
+                    "traverse": "max",
+                }
+            }
+        },
+    }
+    opts = {"traverse-root": "root", "traverse-limit": "null"}
+    updates = dict(
+        fill.traverse_from_tips(None, opts, template=template, root="root", max_depth=2)
+    )
+    sp1 = updates["taxon-sp1"]["attributes"][0]
+    assert (sp1["date_value"], sp1["from"], sp1["to"]) == (
+        "2021-06-01",
+        "2019-02-28",
+        "2021-06-01",
+    )
+    root = updates["taxon-root"]["attributes"][0]
+    assert (root["date_value"], root["from"], root["to"]) == (
+        "2021-06-01",
+        "2018-01-01",
+        "2021-06-01",
+    )
+    assert fill.date_string(fill.date_ordinal("2020-02-29")) == "2020-02-29"
+
+
+def test_keyword_lists_are_dictionary_encoded(monkeypatch):
+    """Test keyword lists are merged as encoded sets and stored as strings."""
+
+    def country(*values):
+        return [
+            {
+                "key": "country",
+                "values": [{"keyword_value": value} for value in values],
+            }
+        ]
+
+    nodes = [
+        make_node("sp1", "g1", "species", country("UK", "France", "UK")),
+        make_node("sp2", "g1", "species", country("Spain")),
+        make_node("sp3", "g2", "species", country("UK")),
+        make_node("g1", "root"),
+        make_node("g2", "root", attributes=country("Peru")),
+        make_node("root", rank="family"),
+    ]
+    monkeypatch.setattr(fill, "stream_subtree_nodes", lambda es, **kwargs: iter(nodes))
+    template = {
+        "index_name": "taxon",
+        "types": {
+            "attributes": {
+                "country": {"type": "keyword", "summary": "list", "traverse": "list"}
+            }
+        },
+    }
+    opts = {"traverse-root": "root", "traverse-limit": "null"}
+    updates = dict(
+        fill.traverse_from_tips(None, opts, template=template, root="root", max_depth=2)
+    )
+    sp1 = updates["taxon-sp1"]["attributes"][0]
+    assert (sp1["keyword_value"], sp1["length"], sp1["count"]) == (
+        ["France", "UK"],
+        2,
+        3,
+    )
+    assert updates["taxon-g2"]["attributes"][0]["keyword_value"] == ["Peru", "UK"]
+    root = updates["taxon-root"]["attributes"][0]
+    assert root["keyword_value"] == ["France", "Peru", "Spain", "UK"]
+    assert root["length"] == 4
+
+
+def test_ancestor_values_fill_each_descendant_once(template):
+    """Test nearest ancestor values are carried down in a single pass."""
+    nodes = make_nodes()
+    nodes[1]["_source"]["attributes"] = [
+        {"key": "genome_size", "long_value": 30, "count": 3, "median": 30}
+    ]
+    nodes[4]["_source"]["attributes"] = [
+        {"key": "genome_size", "long_value": 40, "count": 1, "median": 40}
+    ]
+    nodes.append(make_node("ssp4", "sp4", "subspecies"))
+    tree = load_tree(nodes)
+    updates = list(
+        fill.stream_ancestor_values_to_descendants(
+            tree,
+            attrs={"genome_size"},
+            meta=template["types"]["attributes"],
+            max_depth=3,
+        )
+    )
+    assert [doc_id for doc_id, _ in updates] == ["taxon-g1", "taxon-sp4", "taxon-ssp4"]
+    values = {doc_id: doc["attributes"][-1] for doc_id, doc in updates}
+    assert values["taxon-g1"]["long_value"] == 30
+    assert values["taxon-sp4"]["long_value"] == 40
+    assert values["taxon-ssp4"]["long_value"] == 40
+    assert values["taxon-ssp4"]["aggregation_source"] == "ancestor"
+
+
+def test_ancestor_values_reach_descendants_below_max_depth(template):
+    """Test max_depth limits which ancestors pass on values, not how far."""
+    nodes = [
+        make_node("root", rank="family"),
+        make_node("c1", "root"),
+        make_node("g1", "c1"),
+        make_node("gg1", "g1", "species"),
+        make_node("gg2", "g1", "species"),
+    ]
+    nodes[2]["_source"]["attributes"] = [
+        {"key": "genome_size", "long_value": 20, "count": 1, "median": 20}
+    ]
+    nodes[0]["_source"]["attributes"] = [
+        {"key": "genome_size", "long_value": 10, "count": 1, "median": 10}
+    ]
+    updates = dict(
+        fill.stream_ancestor_values_to_descendants(
+            load_tree(nodes),
+            attrs={"genome_size"},
+            meta=template["types"]["attributes"],
+            max_depth=1,
+        )
+    )
+    assert sorted(updates) == ["taxon-c1", "taxon-gg1", "taxon-gg2"]
+    assert {
+        doc_id: doc["attributes"][-1]["long_value"] for doc_id, doc in updates.items()
+    } == {"taxon-c1": 10, "taxon-gg1": 10, "taxon-gg2": 10}
+
+
+def test_traverse_from_tips_with_approximate_summaries(monkeypatch, template):
+    """Test approximate attributes propagate sketches and report error."""
+    template["types"]["attributes"]["genome_size"]["summary_precision"] = "approximate"
+    monkeypatch.setattr(
+        fill, "stream_subtree_nodes", lambda es, **kwargs: iter(make_nodes())
+    )
+    opts = {"traverse-root": "root", "traverse-limit": "null"}
+    updates = dict(
+        fill.traverse_from_tips(None, opts, template=template, root="root", max_depth=2)
+    )
+    root = updates["taxon-root"]["attributes"][0]
+    assert root["long_value"] == pytest.approx(20, rel=0.01)
+    assert root["summary_error"] == 0.01
+    assert (root["min"], root["max"]) == (10, 40)
+    assert root["count"] == 2
+
+
+def test_summarise_tree_with_frozen_children(template):
+    """Test unchanged children contribute stored summaries to changed ancestors."""
+    nodes = [
+        node
+        for node in make_nodes()
+        if node["_source"]["taxon_id"] not in {"sp3", "sp4"}
+    ]
+    nodes[4]["_source"]["attributes"] = [
+        {
+            "key": "genome_size",
+            "long_value": 40,
+            "median": 40,
+            "count": 1,
+            "sp_count": 1,
+            "aggregation_source": "descendant",
+        }
+    ]
+    opts = {"traverse-limit": "null"}
+    updates = dict(
+        fill.summarise_tree(
+            load_tree(nodes),
+            opts,
+            meta=template["types"]["attributes"],
+            frozen={"sp2", "g2"},
+        )
+    )
+    assert sorted(updates) == ["taxon-g1", "taxon-root", "taxon-sp1"]
+    assert updates["taxon-g1"]["attributes"][0]["long_value"] == 15
+    root = updates["taxon-root"]["attributes"][0]
+    assert root["long_value"] == 27.5
+    assert root["count"] == 2
+
+
+class FakeTaxonIndex:
+    """In-memory taxon index standing in for ElasticSearch lookups."""
+
+    def __init__(self, nodes):
+        """Init FakeTaxonIndex class."""
+        self.sources = {
+            node["_source"]["taxon_id"]: ujson.loads(ujson.dumps(node["_source"]))
+            for node in nodes
+        }
+
+    def lineage(self, taxon_id):
+        """List ancestors of a taxon, nearest first."""
+        lineage = []
+        parent = self.sources[taxon_id].get("parent", None)
+        while parent is not None:
+            lineage.append({"taxon_id": parent, "node_depth": len(lineage) + 1})
+            parent = self.sources[parent].get("parent", None)
+        return lineage
+
+    def hit(self, taxon_id):
+        """Return a copy of a taxon as a search hit."""
+        source = ujson.loads(ujson.dumps(self.sources[taxon_id]))
+        return {"_id": f"taxon-{taxon_id}", "_source": source}
+
+    def document_by_id(self, es, ids, index):
+        """Get documents with their lineage by ID."""
+        docs = {}
+        for doc_id in ids:
+            taxon_id = doc_id.replace("taxon-", "", 1)
+            if taxon_id in self.sources:
+                docs[doc_id] = {
+                    **self.hit(taxon_id)["_source"],
+                    "lineage": self.lineage(taxon_id),
+                }
+        return docs
+
+    def search(self, es, *, index, body, **kwargs):
+        """Stream results of the search templates used by fill."""
+        params = body["params"]
+        if body["id"] == "taxon_attributes_by_taxon_id":
+            return iter([self.hit(params["taxon_id"])])
+        if body["id"] == "taxon_attributes_by_parent":
+            return iter(
+                [
+                    self.hit(taxon_id)
+                    for taxon_id, source in self.sources.items()
+                    if source.get("parent", None) in params["taxon_ids"]
+                ]
+            )
+        return iter(
+            [
+                self.hit(taxon_id)
+                for taxon_id in self.sources
+                if any(
+                    ancestor["taxon_id"] == params["taxon_id"]
+                    and ancestor["node_depth"] <= params["depth"]
+                    for ancestor in self.lineage(taxon_id)
+                )
+            ]
+        )
+
+    def max_depth(self, es, *, index, root):
+        """Find the depth of the deepest descendant of a root taxon."""
+        return max(
+            (
+                ancestor["node_depth"]
+                for taxon_id in self.sources
+                for ancestor in self.lineage(taxon_id)
+                if ancestor["taxon_id"] == root
+            ),
+            default=None,
+        )
+
+    def index_updates(self, es, opts, template, stream):
+        """Replace stored documents with updates."""
+        for doc_id, source in stream:
+            self.sources[doc_id.replace("taxon-", "", 1)] = ujson.loads(
+                ujson.dumps(source)
+            )
+
+
+@pytest.fixture
+def taxon_index(monkeypatch):
+    """Install an in-memory taxon index for fill lookups."""
+
+    def install(index):
+        monkeypatch.setattr(fill, "document_by_id", index.document_by_id)
+        monkeypatch.setattr(fill, "stream_template_search_results", index.search)
+        monkeypatch.setattr(fill, "get_max_depth_by_lineage", index.max_depth)
+        monkeypatch.setattr(fill, "index_updates", index.index_updates)
+        return index
+
+    return install
+
+
+def incremental_nodes():
+    """Create a tree with no values yet."""
+    return [
+        make_node("root", rank="family"),
+        make_node("g1", "root"),
+        make_node("sp1", "g1", "species"),
+        make_node("sp2", "g1", "species"),
+        make_node("g3", "root"),
+        make_node("sp5", "g3", "species"),
+        make_node("sp6", "g3", "species"),
+    ]
+
+
+FILL_OPTS = {
+    "traverse-root": "root",
+    "traverse-limit": "null",
+    "traverse-infer-ancestors": True,
+    "traverse-infer-descendants": True,
+}
+
+
+def test_changed_lineages_trims_lineages_to_root(taxon_index):
+    """Test changed taxa outside the root are skipped and lineages end at root."""
+    nodes = make_nodes()
+    nodes[1]["_source"]["parent"] = "top"
+    taxon_index(FakeTaxonIndex(nodes + [make_node("top", rank="order")]))
+    changed, affected = fill.changed_lineages(
+        None,
+        index="taxon",
+        root="g1",
+        doc_ids={"taxon-sp1", "taxon-g1", "taxon-sp3", "taxon-top"},
+    )
+    assert changed == {"sp1": ["g1"], "g1": []}
+    assert affected == {"sp1", "g1"}
+    changed, affected = fill.changed_lineages(
+        None, index="taxon", root="root", doc_ids={"taxon-sp1"}
+    )
+    assert changed == {"sp1": ["g1", "root"]}
+
+
+def test_stream_nodes_and_children_and_inherited_values(taxon_index):
+    """Test taxa are read with their children and nearest ancestors win."""
+    nodes = make_nodes()
+    nodes[1]["_source"]["attributes"] = genome_size(30)
+    nodes[2]["_source"]["attributes"] = genome_size(20)
+    taxon_index(FakeTaxonIndex(nodes))
+    streamed = fill.stream_nodes_and_children(None, index="taxon", taxon_ids={"g1"})
+    assert [node["_id"] for node in streamed] == ["taxon-g1", "taxon-sp1", "taxon-sp2"]
+    values = fill.inherited_values(
+        None, index="taxon", lineage=["g1", "root"], attrs={"genome_size"}
+    )
+    assert values["genome_size"]["values"] == [{"long_value": 20}]
+    assert fill.inherited_values(None, index="taxon", lineage=[], attrs=set()) == {}
+
+
+def test_incremental_fill_matches_full_fill(taxon_index, template, tmp_path):
+    """Test an incremental fill for a changed species matches a full fill."""
+    index = taxon_index(FakeTaxonIndex(incremental_nodes()))
+    fill.traverse_tree("es", FILL_OPTS, template, "root", None)
+    index.sources["sp5"]["attributes"] = genome_size(50)
+    expected = taxon_index(FakeTaxonIndex([]))
+    expected.sources = ujson.loads(ujson.dumps(index.sources))
+    fill.traverse_tree("es", FILL_OPTS, template, "root", None)
+    taxon_index(index)
+    log = tmp_path / "changes.jsonl"
+    log.write_text(ujson.dumps({"_index": "taxon", "_id": "taxon-sp5"}) + "\n")
+    fill.incremental_fill(
+        "es", {**FILL_OPTS, "traverse-incremental": str(log)}, template
+    )
+    assert index.sources == expected.sources
+    for taxon_id in ("g3", "root", "sp6", "g1", "sp1"):
+        assert index.sources[taxon_id]["attributes"][0]["long_value"] == 50
+    assert index.sources["sp1"]["attributes"][0]["aggregation_source"] == "ancestor"
+
+
+def test_incremental_fill_keeps_change_log_until_success(
+    monkeypatch, taxon_index, template, tmp_path
+):
+    """Test the change log is kept after a failed run and removed on success."""
+    taxon_index(FakeTaxonIndex(make_nodes()))
+    log = tmp_path / "changes.jsonl"
+    working = tmp_path / "changes.jsonl.fill"
+    log.write_text(ujson.dumps({"_index": "taxon", "_id": "taxon-sp1"}) + "\n")
+    opts = {**FILL_OPTS, "traverse-incremental": str(log)}
+
+    def fail(*args, **kwargs):
+        raise ConnectionError
+
+    monkeypatch.setattr(fill, "summarise_lineages", fail)
+    with pytest.raises(ConnectionError):
+        fill.incremental_fill("es", opts, template)
+    assert not log.exists()
+    assert working.exists()
+    log.write_text(ujson.dumps({"_index": "taxon", "_id": "taxon-sp3"}) + "\n")
+    seen = []
+    changed_lineages = fill.changed_lineages
+
+    def record(es, *, index, root, doc_ids):
+        seen.append(doc_ids)
+        return changed_lineages(es, index=index, root=root, doc_ids=doc_ids)
+
+    monkeypatch.setattr(fill, "changed_lineages", record)
+    monkeypatch.setattr(fill, "summarise_lineages", lambda *args, **kwargs: set())
+    fill.incremental_fill("es", opts, template)
+    assert seen == [{"taxon-sp1", "taxon-sp3"}]
+    assert not log.exists()
+    assert not working.exists()
+
+
+def make_unbalanced_nodes():
+    """Create a tree with one large and two small subtrees."""
+    nodes = [make_node("root", rank="order"), make_node("big", "root", "family")]
+    nodes += [make_node(f"b{i}", "big") for i in range(6)]
+    nodes += [make_node("small1", "root", "family"), make_node("small2", "root")]
+    return nodes
+
+
+def test_tree_partition_cuts_large_subtrees():
+    """Test subtrees larger than the target are split at their children."""
+    tree = load_tree(make_unbalanced_nodes())
+    assert tree.subtree_sizes()[tree.index["big"]] == 7
+    roots, above = tree.partition(7)
+    assert [tree.taxon_ids[idx] for idx in roots] == ["big", "small2", "small1"]
+    assert [tree.taxon_ids[idx] for idx in above] == ["root"]
+
+
+def test_partition_subtrees_balances_groups(monkeypatch):
+    """Test small subtrees are grouped into units of similar size."""
+    monkeypatch.setattr(fill, "get_max_depth_by_lineage", lambda es, **kwargs: 2)
+    monkeypatch.setattr(
+        fill, "stream_subtree_nodes", lambda es, **kwargs: iter(make_unbalanced_nodes())
+    )
+    groups, above = fill.partition_subtrees(
+        None, {}, index="taxon", root="root", parts=4
+    )
+    assert above == {"root", "big"}
+    assert [len(group) for group in groups] == [2, 2, 2, 2]
+    assert sorted(sum(groups, [])) == sorted(
+        ["small1", "small2"] + [f"b{i}" for i in range(6)]
+    )
+
+
+class InlinePool:
+    """Stand-in for a process pool that runs tasks in this process."""
+
+    def __init__(self, processes=None):
+        """Init InlinePool class."""
+
+    def __enter__(self):
+        """Enter pool context."""
+        return self
+
+    def __exit__(self, *args):
+        """Exit pool context."""
+
+    def imap_unordered(self, func, tasks):
+        """Run tasks in order."""
+        return map(func, tasks)
+
+
+def test_parallel_fill_inherits_values_inside_subtrees(monkeypatch, template):
+    """Test values above the subtree cut reach taxa inside each subtree."""
+    nodes = {
+        node["_source"]["taxon_id"]: node
+        for node in [
+            make_node("root", rank="family"),
+            make_node("c1", "root"),
+            make_node("g1", "c1"),
+            make_node("gg1", "g1", "species"),
+            make_node("c2", "root"),
+            make_node("g2", "c2", "species"),
+        ]
+    }
+    nodes["root"]["_source"]["attributes"] = [
+        {"key": "genome_size", "long_value": 10, "count": 1, "median": 10}
+    ]
+
+    def subtree(root):
+        yield ujson.loads(ujson.dumps(nodes[root]))
+        for taxon_id, node in nodes.items():
+            if node["_source"].get("parent") == root:
+                yield from subtree(taxon_id)
+
+    def nodes_and_children(es, *, index, taxon_ids):
+        for taxon_id in taxon_ids:
+            yield ujson.loads(ujson.dumps(nodes[taxon_id]))
+        for node in nodes.values():
+            if node["_source"].get("parent") in taxon_ids:
+                yield ujson.loads(ujson.dumps(node))
+
+    def index_updates(es, opts, template, stream):
+        for doc_id, source in stream:
+            nodes[doc_id.replace("taxon-", "")]["_source"] = source
+
+    monkeypatch.setattr(fill, "Pool", InlinePool)
+    monkeypatch.setattr(fill, "launch_es", lambda opts, **kwargs: None)
+    monkeypatch.setattr(fill, "get_max_depth_by_lineage", lambda es, **kwargs: 3)
+    monkeypatch.setattr(
+        fill,
+        "partition_subtrees",
+        lambda es, opts, **kwargs: ([["c1"], ["c2"]], {"root"}),
+    )
+    monkeypatch.setattr(
+        fill, "stream_subtree_nodes", lambda es, *, root, **kwargs: subtree(root)
+    )
+    monkeypatch.setattr(fill, "stream_nodes_and_children", nodes_and_children)
+    monkeypatch.setattr(fill, "index_updates", index_updates)
+    opts = {
+        "traverse-root": "root",
+        "traverse-limit": "null",
+        "traverse-threads": 2,
+        "traverse-infer-descendants": True,
+    }
+    fill.traverse_handler(None, opts, template)
+    for taxon_id in ("c1", "g1", "gg1", "c2", "g2"):
+        attribute = nodes[taxon_id]["_source"]["attributes"][0]
+        assert (attribute["long_value"], attribute["aggregation_source"]) == (
+            10,
+            "ancestor",
+        )
+
+
+def test_partition_attributes_keeps_linked_attributes_together():
+    """Test attribute groups are balanced and keep ordered attributes together."""
+    meta = {
+        "assembly_level": {"type": "keyword", "order": ["assembly_span"]},
+        "assembly_span": {"type": "long"},
+        "c_value": {"type": "float"},
+        "genome_size": {"type": "long"},
+    }
+    groups = fill.partition_attributes(meta, 3)
+    assert len(groups) == 3
+    assert {"assembly_level", "assembly_span"} in groups
+    assert sorted(key for keys in groups for key in keys) == sorted(meta)
+
+
+def test_index_updates_sends_attribute_group(monkeypatch, template):
+    """Test attribute group updates only send attributes in the group."""
+    calls = []
+
+    def index_stream(es, index, stream, **kwargs):
+        calls.append((kwargs["_op_type"], list(stream)))
+        return len(calls[-1][1]), 0
+
+    monkeypatch.setattr(fill, "index_stream", index_stream)
+    monkeypatch.setattr(fill, "refresh_barrier", lambda es: None)
+    template["attribute_group"] = {"genome_size"}
+    source = {
+        "taxon_id": "sp1",
+        "attributes": [{"key": "genome_size"}, {"key": "c_value"}],
+    }
+    fill.index_updates(None, {}, template, iter([("taxon-sp1", source)]))
+    assert calls == [
+        ("attributes", [("taxon-sp1", {"attributes": [{"key": "genome_size"}]})])
+    ]
+
+
+def test_fill_from_tips_resumes_from_checkpoint(monkeypatch, template, tmp_path):
+    """Test an interrupted traversal resumes above the last saved depth."""
+    monkeypatch.setattr(
+        fill, "stream_subtree_nodes", lambda es, **kwargs: iter(make_nodes())
+    )
+    written = []
+
+    def index_updates(es, opts, template, stream):
+        updates = dict(stream)
+        if "taxon-root" in updates and not opts.get("resume"):
+            raise ConnectionError
+        written.append(updates)
+
+    monkeypatch.setattr(fill, "index_updates", index_updates)
+    opts = {
+        "traverse-limit": "null",
+        "checkpoint": str(tmp_path),
+        "checkpoint-interval": 0,
+    }
+    with pytest.raises(ConnectionError):
+        fill.fill_from_tips(None, opts, template=template, root="root", max_depth=2)
+    assert [sorted(updates) for updates in written] == [
+        ["taxon-sp1", "taxon-sp2", "taxon-sp3"],
+        ["taxon-g1", "taxon-g2"],
+    ]
+    written.clear()
+    opts["resume"] = True
+    fill.fill_from_tips(None, opts, template=template, root="root", max_depth=2)
+    assert [sorted(updates) for updates in written] == [["taxon-root"]]
+    root = written[0]["taxon-root"]["attributes"][0]
+    assert (root["long_value"], root["count"]) == (27.5, 2)
+
+
+def test_fill_from_tips_profiles_fill(monkeypatch, template, tmp_path):
+    """Test a profiled fill records time per attribute, depth and summary."""
+    monkeypatch.setattr(
+        fill, "stream_subtree_nodes", lambda es, **kwargs: iter(make_nodes())
+    )
+    monkeypatch.setattr(fill, "index_updates", lambda *args: (0, 0))
+    fill.PROFILE.reset(enabled=True)
+    try:
+        fill.fill_from_tips(
+            None,
+            {"traverse-limit": "null"},
+            template=template,
+            root="root",
+            max_depth=2,
+        )
+        rows = {(row[0], row[1]): row[2:] for row in fill.PROFILE.export()}
+        path = str(tmp_path / "profile.json")
+        fill.PROFILE.write(path)
+    finally:
+        fill.PROFILE.reset()
+    assert rows[("es_read", "root")][0] == 1
+    assert [rows[("depth", str(depth))][2] for depth in (2, 1, 0)] == [4, 2, 1]
+    assert {("es_write", str(depth)) for depth in (2, 1, 0)} <= set(rows)
+    assert rows[("attribute", "genome_size")][0] == 6
+    assert rows[("summary", "median")][0] == 6
+    with open(path) as fh:
+        report = ujson.load(fh)
+    assert {row["section"] for row in report} == {
+        "attribute",
+        "depth",
+        "es_read",
+        "es_write",
+        "summary",
+    }
+
+
+def test_deduped_list_order_is_stable():
+    """Test deduplicated lists do not depend on string hash order."""
+    assert fill.deduped_list([["UK", "Peru"], "France", "UK"]) == [
+        "France",
+        "Peru",
+        "UK",
+    ]
+
+
+def test_compile_plans_resolves_summaries():
+    """Test attribute metadata is resolved once into summary plans."""
+    plans = fill.compile_plans(
+        {
+            "genome_size": {"type": "long", "summary": "median", "traverse": "mean"},
+            "assembly_level": {
+                "type": "keyword",
+                "summary": ["primary", "enum"],
+                "traverse": "mode",
+                "traverse_direction": "down",
+                "traverse_limit": "order",
+                "order": ["assembly_level", "assembly_span"],
+            },
+        }
+    )
+    plan = plans["genome_size"]
+    assert plan.value_type == "long_value"
+    assert plan.summaries == ("mean", "median")
+    assert plan.summary_types == (["median"], ["median"])
+    assert plan.ascends()
+    assert plan.local_limit("family") == "family"
+    plan = plans["assembly_level"]
+    assert plan.summaries == ("primary", "mode", "enum")
+    assert plan.summary_types[0] == ["enum", "mode"]
+    assert plan.linked == {"assembly_level", "assembly_span"}
+    assert not plan.ascends()
+    assert plan.local_limit("family") == "order"
+
+
+def test_traverse_from_tips_skips_unchanged_nodes(monkeypatch, template):
+    """Test a second traversal over filled values writes no updates."""
+    nodes = make_nodes()
+    monkeypatch.setattr(fill, "stream_subtree_nodes", lambda es, **kwargs: iter(nodes))
+    opts = {"traverse-root": "root", "traverse-limit": "null"}
+    updates = dict(
+        fill.traverse_from_tips(None, opts, template=template, root="root", max_depth=2)
+    )
+    assert len(updates) == 6
+    nodes = [
+        {"_id": doc_id, "_source": ujson.loads(ujson.dumps(source))}
+        for doc_id, source in updates.items()
+    ] + [make_node("sp4", "g2", "species")]
+    updates = dict(
+        fill.traverse_from_tips(None, opts, template=template, root="root", max_depth=2)
+    )
+    assert updates == {}
+
+
+def test_traverse_from_tips_sends_changed_attributes(monkeypatch, template):
+    """Test partial updates only hold attributes whose summaries changed."""
+    nodes = make_nodes()
+    nodes[1]["_source"]["attributes"] = [{"key": "c_value", "float_value": 1.0}]
+    monkeypatch.setattr(fill, "stream_subtree_nodes", lambda es, **kwargs: iter(nodes))
+    opts = {
+        "traverse-root": "root",
+        "traverse-limit": "null",
+        "es-partial-update": True,
+    }
+    updates = dict(
+        fill.traverse_from_tips(None, opts, template=template, root="root", max_depth=2)
+    )
+    assert list(updates["taxon-root"]) == ["attributes"]
+    assert [entry["key"] for entry in updates["taxon-root"]["attributes"]] == [
+        "genome_size"
+    ]
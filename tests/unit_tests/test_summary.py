@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Summary function tests."""
+
+import random
+
+import pytest
+
+from genomehubs.lib import fill
+from genomehubs.lib import summary
+
+
+@pytest.mark.parametrize("name", sorted(summary.NUMERIC_SUMMARIES))
+def test_numeric_summaries_match_python(name):
+    """Test vectorised summaries give the same values as the python versions."""
+    rng = random.Random(name)
+    for length in (1, 2, 5, 8, 101):
+        ints = [rng.randint(1, 6) for _ in [None] * length]
+        floats = [rng.choice([0.5, 1.25, 2.0, 3.5]) for _ in [None] * length]
+        for values in (ints, sorted(ints), floats):
+            expected = fill.SUMMARIES[name](list(values))
+            value = summary.numeric_summary(name, values)
+            if isinstance(expected, list):
+                assert sorted(value) == sorted(expected)
+            else:
+                assert value == expected
+                assert type(value) is type(expected)
+
+
+def test_numeric_summary_falls_back_for_other_values():
+    """Test non-numeric values are left to the python summaries."""
+    assert summary.numeric_summary("median", ["a", "b"]) is None
+    assert summary.numeric_summary("list", [1, 2]) is None
+    assert summary.numeric_summary("max", [1, None]) is None
+
+
+def test_value_sketch_merges_within_error_bound():
+    """Test merged sketches estimate quantiles within the relative error."""
+    rng = random.Random(1)
+    values = [rng.lognormvariate(18, 1) for _ in [None] * 5000]
+    merged = summary.ValueSketch()
+    for start, end in ((0, 1000), (1000, 2500), (2500, 5000)):
+        part = summary.ValueSketch()
+        part.add_values(values[start:end])
+        merged.merge(part)
+    assert merged.count == 5000
+    expected = fill.SUMMARIES["median_low"](values)
+    estimate = merged.summarise("median_low")
+    assert abs(estimate - expected) / expected <= merged.error("median_low")
+    assert merged.summarise("max") == max(values)
+    assert merged.summarise("mean") == pytest.approx(sum(values) / 5000)
+
+
+def test_value_sketch_mode_with_bounded_count_map():
+    """Test the count map keeps the modal value and reports its error."""
+    sketch = summary.ValueSketch(capacity=4)
+    sketch.add_values([7] * 50 + list(range(100)))
+    assert sketch.summarise("mode") == 7
+    assert len(sketch.counts) <= 4
+    assert 0 < sketch.error("mode") < 1
+
+
+def test_accumulators_use_typed_buffers():
+    """Test accumulators are created per key with typed float buffers."""
+    accumulators = summary.Accumulators({"size": "float", "name": "keyword"})
+    accumulators["size"].add([1.5, 2.5])
+    accumulators["size"]["count"] += 2
+    accumulators["name"].add_unique(["a", "b"])
+    accumulators["name"].add_unique(["b", "c"])
+    assert accumulators["size"].values.typecode == "d"
+    assert list(accumulators["size"]["values"]) == [1.5, 2.5]
+    assert accumulators["size"]["count"] == 2
+    assert sorted(accumulators["name"]["values"]) == ["a", "b", "c"]
+    assert "sp_count" in accumulators["name"]
+    assert not hasattr(accumulators["name"], "__dict__")
+
+
+def test_keyword_codes_encode_sets_as_bitsets():
+    """Test keyword sets round trip through a dictionary of codes."""
+    codes = summary.KeywordCodes()
+    first = codes.encode(["b", "a", "b"])
+    second = codes.encode(["c"] + [f"k{idx}" for idx in range(100)])
+    assert len(codes) == 103
+    merged = summary.union_bits([first, second])
+    assert summary.count_bits(merged) == 103
+    assert codes.decode(merged)[:3] == ["a", "b", "c"]
+    assert codes.decode(merged & ~codes.encode(["a", "x"], add=False)) == sorted(
+        ["b", "c"] + [f"k{idx}" for idx in range(100)]
+    )
+    assert len(codes) == 103
+    assert codes.decode(0) == []